@@ -0,0 +1,154 @@
+"""xarray accessor that runs the model on a Dataset of inputs
+
+run_model converts its inputs to NumPy arrays, so calling it with the
+variables of a Dataset loses coordinates, attributes and dask chunking.
+Importing this module registers a blrt accessor on xarray Datasets whose
+run method applies run_model with xarray.apply_ufunc.  Inputs are aligned
+and broadcast by dimension name, and chunked inputs are evaluated lazily
+with dask="parallelized": each block of the broadcast inputs is one call to
+run_model, and nothing is computed until the result is.
+
+Outputs are returned as a Dataset with the coordinates and chunks of the
+inputs and the CF attributes written by beer_lambert_rt.io.make_netcdf.
+Counts of quality flags are not added to the attributes of quality, because
+they would compute the result, see beer_lambert_rt.quality.quality_counts.
+
+Example
+-------
+>>> import beer_lambert_rt.accessor
+>>> ds = xr.open_mfdataset("forcing_2020*.nc", chunks={"time": 1})
+>>> result = ds.blrt.run(diagnostics=["quality"], max_memory="1GB")
+>>> result.par.mean("time").compute()
+"""
+
+import numpy as np
+import xarray as xr
+
+from beer_lambert_rt.io import flux_attrs, par_attrs, extra_output_attrs
+from beer_lambert_rt.model import run_model, extra_output_dtypes
+from beer_lambert_rt.tables import MODEL_INPUTS
+
+
+def run_blocks(*arrays, names, std_names, snow_names, extra_names, ensemble, kwargs):
+    """Runs the model on one block of inputs for apply_ufunc
+
+    :arrays: model inputs in the order of names, then standard deviations in
+             the order of std_names, then snow distribution parameters in the
+             order of snow_names
+    :ensemble: True if outputs have a leading ensemble dimension, which is
+               moved to the end as an apply_ufunc core dimension
+
+    :returns: tuple of flux, par and extra outputs in the order of extra_names
+    """
+    inputs = dict(zip(names, arrays))
+    std = dict(zip(std_names, arrays[len(names):len(names) + len(std_names)]))
+    snow = dict(zip(snow_names, arrays[len(names) + len(std_names):]))
+    if std or "uncertainty" in kwargs:
+        kwargs = {**kwargs, "uncertainty": {**kwargs.get("uncertainty", {}), **std}}
+    if snow:
+        kwargs = {**kwargs, "snow_distribution": {**kwargs.get("snow_distribution", {}),
+                                                  **snow}}
+    flux, par, *extras = run_model(*[inputs[name] for name in MODEL_INPUTS], **kwargs)
+    outputs = [flux, par] + [extras[0][name] for name in extra_names]
+    if ensemble:
+        outputs = [np.moveaxis(value, 0, -1) for value in outputs]
+    return tuple(outputs)
+
+
+@xr.register_dataset_accessor("blrt")
+class BeerLambertAccessor:
+    """Runs the Beer-Lambert model on the variables of a Dataset"""
+
+    def __init__(self, ds):
+        self._ds = ds
+
+    def run(self, variables=None, **kwargs):
+        """Returns a Dataset of flux, PAR and extra outputs of run_model
+
+        :variables: dict of model input to the name of a variable in the
+                    Dataset, a DataArray or a number, for inputs that are not
+                    variables of the same name, e.g. {"sw_radiation": "swdn",
+                    "sea_ice_concentration": 0.9}
+        :kwargs: keywords passed to run_model, e.g. use_distribution,
+                 parameters, jacobian, diagnostics or max_memory.  max_memory
+                 applies to each block.  Standard deviations in uncertainty,
+                 and parameters in snow_distribution, can be DataArrays,
+                 which are broadcast with the inputs.
+
+        :returns: xarray.Dataset with sw_flux, par and any extra outputs.  If
+                  parameters is an ensemble, outputs have a leading ensemble
+                  dimension.
+        """
+        for name in ["progress", "checkpoint", "plan"]:
+            if kwargs.get(name) is not None:
+                raise ValueError(f"{name} cannot be used with the blrt accessor")
+        variables = {**{name: name for name in MODEL_INPUTS}, **(variables or {})}
+        unknown = [name for name in variables if name not in MODEL_INPUTS]
+        if unknown:
+            raise ValueError(f"Unknown model inputs {', '.join(unknown)}, expects "
+                             f"{', '.join(MODEL_INPUTS)}")
+        inputs = []
+        for name in MODEL_INPUTS:
+            value = variables[name]
+            if isinstance(value, str):
+                if value not in self._ds:
+                    raise ValueError(f"Dataset has no variable {value} for {name}")
+                value = self._ds[value]
+            inputs.append(value)
+
+        # DataArray standard deviations are inputs of apply_ufunc, so that
+        # they are aligned and chunked with the model inputs
+        uncertainty = dict(kwargs.pop("uncertainty", None) or {})
+        std = {name: uncertainty.pop(name) for name in list(uncertainty)
+               if isinstance(uncertainty[name], xr.DataArray)}
+        if uncertainty:
+            kwargs["uncertainty"] = uncertainty
+        snow_distribution = dict(kwargs.pop("snow_distribution", None) or {})
+        snow = {name: snow_distribution.pop(name) for name in list(snow_distribution)
+                if isinstance(snow_distribution[name], xr.DataArray)}
+        if snow_distribution:
+            kwargs["snow_distribution"] = snow_distribution
+        extra_dtypes = extra_output_dtypes(kwargs.get("jacobian"),
+                                           kwargs.get("diagnostics"),
+                                           bool(uncertainty or std))
+        # run_model only returns extras if some are requested
+        if not extra_dtypes:
+            kwargs.pop("jacobian", None)
+            kwargs.pop("diagnostics", None)
+
+        parameters = kwargs.get("parameters")
+        nens = None if parameters is None else parameters.ensemble_size
+        output_core_dims = [[] if nens is None else ["ensemble"]] * (2 + len(extra_dtypes))
+        dtypes = [np.float64, np.float64] + list(extra_dtypes.values())
+        outputs = xr.apply_ufunc(
+            run_blocks, *inputs, *std.values(), *snow.values(),
+            kwargs=dict(names=MODEL_INPUTS, std_names=list(std), snow_names=list(snow),
+                        extra_names=list(extra_dtypes), ensemble=nens is not None,
+                        kwargs=kwargs),
+            output_core_dims=output_core_dims,
+            dask="parallelized",
+            output_dtypes=dtypes,
+            dask_gufunc_kwargs={"output_sizes": {} if nens is None else {"ensemble": nens}},
+            keep_attrs="drop",
+        )
+
+        result = xr.Dataset(
+            {
+                "sw_flux": outputs[0].assign_attrs(flux_attrs),
+                "par": outputs[1].assign_attrs(par_attrs),
+                **{name: value.assign_attrs(extra_output_attrs(name))
+                   for name, value in zip(extra_dtypes, outputs[2:])},
+            })
+        # apply_ufunc orders dimensions by first appearance, so ice thickness
+        # on (y, x) would put time last
+        dims = []
+        for value in sorted([value for value in inputs if isinstance(value, xr.DataArray)],
+                            key=lambda value: -value.ndim):
+            dims += [dim for dim in value.dims if dim not in dims]
+        result = result.transpose(*([] if nens is None else ["ensemble"]), *dims)
+        if nens is not None:
+            result = result.assign_coords(
+                ensemble=np.arange(nens),
+                **{name: ("ensemble", getattr(parameters, name).reshape(-1))
+                   for name in parameters.varying})
+        return result
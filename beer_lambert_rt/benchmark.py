@@ -0,0 +1,333 @@
+"""End-to-end benchmark of the daily Stroeve et al (2021) workflow
+
+The original workflow in beer_lambert_rt.orig.py evaluates 15 ice thickness
+classes x 7 snow depth classes for each of the 361 x 361 cells of the EASE
+grid, one day at a time, with triple-nested Python loops.  This module
+measures the refactored pipeline on the same problem size so that speedup
+claims are reproducible:
+
+1. Synthetic daily input files on a 361 x 361 grid are generated with
+   make_synthetic_day and written as netcdf, one file per model day.
+2. Each day is loaded with io.load_data, run with run_model and written with
+   io.make_netcdf and io.write_results.  Each stage is timed.
+3. The same inputs are evaluated with legacy_par, a vectorized version of the
+   original formulation.  legacy_par is checked against the original
+   per-cell function, original_functions.get_f_att_snow, on a sample of
+   cells, and the time of the original loops is extrapolated from that
+   sample.
+
+The refactored model uses a different snow depth distribution, surface
+scattering layers and open water albedo than the original code, so PAR
+differs between the two.  The difference is reported, not asserted.
+
+Peak resident set size (RSS) is read with resource.getrusage, so it is the
+high water mark of the process, recorded after the pipeline and before the
+legacy formulation is run.
+
+Example
+-------
+>>> report = run_benchmark(ndays=31)
+>>> report["pipeline"]["seconds_per_model_day"]
+"""
+
+import datetime as dt
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from beer_lambert_rt.model import run_model
+import beer_lambert_rt.io as io
+from beer_lambert_rt.original_functions import get_f_att_snow
+
+
+# EASE grid used by Stroeve et al (2021)
+GRID_SHAPE = (361, 361)
+
+# Ice thickness class probabilities, flux to PAR factors and number of snow
+# classes used in beer_lambert_rt.orig.py
+LEGACY_ICE_PDF = np.array([0.0646, 0.1415, 0.173, 0.1272, 0.1114, 0.0824, 0.0665,
+                           0.0541, 0.0429, 0.0347, 0.0287, 0.024, 0.0194, 0.016, 0.0136])
+LEGACY_UNDERICE_FLUX2PAR = 3.51
+LEGACY_OPENWATER_FLUX2PAR = 2.30
+LEGACY_NBINS_SNOW = 7
+LEGACY_MAX_FACTOR_ICE = 3.
+
+# Number of cells evaluated by each call of legacy_par in run_benchmark, to
+# keep the (cell x snow x ice) temporaries small
+LEGACY_CHUNK_SIZE = 2**15
+
+
+def make_synthetic_day(day, shape=GRID_SHAPE, seed=0):
+    """Returns synthetic model inputs for one day as an xarray.Dataset
+
+    Fields are smooth large scale patterns plus noise, within the ranges of
+    the spring Arctic inputs used by Stroeve et al (2021): NSIDC sea ice
+    concentration, CryoSat-2 sea ice thickness, SnowModel snow depth and
+    APP-x albedo, surface temperature and downwelling shortwave.  Cells
+    outside a circular ice covered domain are NaN, as for land and ocean
+    outside the ice pack in the observed fields.
+
+    :day: day of month, 1-based.  Fields drift slowly from day to day.
+    :shape: shape of grid
+    :seed: random seed
+
+    :returns: xarray.Dataset with io.EXPECTED_VARIABLES on (y, x)
+    """
+    import xarray as xr
+    rng = np.random.default_rng([seed, day])
+    ny, nx = shape
+    y, x = np.meshgrid(np.linspace(-1., 1., ny), np.linspace(-1., 1., nx), indexing="ij")
+    radius = np.hypot(x, y)
+    phase = 0.05 * day
+    pattern = 0.5 * (1. + np.sin(3. * x + phase) * np.cos(2. * y - phase))
+
+    def noisy(field, scale):
+        return field + scale * rng.standard_normal(shape)
+
+    sea_ice_concentration = np.clip(noisy(1.05 - 0.6 * radius**2, 0.05), 0.15, 1.)
+    ice_thickness = np.clip(noisy(0.4 + 3. * pattern * (1. - radius), 0.1), 0.1, 5.)
+    snow_depth = np.clip(noisy(0.05 + 0.35 * pattern, 0.03), 0., 0.6)
+    # Ponds are not used by run_model
+    pond_depth = np.zeros(shape)
+    albedo = np.clip(noisy(0.85 - 0.2 * (1. - sea_ice_concentration), 0.03), 0.4, 0.9)
+    # Mostly cold, with melting cells near the ice edge later in the month
+    surface_temperature = noisy(-12. + 10. * radius + 0.2 * day, 1.)
+    sw_radiation = np.clip(noisy(150. + 5. * day - 60. * y, 10.), 0., None)
+
+    outside = radius > 1.
+    fields = {
+        "ice_thickness": ice_thickness,
+        "snow_depth": snow_depth,
+        "albedo": albedo,
+        "sw_radiation": sw_radiation,
+        "surface_temperature": surface_temperature,
+        "sea_ice_concentration": sea_ice_concentration,
+        "pond_depth": pond_depth,
+        }
+    for field in fields.values():
+        field[outside] = np.nan
+
+    return xr.Dataset(
+        {name: (("y", "x"), field) for name, field in fields.items()},
+        coords={"y": np.arange(ny), "x": np.arange(nx)},
+        attrs={"title": f"Synthetic model inputs for day {day}"},
+        )
+
+
+def legacy_par(ice_thickness, snow_depth, albedo, sw_radiation,
+               surface_temperature, sea_ice_concentration):
+    """Returns under-ice PAR from a vectorized version of beer_lambert_rt.orig.py
+
+    Reproduces the original formulation, including uniform snow class
+    weights, snow classes up to 13/7 of the mean depth, transmittance
+    clipped to 1 and 1 - albedo for open water.  Inputs are arrays of the
+    same shape, with surface temperature in degrees C.
+
+    :returns: PAR with the shape of the inputs
+    """
+    nbins_ice = LEGACY_ICE_PDF.size
+    snow_factor = (2. * np.arange(1, LEGACY_NBINS_SNOW + 1) - 1.) / LEGACY_NBINS_SNOW
+    ice_factor = (LEGACY_MAX_FACTOR_ICE / 2. *
+                  (2. * np.arange(1, nbins_ice + 1) - 1.) / nbins_ice)
+
+    # Bins are (cell, snow, ice)
+    hsnow = np.multiply.outer(snow_depth, snow_factor)[..., :, np.newaxis]
+    hice = np.multiply.outer(ice_thickness, ice_factor)[..., np.newaxis, :]
+    wet = (surface_temperature > 0.)[..., np.newaxis, np.newaxis]
+
+    k_snow = np.where(wet, np.where((hsnow > 0.) & (hsnow <= 0.03), 40., 5.), 7.)
+    i0_snow = np.where(wet, 0.45, 1.)
+    transmittance = i0_snow * np.exp(-k_snow * hsnow) * np.exp(-hice)
+
+    hssl = np.where(hice <= 0.8, hice / 3. - 1. / 6., 0.1)
+    bare_ice = np.where(hice < 0.5, np.exp(-hice), 0.26 * np.exp(-(hice - hssl)))
+    transmittance = np.where(hsnow == 0., bare_ice, transmittance)
+    transmittance = np.minimum(transmittance, 1.)
+
+    ice_transmittance = transmittance.mean(axis=-2) @ LEGACY_ICE_PDF
+    return sw_radiation * (1. - albedo) * (
+        ice_transmittance * sea_ice_concentration * LEGACY_UNDERICE_FLUX2PAR +
+        (1. - sea_ice_concentration) * LEGACY_OPENWATER_FLUX2PAR)
+
+
+def legacy_par_loop(ice_thickness, snow_depth, albedo, sw_radiation,
+                    surface_temperature, sea_ice_concentration):
+    """Returns under-ice PAR using the per-cell loops of the original code
+
+    Arguments are 1D arrays, see legacy_par.  Slow; use for a sample of cells.
+    """
+    nbins_ice = LEGACY_ICE_PDF.size
+    par = np.zeros(len(ice_thickness))
+    for igrid in range(len(ice_thickness)):
+        i_s_hom = np.zeros(nbins_ice)
+        for ll in range(nbins_ice):
+            hice = ice_thickness[igrid] * LEGACY_MAX_FACTOR_ICE / 2. * (2 * ll + 1) / nbins_ice
+            for kk in range(LEGACY_NBINS_SNOW):
+                hsnow = snow_depth[igrid] * (2 * kk + 1) / LEGACY_NBINS_SNOW
+                f_att_snow = min(get_f_att_snow(hsnow, hice, surface_temperature[igrid]), 1.)
+                i_s_hom[ll] += f_att_snow / LEGACY_NBINS_SNOW
+        t_ow = 1. - albedo[igrid]
+        sic = sea_ice_concentration[igrid]
+        par[igrid] = np.sum(sw_radiation[igrid] * (t_ow * i_s_hom * sic * LEGACY_UNDERICE_FLUX2PAR +
+                                                   t_ow * (1 - sic) * LEGACY_OPENWATER_FLUX2PAR) *
+                            LEGACY_ICE_PDF)
+    return par
+
+
+def peak_rss():
+    """Returns the peak resident set size of the process in bytes, or None if
+    the resource module is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def write_synthetic_inputs(workdir, ndays=31, shape=GRID_SHAPE, seed=0):
+    """Writes one synthetic netcdf input file per day and returns their paths"""
+    workdir = Path(workdir)
+    paths = []
+    for day in range(1, ndays + 1):
+        path = workdir / f"synthetic_inputs_day{day:02d}.nc"
+        make_synthetic_day(day, shape=shape, seed=seed).to_netcdf(path)
+        paths.append(path)
+    return paths
+
+
+def run_pipeline(paths, **run_kwargs):
+    """Runs load, model and write for each input file and times each stage
+
+    :paths: list of input files
+    :run_kwargs: keywords passed to run_model
+
+    :returns: dict of total seconds for each stage and list of output paths
+    """
+    timings = {"load": 0., "model": 0., "write": 0.}
+    outpaths = []
+    for path in paths:
+        start = time.perf_counter()
+        data = io.load_data(path)
+        data.load()
+        loaded = time.perf_counter()
+        flux, par = run_model(
+            data.ice_thickness,
+            data.snow_depth,
+            data.albedo,
+            data.sw_radiation,
+            data.surface_temperature,
+            data.sea_ice_concentration,
+            **run_kwargs)
+        modelled = time.perf_counter()
+        result = io.make_netcdf(flux, par, data.ice_thickness.dims, data.coords, path,
+                                parameters=run_kwargs.get("parameters"))
+        outpath = io.make_outpath(path, "nc")
+        io.write_results(result, outpath)
+        written = time.perf_counter()
+        data.close()
+
+        timings["load"] += loaded - start
+        timings["model"] += modelled - loaded
+        timings["write"] += written - modelled
+        outpaths.append(outpath)
+    return timings, outpaths
+
+
+def run_benchmark(ndays=31, shape=GRID_SHAPE, workdir=None, legacy_sample=2000,
+                  seed=0, **run_kwargs):
+    """Runs the end-to-end benchmark and returns a report
+
+    :ndays: number of model days
+    :shape: shape of grid
+    :workdir: directory for input and output files.  A temporary directory is
+              used and removed if None
+    :legacy_sample: number of cells used to check legacy_par against the
+                    original loops and to extrapolate their run time.  0 skips
+                    the original loops.
+    :seed: random seed for synthetic inputs
+    :run_kwargs: keywords passed to run_model, e.g. max_memory
+
+    :returns: dict that can be serialized as json
+    """
+    import xarray as xr
+    if workdir is None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            return run_benchmark(ndays=ndays, shape=shape, workdir=tmpdir,
+                                 legacy_sample=legacy_sample, seed=seed, **run_kwargs)
+
+    paths = write_synthetic_inputs(workdir, ndays=ndays, shape=shape, seed=seed)
+    ncell = int(np.prod(shape))
+
+    timings, outpaths = run_pipeline(paths, **run_kwargs)
+    pipeline_seconds = sum(timings.values())
+    pipeline_rss = peak_rss()
+
+    legacy_seconds = 0.
+    differences = []
+    legacy_mean = []
+    for path, outpath in zip(paths, outpaths):
+        with xr.open_dataset(path) as data, xr.open_dataset(outpath) as result:
+            inputs = [data[name].values.reshape(-1) for name in
+                      ["ice_thickness", "snow_depth", "albedo", "sw_radiation",
+                       "surface_temperature", "sea_ice_concentration"]]
+            model_par = result["par"].values.reshape(-1)
+        start = time.perf_counter()
+        par = np.concatenate([legacy_par(*[x[i:i + LEGACY_CHUNK_SIZE] for x in inputs])
+                              for i in range(0, ncell, LEGACY_CHUNK_SIZE)])
+        legacy_seconds += time.perf_counter() - start
+        differences.append(model_par - par)
+        legacy_mean.append(np.nanmean(par))
+    differences = np.concatenate(differences)
+
+    report = {
+        "created": dt.datetime.now().isoformat(),
+        "shape": list(shape),
+        "cells": ncell,
+        "model_days": ndays,
+        "pipeline": {
+            **{f"{stage}_seconds": seconds for stage, seconds in timings.items()},
+            "total_seconds": pipeline_seconds,
+            "seconds_per_model_day": pipeline_seconds / ndays,
+            "peak_rss_bytes": pipeline_rss,
+            },
+        "legacy_vectorized": {
+            "total_seconds": legacy_seconds,
+            "seconds_per_model_day": legacy_seconds / ndays,
+            },
+        "model_minus_legacy_par": {
+            "legacy_mean": float(np.mean(legacy_mean)),
+            "mean": float(np.nanmean(differences)),
+            "mean_absolute": float(np.nanmean(np.abs(differences))),
+            "max_absolute": float(np.nanmax(np.abs(differences))),
+            },
+        }
+
+    if legacy_sample:
+        # Check legacy_par against the original per-cell code on ice covered cells
+        with xr.open_dataset(paths[0]) as data:
+            inputs = [data[name].values.reshape(-1) for name in
+                      ["ice_thickness", "snow_depth", "albedo", "sw_radiation",
+                       "surface_temperature", "sea_ice_concentration"]]
+        valid = np.flatnonzero(np.isfinite(inputs[0]))
+        sample = np.random.default_rng(seed).choice(valid, min(legacy_sample, valid.size),
+                                                    replace=False)
+        inputs = [x[sample] for x in inputs]
+        start = time.perf_counter()
+        expected = legacy_par_loop(*inputs)
+        loop_seconds = time.perf_counter() - start
+        loop_seconds_per_day = loop_seconds / sample.size * ncell
+        report["legacy_loop"] = {
+            "sample_cells": int(sample.size),
+            "max_absolute_difference_from_vectorized": float(
+                np.max(np.abs(legacy_par(*inputs) - expected))),
+            "estimated_seconds_per_model_day": loop_seconds_per_day,
+            }
+        report["speedup_over_legacy_loop"] = (loop_seconds_per_day /
+                                              report["pipeline"]["seconds_per_model_day"])
+
+    return report
@@ -0,0 +1,189 @@
+"""Tile-level checkpoint and restart for long model runs
+
+run_model evaluates a grid in tiles, see beer_lambert_rt.planner.  With a
+Checkpoint, outputs are written to .npy files in a checkpoint directory as
+each tile finishes, and the tile is recorded in a state file.  If the job
+dies, running the same job with the same checkpoint directory resumes: the
+outputs of recorded tiles are verified against their checksums and only
+tiles that are missing or fail verification are evaluated.
+
+The state file, state.jsonl, is a JSON lines journal.  The first line
+describes the job: grid shape, tiling, model options, parameters and a
+fingerprint of the inputs.  Each following line records a completed tile,
+its rows (e.g. time steps) and columns, and a CRC32 checksum of each of its
+outputs.  Lines are appended and synced after the outputs of a tile are
+flushed, so a crash leaves at worst a truncated last line, which is ignored.
+On resume the journal is rewritten from the lines that parsed before new
+tiles are appended, so a truncated line is never followed by valid ones.
+
+Example
+-------
+>>> flux, par = run_model(..., max_memory="4GB", checkpoint="run.checkpoint")
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import zlib
+
+import numpy as np
+
+
+STATE_FILE = "state.jsonl"
+
+
+def fingerprint(arrays):
+    """Returns a hex digest of the shapes, dtypes and values of arrays"""
+    digest = hashlib.blake2b(digest_size=16)
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        digest.update(f"{arr.shape}{arr.dtype.str}".encode())
+        digest.update(arr.view(np.uint8).reshape(-1))
+    return digest.hexdigest()
+
+
+def checksum(arr):
+    """Returns the CRC32 checksum of the values of arr"""
+    return zlib.crc32(np.ascontiguousarray(arr).view(np.uint8).reshape(-1))
+
+
+class Checkpoint:
+    """Writes outputs of a run to a checkpoint directory tile by tile
+
+    :directory: path of the checkpoint directory, created if it does not exist
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.outputs = {}
+        self.completed = {}
+        self.resumed = 0
+        self._journal = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @property
+    def state_path(self):
+        return self.directory / STATE_FILE
+
+    def output_path(self, name):
+        return self.directory / f"{name}.npy"
+
+    def read_state(self):
+        """Returns the job description and a dict of completed tile records
+        keyed by tile index, or None, {} if there is no state file"""
+        if not self.state_path.exists():
+            return None, {}
+        with open(self.state_path) as f:
+            lines = f.read().splitlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Truncated last line of a job that died while recording a tile
+                break
+        if not records:
+            return None, {}
+        return records[0], {record["tile"]: record for record in records[1:]}
+
+    def open(self, job, outputs):
+        """Opens output files and returns them with the completed tiles
+
+        If the directory has a state file for a different job, a ValueError is
+        raised rather than overwriting its outputs.
+
+        :job: JSON serializable dict describing the job
+        :outputs: dict of output name to (shape, dtype)
+
+        :returns: dict of output name to numpy.memmap, and dict of verified
+                  tile records keyed by tile index
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        job = json.loads(json.dumps(job))
+        state_job, completed = self.read_state()
+        if state_job is not None and state_job != job:
+            raise ValueError(f"Checkpoint {self.directory} is for a different job.  "
+                             "Remove it or use another directory")
+        resume = state_job is not None and all(self.output_path(name).exists()
+                                               for name in outputs)
+        for name, (shape, dtype) in outputs.items():
+            if resume:
+                arr = np.load(self.output_path(name), mmap_mode="r+")
+                if arr.shape != tuple(shape) or arr.dtype != np.dtype(dtype):
+                    raise ValueError(f"Checkpoint output {name} has shape {arr.shape} "
+                                     f"and dtype {arr.dtype}, expects {shape} and {dtype}")
+            else:
+                arr = np.lib.format.open_memmap(self.output_path(name), mode="w+",
+                                                dtype=dtype, shape=tuple(shape))
+            self.outputs[name] = arr
+        if not resume:
+            completed = {}
+        self._write_state([job, *completed.values()])
+        self._journal = open(self.state_path, "a")
+        self.completed = completed
+        return self.outputs, completed
+
+    def _write_state(self, records):
+        """Replaces the state file with records, one per line"""
+        tmp_path = self.state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def verify(self, blocks):
+        """Drops completed tiles whose outputs do not match their checksums
+
+        :blocks: dict of output name to array viewed as blocks, such that
+                 blocks[name][..., rows, cols] are the outputs of a tile
+
+        :returns: list of indices of tiles that failed verification
+        """
+        failed = [tile for tile, record in self.completed.items()
+                  if any(checksum(blocks[name][..., slice(*record["rows"]),
+                                               slice(*record["cols"])]) != crc
+                         for name, crc in record["checksums"].items())]
+        for tile in failed:
+            del self.completed[tile]
+        self.resumed = len(self.completed)
+        return failed
+
+    def record(self, tile, rows, cols, blocks):
+        """Flushes outputs and records a completed tile
+
+        :tile: tile index
+        :rows, cols: slices of the tile, see ExecutionPlan.blocks
+        :blocks: see verify
+        """
+        for arr in self.outputs.values():
+            arr.flush()
+        record = {
+            "tile": tile,
+            "rows": [rows.start, rows.stop],
+            "cols": [cols.start, cols.stop],
+            "checksums": {name: checksum(arr[..., rows, cols]) for name, arr in blocks.items()},
+            }
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.completed[tile] = record
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def remove(self):
+        """Closes and deletes the checkpoint directory"""
+        self.close()
+        self.outputs = {}
+        shutil.rmtree(self.directory, ignore_errors=True)
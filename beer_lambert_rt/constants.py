@@ -40,4 +40,7 @@ max_factor_snow = 3.
 underice_flux2par = 3.5   # from Eq 10
 openwater_flux2par = 2.3  # from Eq 9 Stroeve et al
 
+# Diffuse attenuation coefficient of PAR in sea water below the ice, m-1
+k_water = 0.1
+
 # Add snow distribution to constants
@@ -0,0 +1,112 @@
+"""PAR profiles in the water column below the ice
+
+run_model returns PAR at the ice base, or at the surface of open water.
+Below it, PAR decays exponentially with depth,
+
+    PAR(z) = PAR(0) exp(-k_water z)
+
+where z is depth below the ice base in meters and k_water is the diffuse
+attenuation coefficient of sea water.  The profile has one more dimension
+than PAR, so it is built lazily as a dask array that broadcasts ice base PAR
+against the attenuation at each depth level.  It is chunked along depth, so
+a profile is evaluated, or written to netCDF, a few levels at a time and
+peak memory does not grow with the number of levels.
+
+Example
+-------
+>>> flux, par = run_model(...)
+>>> profile = par_profile(par, depth=[0., 5., 10., 20., 50.], k_water=0.15)
+>>> profile[..., 2, :, :].compute()
+
+or to write a profile with the model outputs
+
+>>> result = io.make_netcdf(flux, par, dims, coords, input_file)
+>>> io.write_results(add_depth_profile(result, depth=np.arange(0., 50., 1.)), outpath)
+"""
+
+import numpy as np
+
+from beer_lambert_rt.constants import k_water as default_k_water
+
+
+# Number of depth levels in each chunk of a profile
+DEPTH_CHUNK_SIZE = 1
+
+depth_attrs = {
+    "standard_name": "depth",
+    "long_name": "depth below the ice base",
+    "units": "m",
+    "positive": "down",
+    "axis": "Z",
+}
+par_depth_attrs = {
+    "long_name": "downwelling photosynthetic photon irradiance in sea water "
+                 "below the ice base",
+    "units": "mol m-2 s-1",
+}
+
+
+def parse_depth(depth):
+    """Returns depth levels as a 1D float array, raising ValueError for
+    levels that are negative or not finite"""
+    depth = np.atleast_1d(np.asarray(depth, dtype=np.float64))
+    if depth.ndim != 1:
+        raise ValueError(f"depth must be a 1D array of levels, got shape {depth.shape}")
+    if not np.all(np.isfinite(depth)) or np.any(depth < 0.):
+        raise ValueError("depth levels must be finite and non-negative")
+    return depth
+
+
+def depth_axis(ndim):
+    """Returns the axis of the depth dimension in a profile of PAR with ndim
+    dimensions: before the last two, horizontal, dimensions, or first if PAR
+    has fewer than two"""
+    return max(ndim - 2, 0)
+
+
+def par_profile(par, depth, k_water=None, chunk_size=DEPTH_CHUNK_SIZE):
+    """Returns a lazy profile of PAR at depth levels below the ice base
+
+    :par: PAR at the ice base from run_model, e.g. with shape (time, y, x)
+    :depth: depth levels below the ice base in meters
+    :k_water: diffuse attenuation coefficient of sea water in m-1, defaults
+              to beer_lambert_rt.constants.k_water
+    :chunk_size: number of depth levels evaluated at a time
+
+    :returns: dask array with a depth dimension inserted at depth_axis,
+              e.g. (time, depth, y, x)
+    """
+    import dask.array as da
+
+    k_water = default_k_water if k_water is None else float(k_water)
+    if not np.isfinite(k_water) or k_water < 0.:
+        raise ValueError(f"k_water must be finite and non-negative, got {k_water}")
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+    depth = parse_depth(depth)
+    par = np.asarray(par)
+    axis = depth_axis(par.ndim)
+
+    # Ice base PAR is one chunk that is shared, not copied, by every level
+    base = da.from_array(np.expand_dims(par, axis), chunks=-1)
+    attenuation = np.exp(-k_water * depth).reshape((-1,) + (1,) * (par.ndim - axis))
+    attenuation = da.from_array(attenuation, chunks=chunk_size)
+    return base * attenuation.astype(par.dtype)
+
+
+def add_depth_profile(ds, depth, k_water=None, chunk_size=DEPTH_CHUNK_SIZE):
+    """Returns ds with a lazy par_depth variable, a depth coordinate, and
+    k_water in the global attributes
+
+    :ds: xarray.Dataset from io.make_netcdf
+    :depth, k_water, chunk_size: see par_profile
+    """
+    depth = parse_depth(depth)
+    k_water = default_k_water if k_water is None else k_water
+    dims = list(ds.par.dims)
+    dims.insert(depth_axis(len(dims)), "depth")
+    profile = par_profile(ds.par.values, depth, k_water=k_water, chunk_size=chunk_size)
+    ds = ds.assign_coords(depth=("depth", depth, depth_attrs))
+    ds = ds.assign(par_depth=(dims, profile, par_depth_attrs))
+    # Replaces the default written with the other constants
+    return ds.assign_attrs(k_water=float(k_water))
@@ -8,19 +8,66 @@ from the CLI.
 Explore defining a multivariate distribution and then quantizing it.
 """
 
+from functools import lru_cache
+import threading
+
 import numpy as np
-from scipy.stats import skewnorm
 
 
-"""Returns skewnorm distribution for snow depth anomalies from
+"""Parameters of the skewnorm distribution for snow depth anomalies from
 Mallet et al (2021).
-
-:returns: scipy rv_continuous class for skewnorm dist
 """
 skewness = 2.54
 location = -1.11
 scale = 1.5
-snow_depth_anomaly_distribution = skewnorm(skewness, location, scale)
+
+"""Coefficient of variation of snow depth"""
+cv = 0.417
+
+"""Names of the snow depth distribution parameters that can vary between
+cells, see snow_depth_fraction_field
+"""
+SNOW_DISTRIBUTION_PARAMETERS = ["skewness", "location", "scale", "cv"]
+
+"""Largest number of parameter sets whose snow depth fractions are cached by
+snow_depth_fraction_field.  Fields with more distinct sets, e.g. parameters
+that vary smoothly from cell to cell, are not cached.
+"""
+SNOW_FRACTION_CACHE_SIZE = 1024
+_snow_fraction_cache = {}
+# Chunks may be run concurrently, e.g. by dask's threaded scheduler
+_snow_fraction_lock = threading.Lock()
+
+"""Snow depth fractions for the default distribution, keyed by (nbins, factor).
+Precomputed with snow_depth_anomaly_distribution.cdf so that the default model
+configuration does not need to import scipy.
+"""
+PRECOMPUTED_SNOW_DEPTH_FRACTIONS = {
+    (7, 3.): np.array([0.0614582087072322, 0.34041033501290446,
+                       0.36661566758679864, 0.17168994455533867,
+                       0.04964219913097995, 0.009120004146821598,
+                       0.0010636408599244388]),
+}
+
+
+@lru_cache(maxsize=None)
+def get_snow_depth_anomaly_distribution():
+    """Returns skewnorm distribution for snow depth anomalies from
+    Mallet et al (2021).
+
+    scipy.stats is slow to import, so it is imported on first use.
+
+    :returns: scipy rv_continuous class for skewnorm dist
+    """
+    from scipy.stats import skewnorm
+    return skewnorm(skewness, location, scale)
+
+
+def __getattr__(name):
+    """Creates snow_depth_anomaly_distribution on first access"""
+    if name == "snow_depth_anomaly_distribution":
+        return get_snow_depth_anomaly_distribution()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def ice_thickness_distribution(ice_thickness, nbins=15, factor=3.):
@@ -55,7 +102,6 @@ def ice_thickness_distribution(ice_thickness, nbins=15, factor=3.):
 # Put these in script
 def snow_depth_std(snow_depth_mean):
     """Returns standard deviation of snow depths"""
-    cv = 0.417
     return cv * snow_depth_mean
 
 
@@ -84,24 +130,30 @@ def get_bins(xmean, nbins=7, factor=2., loc=None):
               nbin-size array where the lower edge, central value, or upper edge
               of each bin is returned.  width is array with nbins elements that contains
               the width of each bin.
+
+    If xmean is an array, bins are defined along a new trailing axis so that
+    returned arrays have shape xmean.shape + (nbins,) (or nbins+1 for edges).
     """
-    edges = np.linspace(0., xmean*factor, nbins+1)
-    width = np.diff(edges)
+    edges = np.linspace(0., np.multiply(xmean, factor), nbins+1, axis=-1)
+    width = np.diff(edges, axis=-1)
     if loc == "lower":
-        return edges[:-1], width
+        return edges[..., :-1], width
     elif loc == "upper":
-        return edges[1:], width
+        return edges[..., 1:], width
     elif loc == "center":
-        return (edges[:-1] + edges[1:])/2., width
+        return (edges[..., :-1] + edges[..., 1:])/2., width
     return edges, width
 
 
-def snow_depth_distribution(snow_depth, nbins=7, factor=3.):
+def snow_depth_distribution(snow_depth, nbins=7, factor=3., snow_distribution=None):
     """Returns a discrete snow depth distribution
     
     :snow_depth: mean snow depth
     :nbins: number of bins in distribution
     :factor: factor to set maximum snow depth as function of mean snow depth
+    :snow_distribution: dict of distribution parameters that vary between
+                        cells, see snow_depth_fraction_field.  Default=None
+                        uses the module parameters for all cells.
     
     :returns: bin center depth, fraction of dsitribution in bin
     
@@ -113,23 +165,161 @@ def snow_depth_distribution(snow_depth, nbins=7, factor=3.):
     the continuous distribution is covered by the discrete distribution, the sum
     fractions returned by snow_depth_anomaly_distribution.cdf() will not sum to 1.
     To solve this fraction is normalized by the sum of fraction.
-    """
-    
-    edge, width = get_bins(snow_depth, nbins=nbins, factor=factor)
-    std_edge = standardize_snow_depth(edge, snow_depth)
 
-    prob = snow_depth_anomaly_distribution.cdf(std_edge)
-    fraction = np.diff(prob)
-    fraction = fraction/fraction.sum()  # normailize to 1
-    
-    center = (edge[1:] + edge[:-1]) / 2.
-    
+    Because bin edges and the standard deviation both scale with the mean snow
+    depth, the fraction in each bin does not depend on snow_depth.  Fractions are
+    taken from snow_depth_fractions and have shape (nbins,) whatever the shape of
+    snow_depth, or the shape of the parameter fields + (nbins,) if
+    snow_distribution is given.  Bin centers have shape snow_depth.shape + (nbins,).
+    """
+    center, width = get_bins(snow_depth, nbins=nbins, factor=factor, loc="center")
+    if snow_distribution:
+        fraction = snow_depth_fraction_field(nbins, factor, snow_distribution)
+    else:
+        fraction = snow_depth_fractions(nbins, factor)
     return center, fraction
 
 
+@lru_cache(maxsize=None)
+def snow_depth_fractions(nbins=7, factor=3.):
+    """Returns the fraction of the snow depth distribution in each bin
+
+    Snow depth bin edges are standardized by the mean and standard deviation
+    of snow depth.  Because the standard deviation is cv * snow_depth_mean,
+    standardized edges reduce to (edge/snow_depth_mean - 1) / cv, which is
+    independent of the mean.  Fractions are therefore calculated once for each
+    nbins and factor and cached.
+
+    :nbins: number of bins in distribution
+    :factor: factor to set maximum snow depth as function of mean snow depth
+
+    Fractions for the default configuration are precomputed, other
+    configurations are calculated with scipy.
+
+    :returns: read-only array of nbins fractions that sum to 1.
+    """
+    if (nbins, factor) in PRECOMPUTED_SNOW_DEPTH_FRACTIONS:
+        fraction = PRECOMPUTED_SNOW_DEPTH_FRACTIONS[(nbins, factor)].copy()
+    else:
+        edge, width = get_bins(1., nbins=nbins, factor=factor)
+        std_edge = standardize_snow_depth(edge, 1.)
+
+        prob = get_snow_depth_anomaly_distribution().cdf(std_edge)
+        fraction = np.diff(prob)
+        fraction = fraction/fraction.sum()  # normailize to 1
+    fraction.flags.writeable = False
+    return fraction
+
+
+def parse_snow_distribution(snow_distribution):
+    """Returns snow depth distribution parameter fields as float arrays
+
+    :snow_distribution: dict of scalars or arrays keyed by names from
+                        SNOW_DISTRIBUTION_PARAMETERS.  Parameters that are
+                        not given take the module values.
+
+    Raises ValueError for unknown names, values that are not finite, and scale
+    or cv that are not positive.
+
+    :returns: dict of float64 arrays keyed by name
+    """
+    unknown = [name for name in snow_distribution if name not in SNOW_DISTRIBUTION_PARAMETERS]
+    if unknown:
+        raise ValueError(f"Unknown snow distribution parameters {', '.join(unknown)}, "
+                         f"expects {', '.join(SNOW_DISTRIBUTION_PARAMETERS)}")
+    fields = {}
+    for name, value in snow_distribution.items():
+        value = np.asarray(value, dtype=np.float64)
+        if not np.all(np.isfinite(value)):
+            raise ValueError(f"Snow distribution parameter {name} must be finite")
+        if name in ["scale", "cv"] and np.any(value <= 0.):
+            raise ValueError(f"Snow distribution parameter {name} must be positive")
+        fields[name] = value
+    return fields
+
+
+def snow_fraction_table(nbins, factor, parameter_sets):
+    """Returns snow depth fractions for sets of distribution parameters, as
+    snow_depth_fractions, with one vectorized call to scipy
+
+    :parameter_sets: (nsets, 4) array of skewness, location, scale and cv
+
+    :returns: (nsets, nbins) array of fractions
+    """
+    from scipy.stats import skewnorm
+    a, loc, scale, cv = np.asarray(parameter_sets, dtype=np.float64).T[..., np.newaxis]
+    edge, width = get_bins(1., nbins=nbins, factor=factor)
+    prob = skewnorm.cdf((edge - 1.) / cv, a, loc, scale)
+    fraction = np.diff(prob, axis=-1)
+    return fraction / fraction.sum(axis=-1, keepdims=True)
+
+
+def snow_depth_fraction_field(nbins, factor, snow_distribution):
+    """Returns the fraction of the snow depth distribution in each bin for
+    distribution parameters that vary between cells
+
+    Cells that share a set of parameters, e.g. the cells of a region, share
+    fractions: the distinct sets are found with np.unique, and fractions for
+    sets that are not cached are calculated in one vectorized call by
+    snow_fraction_table.  Up to SNOW_FRACTION_CACHE_SIZE sets are cached for
+    later calls, e.g. other chunks of the grid or time steps.
+
+    :nbins: number of bins in distribution
+    :factor: factor to set maximum snow depth as function of mean snow depth
+    :snow_distribution: dict of scalars or arrays keyed by names from
+                        SNOW_DISTRIBUTION_PARAMETERS, see parse_snow_distribution
+
+    :returns: array of fractions with the broadcast shape of the parameters
+              + (nbins,)
+    """
+    defaults = {"skewness": skewness, "location": location, "scale": scale, "cv": cv}
+    fields = parse_snow_distribution(snow_distribution)
+    values = np.broadcast_arrays(*[fields.get(name, defaults[name])
+                                   for name in SNOW_DISTRIBUTION_PARAMETERS])
+    shape = values[0].shape
+    parameter_sets, inverse = np.unique(np.stack([value.reshape(-1) for value in values],
+                                                 axis=-1),
+                                        axis=0, return_inverse=True)
+    if len(parameter_sets) > SNOW_FRACTION_CACHE_SIZE:
+        table = snow_fraction_table(nbins, factor, parameter_sets)
+        return table[inverse.reshape(-1)].reshape(shape + (nbins,))
+
+    keys = [(nbins, factor) + tuple(row) for row in parameter_sets.tolist()]
+    # Fractions for this call are kept locally, as another thread may clear
+    # the cache before they are looked up
+    with _snow_fraction_lock:
+        fractions = {key: _snow_fraction_cache[key] for key in keys
+                     if key in _snow_fraction_cache}
+    missing = [i for i, key in enumerate(keys) if key not in fractions]
+    if missing:
+        for i, fraction in zip(missing, snow_fraction_table(nbins, factor,
+                                                            parameter_sets[missing])):
+            fraction.flags.writeable = False
+            fractions[keys[i]] = fraction
+        with _snow_fraction_lock:
+            if len(_snow_fraction_cache) + len(missing) > SNOW_FRACTION_CACHE_SIZE:
+                _snow_fraction_cache.clear()
+            _snow_fraction_cache.update((keys[i], fractions[keys[i]]) for i in missing)
+    table = np.array([fractions[key] for key in keys])
+    return table[inverse.reshape(-1)].reshape(shape + (nbins,))
+
+
+def bin_average(values, area_fraction):
+    """Returns the area-weighted mean of values over the trailing bin axis
+
+    :values: array with bins along the last axis
+    :area_fraction: (nbins,) fractions shared by all cells, or fractions for
+                    each cell that broadcast with values
+    """
+    if np.ndim(area_fraction) == 1:
+        return values @ area_fraction
+    return np.einsum("...i,...i->...", values, area_fraction)
+
+
 def snow_ice_distribution(ice_thickness_mean, snow_depth_mean, 
                           nbins_ice=15, max_factor_ice=3.,
-                          nbins_snow=7, max_factor_snow=3.):
+                          nbins_snow=7, max_factor_snow=3.,
+                          snow_distribution=None):
     """Returns combined distributions of snow depth and ice thickness, 
     along with a joint probability (% fraction) of area
 
@@ -144,15 +334,33 @@ def snow_ice_distribution(ice_thickness_mean, snow_depth_mean,
     :max_factor_ice: maximum ice thickness factor (default=3.)
     :nbins_snow: number of snow bins to use (default=7)
     :max_factor_snow: maximum ice thckness factor (default=3.)
+    :snow_distribution: dict of snow depth distribution parameters that vary
+                        between cells, see snow_depth_fraction_field
+
+    :returns: ice thicknesses, snow depths and joint probabilities.  Bins
+              are flattened along the last axis, so that thicknesses and depths
+              have shape ice_thickness_mean.shape + (nbins_snow*nbins_ice,).
+              Joint probabilities do not depend on the means and have shape
+              (nbins_snow*nbins_ice,), or the shape of the snow_distribution
+              parameters + (nbins_snow*nbins_ice,).  Average over bins with
+              bin_average.
     """
     snow_depth_dist, snow_prob = snow_depth_distribution(snow_depth_mean,
                                               nbins=nbins_snow,
-                                              factor=max_factor_snow)
+                                              factor=max_factor_snow,
+                                              snow_distribution=snow_distribution)
     ice_thickness_dist, ice_prob = ice_thickness_distribution(ice_thickness_mean,
                                                     nbins=nbins_ice,
                                                     factor=max_factor_ice)
-    ice_thick_2d, snow_depth_2d = np.meshgrid(ice_thickness_dist,
-                                              snow_depth_dist)
-    joint_prob = np.outer(snow_prob, ice_prob)
-    
-    return ice_thick_2d.flatten(), snow_depth_2d.flatten(), joint_prob.flatten()
+    shape = np.broadcast_shapes(np.shape(ice_thickness_mean), np.shape(snow_depth_mean))
+    nsnow = np.shape(snow_prob)[-1]
+    nbins = nsnow * len(ice_prob)
+    ice_thick_2d = np.broadcast_to(ice_thickness_dist[..., np.newaxis, :],
+                                   shape + (nsnow, len(ice_prob)))
+    snow_depth_2d = np.broadcast_to(snow_depth_dist[..., :, np.newaxis],
+                                    shape + (nsnow, len(ice_prob)))
+    joint_prob = snow_prob[..., :, np.newaxis] * ice_prob
+
+    return (ice_thick_2d.reshape(shape + (nbins,)),
+            snow_depth_2d.reshape(shape + (nbins,)),
+            joint_prob.reshape(np.shape(snow_prob)[:-1] + (nbins,)))
@@ -0,0 +1,267 @@
+"""Retrieval of snow depth or ice thickness from observed under-ice light
+
+Flux and PAR decrease monotonically with snow depth and ice thickness, so
+given the other inputs, the snow depth or ice thickness that reproduces an
+observed under-ice flux or PAR can be found by root finding.  All cells are
+solved at once with a bracketed (safeguarded) Newton iteration: each
+iteration evaluates the model and its analytic derivative for the cells that
+have not converged, takes a Newton step, and falls back to bisection when
+the step leaves the bracket.  The bracket keeps the iteration convergent
+across the steps in the model at surface type boundaries, where the Newton
+step alone can cycle.
+
+Transmittance is not monotonic everywhere, e.g. bare ice transmits less
+than a thin wet snow cover, so the bounds may not bracket a solution even
+when one exists.  These cells are scanned at evenly spaced points between
+the bounds and the first subinterval with a sign change is used as the
+bracket.  Where several solutions exist, the smallest found by the scan is
+returned.
+
+Cells with invalid inputs, e.g. zero ice thickness, are classified by
+beer_lambert_rt.quality.validate once before the iteration and are not
+solved, as run_model masks them.
+
+Example
+-------
+>>> result = invert(observed_flux, ice_thickness=1.5, snow_depth=None,
+...                 albedo=0.8, sw_radiation=200., skin_temperature=-5.,
+...                 sea_ice_concentration=1.)
+>>> result.solution[result.converged]
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+
+from beer_lambert_rt.jacobian import calculate_flux_and_par_jacobian
+from beer_lambert_rt.model import check_isarray
+from beer_lambert_rt.parameters import default_parameters
+from beer_lambert_rt.quality import validate, SUBSTITUTE_VALUES
+
+
+# Variables that can be retrieved and their default search bounds in meters
+INVERSION_BOUNDS = {
+    "snow_depth": (0., 2.),
+    "ice_thickness": (0.01, 10.),
+    }
+
+# Observed quantities that can be inverted
+OBSERVABLES = ["sw_flux", "par"]
+
+
+@dataclass
+class InversionResult:
+    """Result of invert
+
+    :solution: retrieved snow depth or ice thickness, NaN where the
+               observation cannot be matched within the bounds
+    :converged: True where the iteration converged.  False where no
+                solution was found, or where the solution lies on a step in
+                the model, e.g. at a surface type boundary
+    :iterations: number of iterations for each cell
+    :residual: modelled minus observed flux or PAR at the solution
+    :quality: quality flags of the inputs other than the solved variable, see
+              beer_lambert_rt.quality.  Cells with flags are not solved.
+    """
+    solution: np.ndarray
+    converged: np.ndarray
+    iterations: np.ndarray
+    residual: np.ndarray
+    quality: np.ndarray
+
+
+def invert(observed,
+           ice_thickness,
+           snow_depth,
+           albedo,
+           sw_radiation,
+           skin_temperature,
+           sea_ice_concentration,
+           solve_for="snow_depth",
+           observable="sw_flux",
+           bounds=None,
+           xtol=1e-6,
+           ftol=1e-6,
+           max_iter=50,
+           nscan=16,
+           use_distribution=True,
+           nsnow_class=7.,
+           max_snow_factor=3.,
+           nice_class=15.,
+           max_ice_factor=3.,
+           parameters=None):
+    """Retrieves snow depth or ice thickness that reproduces observed flux or PAR
+
+    Inputs are as run_model and are broadcast against observed.  The input
+    named by solve_for is used as the initial guess; if None the midpoint of
+    bounds is used.
+
+    :observed: observed under-ice flux or PAR (scalar or array-like)
+    :solve_for: "snow_depth" or "ice_thickness"
+    :observable: "sw_flux" or "par"
+    :bounds: (lower, upper) bounds of the solution.  Defaults to INVERSION_BOUNDS
+    :xtol: convergence tolerance for the solution in meters
+    :ftol: convergence tolerance for the residual
+    :max_iter: maximum number of iterations
+    :nscan: number of points between bounds used to search for a bracket
+            where the bounds do not bracket a solution
+    :parameters: beer_lambert_rt.parameters.Parameters object.  Must not be an
+                 ensemble.
+
+    :returns: InversionResult with arrays of the broadcast shape of the inputs
+    """
+    if solve_for not in INVERSION_BOUNDS:
+        raise ValueError(f"Cannot solve for {solve_for}, expects one of "
+                         f"{', '.join(INVERSION_BOUNDS)}")
+    if observable not in OBSERVABLES:
+        raise ValueError(f"Unknown observable {observable}, expects one of "
+                         f"{', '.join(OBSERVABLES)}")
+    parameters = default_parameters if parameters is None else parameters
+    if parameters.ensemble_size is not None:
+        raise ValueError("Inversion does not support parameter ensembles")
+    lower, upper = INVERSION_BOUNDS[solve_for] if bounds is None else bounds
+    if not lower < upper:
+        raise ValueError(f"Lower bound must be less than upper bound, got {(lower, upper)}")
+
+    inputs = {
+        "ice_thickness": ice_thickness,
+        "snow_depth": snow_depth,
+        "albedo": albedo,
+        "surface_flux": sw_radiation,
+        "skin_temperature": skin_temperature,
+        "sea_ice_concentration": sea_ice_concentration,
+        }
+    if inputs[solve_for] is None:
+        inputs[solve_for] = 0.5 * (lower + upper)
+    arrays = np.broadcast_arrays(check_isarray(observed).astype(np.float64),
+                                 *[check_isarray(x).astype(np.float64)
+                                   for x in inputs.values()])
+    shape = arrays[0].shape
+    observed, *arrays = [arr.reshape(-1) for arr in arrays]
+    inputs = dict(zip(inputs, arrays))
+    ncell = observed.size
+
+    # Invalid inputs are substituted so that the model can be evaluated for
+    # all cells, and the cells are excluded from the search.  The solved
+    # variable is set by the iteration, so it is not checked.
+    quality, cleaned = validate([np.full(ncell, SUBSTITUTE_VALUES[solve_for])
+                                 if name == solve_for else arr
+                                 for name, arr in inputs.items()] +
+                                [np.zeros(ncell), np.zeros(ncell)])
+    invalid = quality > 0
+    inputs = {name: arr if name == solve_for else clean
+              for (name, arr), clean in zip(inputs.items(), cleaned)}
+    index = 0 if observable == "sw_flux" else 1
+    derivative = f"d{'flux' if index == 0 else 'par'}_d{solve_for}"
+
+    def residual(x, cells):
+        """Returns model minus observed and its derivative for a subset of cells"""
+        cell_inputs = {name: arr[cells] for name, arr in inputs.items()}
+        cell_inputs[solve_for] = x
+        result = calculate_flux_and_par_jacobian(
+            **cell_inputs,
+            pond_depth=np.zeros_like(x),
+            pond_fraction=np.zeros_like(x),
+            wrt=[solve_for],
+            use_distribution=use_distribution,
+            nsnow_class=nsnow_class,
+            max_snow_factor=max_snow_factor,
+            nice_class=nice_class,
+            max_ice_factor=max_ice_factor,
+            params=parameters)
+        return result[index] - observed[cells], result[2][derivative]
+
+    all_cells = np.arange(ncell)
+    lo = np.full(ncell, float(lower))
+    hi = np.full(ncell, float(upper))
+    f_lo, _ = residual(lo, all_cells)
+    f_hi, _ = residual(hi, all_cells)
+
+    solution = np.full(ncell, np.nan)
+    final_residual = np.full(ncell, np.nan)
+    converged = np.zeros(ncell, dtype=bool)
+    iterations = np.zeros(ncell, dtype=np.int64)
+
+    # Observations at a bound are solved by the bound
+    for bound, f_bound in [(lo, f_lo), (hi, f_hi)]:
+        at_bound = ~converged & ~invalid & (np.abs(f_bound) <= ftol)
+        solution[at_bound] = bound[at_bound]
+        final_residual[at_bound] = f_bound[at_bound]
+        converged |= at_bound
+
+    # Search for a bracket where the bounds do not bracket a solution
+    unbracketed = np.flatnonzero(~converged & ~invalid &
+                                 ~(np.sign(f_lo) * np.sign(f_hi) < 0))
+    # The scan starts just above the lower bound, because the model steps
+    # at zero snow depth
+    scan_lo = np.full(unbracketed.size, lower + xtol)
+    scan_f_lo, _ = residual(scan_lo, unbracketed)
+    found = np.zeros(unbracketed.size, dtype=bool)
+    for point in np.linspace(lower, upper, nscan + 2)[1:]:
+        if found.all():
+            break
+        cells = unbracketed[~found]
+        x = np.full(cells.size, point)
+        f, _ = residual(x, cells)
+        change = np.sign(scan_f_lo[~found]) * np.sign(f) < 0
+        searching = np.flatnonzero(~found)
+        hi[cells[change]] = point
+        lo[cells[change]] = scan_lo[searching[change]]
+        f_lo[cells[change]] = scan_f_lo[searching[change]]
+        found[searching[change]] = True
+        scan_lo[searching[~change]] = point
+        scan_f_lo[searching[~change]] = f[~change]
+    bracketed = np.ones(ncell, dtype=bool)
+    bracketed[unbracketed[~found]] = False
+    bracketed[invalid] = False
+
+    # Observations outside the range of the model within bounds, or with
+    # invalid inputs, cannot be solved
+    active = np.flatnonzero(~converged & bracketed)
+
+    x = np.clip(inputs[solve_for][active], lo[active], hi[active])
+    x = np.where(np.isfinite(x), x, 0.5 * (lo[active] + hi[active]))
+    lo, hi, f_lo = lo[active], hi[active], f_lo[active]
+
+    for iteration in range(1, max_iter + 1):
+        if active.size == 0:
+            break
+        f, df = residual(x, active)
+        iterations[active] = iteration
+
+        # Shrink the bracket so the root stays between lo and hi
+        same_side = np.sign(f) == np.sign(f_lo)
+        lo = np.where(same_side, x, lo)
+        f_lo = np.where(same_side, f, f_lo)
+        hi = np.where(same_side, hi, x)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = x - f / df
+        outside = ~np.isfinite(newton) | (newton <= lo) | (newton >= hi)
+        x_new = np.where(outside, 0.5 * (lo + hi), newton)
+
+        # Cells whose bracket collapses onto a step in the model stop
+        # without converging
+        with np.errstate(divide="ignore", invalid="ignore"):
+            success = (np.abs(f) <= ftol) | (np.abs(f / df) <= xtol)
+        done = success | ((hi - lo) <= xtol)
+        solution[active[done]] = x[done]
+        final_residual[active[done]] = f[done]
+        converged[active[done]] = success[done]
+
+        keep = ~done
+        active, x, lo, hi, f_lo = active[keep], x_new[keep], lo[keep], hi[keep], f_lo[keep]
+
+    if active.size > 0:
+        # Best estimate for cells that did not converge
+        f, _ = residual(x, active)
+        solution[active] = x
+        final_residual[active] = f
+
+    return InversionResult(
+        solution=solution.reshape(shape),
+        converged=converged.reshape(shape),
+        iterations=iterations.reshape(shape),
+        residual=final_residual.reshape(shape),
+        quality=quality.reshape(shape),
+        )
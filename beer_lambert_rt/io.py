@@ -1,18 +1,21 @@
-"""Loaders for data"""
+"""Loaders for data
+
+xarray, pandas and modules only needed to write metadata are slow to import,
+so they are imported by the functions that use them.  This keeps CLI startup
+fast.
+"""
 
 from pathlib import Path
 import datetime as dt
-import os
-import socket
-import platform
+import getpass
 import re
-import inspect
+import json
 
-import xarray as xr
-import pandas as pd
+import numpy as np
 
 import beer_lambert_rt
 import beer_lambert_rt.constants as constants
+from beer_lambert_rt.parameters import Parameters
 
 
 TESTPATH = Path("tests")
@@ -36,9 +39,24 @@ par_attrs = {
     "standard_name": "downwelling_photosynthetic_photon_spherical_irradiance_in_sea_water_at_sea_ice_base",
     "units": "mol m-2 s-1",
 }
+diagnostic_attrs = {
+    "ice_albedo": {"long_name": "albedo of the ice covered fraction of the grid cell",
+                   "units": "1"},
+    "ice_transmittance": {"long_name": "transmittance of the snow and sea ice column",
+                          "units": "1"},
+    "open_water_fraction": {"long_name": "open water fraction of the grid cell",
+                            "units": "1"},
+    "flux_std": {"long_name": "standard deviation of sw_flux propagated from input "
+                              "uncertainties",
+                 "units": flux_attrs["units"]},
+    "par_std": {"long_name": "standard deviation of par propagated from input "
+                             "uncertainties",
+                "units": par_attrs["units"]},
+}
 
 
 def load_netcdf(filepath):
+    import xarray as xr
     ds = xr.open_dataset(filepath)
     if not all([var in ds.data_vars for var in EXPECTED_VARIABLES]):
         raise KeyError(f"Input file {filepath} must contain variables: "
@@ -49,6 +67,7 @@ def load_netcdf(filepath):
 def load_csv(filepath):
     """Loads a csv file into a pandas dataframe and returns it as an
     xarray dataset"""
+    import pandas as pd
     df = pd.read_csv(filepath, index_col=0, parse_dates=True)
     if not all([var in df.columns for var in EXPECTED_VARIABLES]):
         raise KeyError(f"Input file {filepath} must contain columns: "
@@ -56,6 +75,19 @@ def load_csv(filepath):
     return df.to_xarray()
 
 
+def load_parquet(filepath):
+    """Loads the index and EXPECTED_VARIABLES columns of a parquet file into
+    a pandas dataframe and returns it as an xarray dataset"""
+    import pandas as pd
+    import pyarrow.parquet as pq
+    names = pq.read_schema(filepath).names
+    if not all([var in names for var in EXPECTED_VARIABLES]):
+        raise KeyError(f"Input file {filepath} must contain columns: "
+                       f"{', '.join(EXPECTED_VARIABLES)}")
+    df = pd.read_parquet(filepath, columns=EXPECTED_VARIABLES)
+    return df.to_xarray()
+
+
 def test_datapath(test_format='nc'):
     """Loads test data in a specific format"""
     if test_format == "nc":
@@ -72,8 +104,10 @@ def load_data(filepath):
         data = load_netcdf(filepath)
     elif filepath.suffix == ".csv":
         data = load_csv(filepath)
+    elif filepath.suffix == ".parquet":
+        data = load_parquet(filepath)
     else:
-        raise ValueError(f"{filepath} is unknown format!  Expects netcdf or csv")
+        raise ValueError(f"{filepath} is unknown format!  Expects netcdf, csv or parquet")
     return data
 
 
@@ -89,42 +123,133 @@ def make_outpath(input_path, outformat):
     return input_path.parent / f"{input_path.name}.flux_and_par.{outformat}"
 
 
-def make_global_attrs(source_file):
+def make_global_attrs(source_file, parameters=None, memory_profile=None):
     """Returns a dict object for netcdf global attrs
 
     Model parameters are written to the attributes, 
     along with source file, date created and user name of
-    creator
+    creator.  If parameters is given, scalar parameter values
+    replace the constants.  Ensemble parameters are written
+    as variables by make_netcdf.
+
+    memory_profile is a dict of stage summaries from
+    beer_lambert_rt.profiling.MemoryProfiler.summary.  Peak memory of
+    each stage is written as attributes, e.g. peak_memory_load_rss_bytes.
+    Stages without a measurement are skipped.
     """
+    import socket
+    import platform
     global_attrs = {
         'source_file': str(source_file.absolute()),
         'created': dt.datetime.now().isoformat(),
-        'created_by': os.getlogin(),
+        'created_by': getpass.getuser(),
         'machine': socket.gethostname(),
         'platform': platform.platform(),
         'model': 'beer_lambert_rt',
         'model_version': beer_lambert_rt.__version__ if hasattr(beer_lambert_rt, '__version__') else '',
     }
     constants_dict = constants_to_dict()
-    return {**global_attrs, **constants_dict}
-
-
-def make_netcdf(flux, par, dims, coords, source_file):
-    """Generates a netcdf file"""
-    global_attrs = make_global_attrs(source_file)
+    if parameters is not None:
+        for name, value in parameters.items():
+            constants_dict.pop(name, None)
+            if name not in parameters.varying:
+                constants_dict[name] = value
+    memory_attrs = {}
+    for stage, summary in (memory_profile or {}).items():
+        for kind in ["tracemalloc", "rss"]:
+            peak = summary.get(f"{kind}_peak_bytes")
+            if peak is not None:
+                memory_attrs[f"peak_memory_{stage}_{kind}_bytes"] = int(peak)
+    return {**global_attrs, **constants_dict, **memory_attrs}
+
+
+def extra_output_attrs(name):
+    """Returns variable attributes for an extra output of run_model, e.g. a
+    derivative or a diagnostic field"""
+    from beer_lambert_rt.transmission import (SURFACE_TYPE_FLAG_VALUES,
+                                              SURFACE_TYPE_FLAG_MEANINGS,
+                                              SURFACE_TYPE_FILL_VALUE)
+    if name == "surface_type":
+        return {
+            "long_name": "surface type of grid cell mean snow and ice",
+            "flag_values": SURFACE_TYPE_FLAG_VALUES,
+            "flag_meanings": " ".join(SURFACE_TYPE_FLAG_MEANINGS),
+            "_FillValue": SURFACE_TYPE_FILL_VALUE,
+            }
+    if name == "quality":
+        from beer_lambert_rt.quality import QUALITY_FLAG_MASKS, QUALITY_FLAG_MEANINGS
+        return {
+            "long_name": "input quality flags, zero for valid cells",
+            "flag_masks": QUALITY_FLAG_MASKS,
+            "flag_meanings": " ".join(QUALITY_FLAG_MEANINGS),
+            }
+    match = re.fullmatch("d(flux|par)_d(.+)", name)
+    if match:
+        return {"long_name": f"derivative of {match.group(1)} with respect to "
+                             f"{match.group(2)}"}
+    return diagnostic_attrs.get(name, {})
+
+
+def make_netcdf(flux, par, dims, coords, source_file, parameters=None,
+                memory_profile=None, extras=None):
+    """Generates a netcdf file
+
+    If parameters is an ensemble, flux and par have a leading ensemble
+    dimension, and the values of each varying parameter are written as
+    variables along the ensemble dimension.  memory_profile is written to
+    global attributes, see make_global_attrs.
+
+    extras is a dict of extra outputs from run_model, e.g. derivatives or
+    diagnostics, which are written as variables with the dimensions of flux.
+    The number of valid cells and of cells with each quality flag are
+    written to the attributes of quality, see
+    beer_lambert_rt.quality.quality_counts.
+    """
+    import xarray as xr
+    global_attrs = make_global_attrs(source_file, parameters, memory_profile)
+    if parameters is not None and parameters.ensemble_size is not None:
+        dims = ("ensemble",) + tuple(dims)
+        coords = {
+            **dict(coords),
+            "ensemble": np.arange(parameters.ensemble_size),
+            **{name: ("ensemble", getattr(parameters, name).reshape(-1))
+               for name in parameters.varying},
+            }
     ds = xr.Dataset(
         {
             'sw_flux': (dims, flux, flux_attrs),
             'par': (dims, par, par_attrs),
+            **{name: (dims, value, extra_output_attrs(name))
+               for name, value in (extras or {}).items()},
         },
         coords = coords,
         attrs = global_attrs,
     )
+    if "quality" in ds:
+        from beer_lambert_rt.quality import quality_counts
+        ds["quality"].attrs.update(quality_counts(ds["quality"].values))
     return ds
 
 
+def load_parameters(filepath):
+    """Loads model parameters from a json file
+
+    The file contains an object mapping parameter names to values.  Values
+    can be numbers or lists of numbers, which define a parameter ensemble.
+    Parameters not in the file take default values.
+
+    :filepath: pathlib.Path object for parameter file
+
+    :returns: beer_lambert_rt.parameters.Parameters
+    """
+    with open(filepath) as f:
+        values = json.load(f)
+    return Parameters(**values)
+
+
 def ismyconstant(member):
     """Returns True if member of constants module is constant"""
+    import inspect
     isdunder = lambda x: re.match('__.*__', x)
     if not isdunder(member[0]) and not inspect.ismodule(member[1]):
         return True
@@ -133,20 +258,25 @@ def ismyconstant(member):
 
 def constants_to_dict():
     """Returns a dict of constants"""
+    import inspect
     return {member[0]: member[1] for member in inspect.getmembers(constants) if ismyconstant(member)}
 
 
-def write_results(result, outpath):
+def write_results(result, outpath, encoding=None):
     """Writes results to file
 
     :result: xarray.Dataset containing results
     :outpath: pathlib.Path object for output filename
+    :encoding: netcdf encoding of variables, e.g. from
+               beer_lambert_rt.packing.make_encoding.  Ignored for csv and parquet.
     
     :returns: None
     """
     if outpath.suffix == '.nc':
-        result.to_netcdf(outpath)
+        result.to_netcdf(outpath, encoding=encoding)
     elif outpath.suffix == '.csv':
         result.to_pandas().to_csv(outpath)
+    elif outpath.suffix == '.parquet':
+        result.to_pandas().to_parquet(outpath)
     else:
         raise ValueError("Unknown output format")
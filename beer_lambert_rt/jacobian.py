@@ -0,0 +1,332 @@
+"""Analytic derivatives of flux and PAR with respect to inputs and parameters
+
+Transmittance of each snow depth and ice thickness bin is a product of
+exponentials,
+
+    T_b = i0 * exp(-ksnow * (hsnow_b - hssl_snow)) * exp(-kice * (hice_b - hssl_ice))
+
+and bin depths and thicknesses scale with the mean snow depth and ice
+thickness, hsnow_b = snow_depth * fsnow_b and hice_b = ice_thickness * fice_b.
+Because bin fractions do not depend on the means, derivatives of the grid cell
+transmittance T = sum(w_b * T_b) are weighted sums of the derivatives of T_b,
+which are evaluated in the same vectorized pass as T.
+
+Flux and PAR are linear in T,
+
+    flux = sw * (G * T + (1 - sic) * (1 - albedo_open_water))
+    par = sw * (underice_flux2par * G * T +
+                openwater_flux2par * (1 - sic) * (1 - albedo_open_water))
+
+where G = sic - albedo + albedo_open_water * (1 - sic) is the fraction of
+surface flux absorbed by the ice cover.
+
+Parameters are selected piecewise by surface type, so derivatives are
+evaluated within the surface type of each bin.  Steps in the model at
+surface type boundaries, e.g. at hice = 0.5 m or a surface temperature of
+0 C, are not differentiable and are ignored.  Derivatives with respect to
+skin temperature are therefore zero and are not calculated.
+
+The derivatives give a first-order (delta method) estimate of the
+uncertainty of flux and PAR from independent uncertainties of inputs and
+parameters, without Monte Carlo runs,
+
+    std(flux)**2 = sum_i (dflux/dx_i * std(x_i))**2
+
+see propagate_uncertainty.  The estimate is good while the model is close
+to linear over a few standard deviations of each input, and does not
+include the steps at surface type boundaries.
+"""
+
+import numpy as np
+
+from beer_lambert_rt.distributions import snow_ice_distribution, bin_average
+from beer_lambert_rt.parameters import default_parameters, Parameters
+from beer_lambert_rt.profiling import stage
+from beer_lambert_rt.transmission import (transmittance_terms,
+                                          green_edge_hssl_snow_conditions,
+                                          green_edge_hssl_ice_conditions,
+                                          attenuation_ice_conditions,
+                                          attenuation_snow_conditions,
+                                          surface_transmission_conditions)
+from beer_lambert_rt.model import flux_and_par_from_transmittance
+
+
+# Inputs that flux and PAR can be differentiated with respect to
+JACOBIAN_INPUTS = [
+    "ice_thickness",
+    "snow_depth",
+    "albedo",
+    "sw_radiation",
+    "sea_ice_concentration",
+    ]
+
+# Parameters that flux and PAR can be differentiated with respect to
+JACOBIAN_PARAMETERS = [name for name, _ in Parameters().items()]
+
+# Parameters that only affect transmittance of the ice cover
+TRANSMITTANCE_PARAMETERS = [
+    "hssl_ice", "hssl_dry_snow", "hssl_wet_snow", "hssl_thin_wet_snow",
+    "k_ice", "k_thin_ice", "k_dry_snow", "k_wet_snow", "k_thin_wet_snow",
+    "i0_ice", "i0_dry_snow", "i0_wet_snow", "i0_melt_ponds",
+    ]
+
+
+def parse_wrt(wrt):
+    """Returns a list of variables to differentiate with respect to
+
+    :wrt: True for all inputs and parameters, or an iterable of names from
+          JACOBIAN_INPUTS and JACOBIAN_PARAMETERS
+
+    :returns: list of names
+    """
+    if wrt is True:
+        return JACOBIAN_INPUTS + JACOBIAN_PARAMETERS
+    wrt = [wrt] if isinstance(wrt, str) else list(wrt)
+    unknown = [name for name in wrt if name not in JACOBIAN_INPUTS + JACOBIAN_PARAMETERS]
+    if unknown:
+        raise ValueError(f"Cannot differentiate with respect to {', '.join(unknown)}. "
+                         "Expects names from JACOBIAN_INPUTS or JACOBIAN_PARAMETERS")
+    return wrt
+
+
+# Extra outputs of run_model with uncertainty
+UNCERTAINTY_OUTPUTS = ["flux_std", "par_std"]
+
+
+def parse_uncertainty(uncertainty):
+    """Returns a dict of standard deviations of inputs and parameters
+
+    :uncertainty: dict of names from JACOBIAN_INPUTS and JACOBIAN_PARAMETERS
+                  to standard deviations.  Input standard deviations can be
+                  arrays that broadcast to the grid, parameter standard
+                  deviations are scalars.
+
+    :returns: dict of name to numpy array
+    """
+    parse_wrt(list(uncertainty))
+    std = {name: np.asarray(value, dtype=np.float64) for name, value in uncertainty.items()}
+    for name, value in std.items():
+        if name in JACOBIAN_PARAMETERS and value.ndim > 0:
+            raise ValueError(f"Standard deviation of parameter {name} must be a scalar")
+        if np.any(value < 0.):
+            raise ValueError(f"Standard deviation of {name} must not be negative")
+    return std
+
+
+def propagate_uncertainty(derivatives, std):
+    """Returns standard deviations of flux and PAR from independent standard
+    deviations of inputs and parameters, by the delta method
+
+    :derivatives: dict of derivatives from flux_and_par_derivatives, with
+                  dflux_d<name> and dpar_d<name> for each name in std
+    :std: dict of name to standard deviation
+
+    :returns: flux_std, par_std
+    """
+    flux_var = 0.
+    par_var = 0.
+    for name, value in std.items():
+        flux_var = flux_var + (derivatives[f"dflux_d{name}"] * value) ** 2
+        par_var = par_var + (derivatives[f"dpar_d{name}"] * value) ** 2
+    return np.sqrt(flux_var), np.sqrt(par_var)
+
+
+def selected(conditions):
+    """Returns the index of the first true condition, as np.select, or -1"""
+    return np.select(conditions, list(range(len(conditions))), -1)
+
+
+def transmittance_and_derivatives(ice_thickness, snow_depth, pond_depth,
+                                  surface_temperature, wrt,
+                                  use_distribution=True,
+                                  nbins_snow=7,
+                                  max_factor_snow=3.,
+                                  nbins_ice=15,
+                                  max_factor_ice=3.,
+                                  params=None,
+                                  snow_distribution=None):
+    """Returns transmittance and its derivatives
+
+    Arguments are as get_transmittance.
+
+    :wrt: list of names; ice_thickness, snow_depth or TRANSMITTANCE_PARAMETERS.
+          Other names are ignored.
+
+    :returns: transmittance, dict of derivatives keyed by name
+    """
+    params = default_parameters if params is None else params
+    if use_distribution:
+        with stage("distribution"):
+            hice, hsnow, area_fraction = snow_ice_distribution(ice_thickness, snow_depth,
+                                                               nbins_ice, max_factor_ice,
+                                                               nbins_snow, max_factor_snow,
+                                                               snow_distribution)
+            # Rate of change of bin thickness and depth with the mean
+            fice, fsnow, _ = snow_ice_distribution(1., 1., nbins_ice, max_factor_ice,
+                                                   nbins_snow, max_factor_snow)
+        hpond = np.expand_dims(pond_depth, -1)
+        tsurf = np.expand_dims(surface_temperature, -1)
+        params = params.append_axes(1)
+        average = lambda x: bin_average(x, area_fraction)
+    else:
+        hice, hsnow, hpond, tsurf = ice_thickness, snow_depth, pond_depth, surface_temperature
+        fice = fsnow = 1.
+        average = lambda x: x
+
+    with stage("transmittance"):
+        if np.any(hice <= 0):
+            raise ValueError("One or more hice is zero.  This condition is not allowed")
+
+        if np.any((hsnow > 0.) & (hpond > 0)):
+            raise ValueError("One or more hsnow > 0. and hpond > 0.!")
+
+        i0, hssl_ice, hssl_snow, kice, ksnow = transmittance_terms(hice, hsnow, hpond,
+                                                                  tsurf, params)
+        # Transmittance excluding surface transmission
+        attenuation = np.exp(-1. * ksnow * (hsnow - hssl_snow)) * np.exp(-1. * kice * (hice - hssl_ice))
+        transmittance = i0 * attenuation
+
+        derivatives = {}
+        wrt = set(wrt)
+
+        if "ice_thickness" in wrt:
+            # hssl_ice = hice/3. - 1./6. for 0.5 <= hice < 0.8
+            slope = np.where(selected(green_edge_hssl_ice_conditions(hice, hsnow, hpond)) == 3,
+                             1./3., 0.)
+            derivatives["ice_thickness"] = average(-transmittance * kice * fice * (1. - slope))
+        if "snow_depth" in wrt:
+            derivatives["snow_depth"] = average(-transmittance * ksnow * fsnow)
+
+        choice = {}
+        if wrt & {"k_thin_ice", "k_ice"}:
+            choice["kice"] = selected(attenuation_ice_conditions(hice, params))
+            for index, name in enumerate(["k_thin_ice", "k_ice"]):
+                if name in wrt:
+                    derivatives[name] = average(np.where(choice["kice"] == index,
+                                                         -transmittance * (hice - hssl_ice), 0.))
+        if wrt & {"k_dry_snow", "k_wet_snow", "k_thin_wet_snow"}:
+            choice["ksnow"] = selected(attenuation_snow_conditions(hsnow, tsurf, params))
+            for index, name in enumerate(["k_dry_snow", "k_wet_snow", "k_thin_wet_snow"]):
+                if name in wrt:
+                    derivatives[name] = average(np.where(choice["ksnow"] == index,
+                                                         -transmittance * (hsnow - hssl_snow), 0.))
+        if wrt & {"i0_ice", "i0_melt_ponds", "i0_dry_snow", "i0_wet_snow"}:
+            choice["i0"] = selected(surface_transmission_conditions(hice, hsnow, hpond, tsurf))
+            for index, name in [(0, "i0_ice"), (2, "i0_melt_ponds"),
+                                (3, "i0_dry_snow"), (4, "i0_wet_snow")]:
+                if name in wrt:
+                    derivatives[name] = average(np.where(choice["i0"] == index, attenuation, 0.))
+        if "hssl_ice" in wrt:
+            index = selected(green_edge_hssl_ice_conditions(hice, hsnow, hpond))
+            derivatives["hssl_ice"] = average(np.where(index == 4, transmittance * kice, 0.))
+        if wrt & {"hssl_dry_snow", "hssl_wet_snow", "hssl_thin_wet_snow"}:
+            index = selected(green_edge_hssl_snow_conditions(hsnow, tsurf, params))
+            for i, name in enumerate(["hssl_dry_snow", "hssl_wet_snow", "hssl_thin_wet_snow"]):
+                if name in wrt:
+                    derivatives[name] = average(np.where(index == i, transmittance * ksnow, 0.))
+
+    return average(transmittance), derivatives
+
+
+def calculate_flux_and_par_jacobian(
+        ice_thickness,
+        snow_depth,
+        albedo,
+        surface_flux,
+        skin_temperature,
+        sea_ice_concentration,
+        pond_depth,
+        pond_fraction,
+        wrt=True,
+        use_distribution=True,
+        nsnow_class=7.,
+        max_snow_factor=3.,
+        nice_class=15.,
+        max_ice_factor=3.,
+        params=None):
+    """Calculates flux and PAR, and their derivatives, in one vectorized pass
+
+    Arguments are as beer_lambert_rt.model.calculate_flux_and_par.
+
+    :wrt: True for all inputs and parameters, or a list of names from
+          JACOBIAN_INPUTS and JACOBIAN_PARAMETERS
+
+    :returns: total_flux, total_par, dict of derivatives.  Keys are
+              dflux_d<name> and dpar_d<name>.
+    """
+    params = default_parameters if params is None else params
+    wrt = parse_wrt(wrt)
+
+    transmittance, dtransmittance = transmittance_and_derivatives(
+        ice_thickness, snow_depth, pond_depth, skin_temperature, wrt,
+        use_distribution=use_distribution,
+        nbins_snow=int(nsnow_class),
+        max_factor_snow=max_snow_factor,
+        nbins_ice=int(nice_class),
+        max_factor_ice=max_ice_factor,
+        params=params)
+    total_flux, total_par = flux_and_par_from_transmittance(transmittance, albedo,
+                                                            surface_flux,
+                                                            sea_ice_concentration,
+                                                            params)
+    derivatives = flux_and_par_derivatives(transmittance, dtransmittance, albedo,
+                                           surface_flux, sea_ice_concentration, wrt,
+                                           params)
+    return total_flux, total_par, derivatives
+
+
+def flux_and_par_derivatives(transmittance, dtransmittance, albedo, surface_flux,
+                             sea_ice_concentration, wrt, params=None):
+    """Returns derivatives of flux and PAR given transmittance and its derivatives
+
+    :transmittance: transmittance of the ice cover from transmittance_and_derivatives
+    :dtransmittance: dict of derivatives of transmittance from
+                     transmittance_and_derivatives
+    :albedo: grid cell albedo
+    :surface_flux: shortwave flux at the surface
+    :sea_ice_concentration: sea ice concentration
+    :wrt: list of names from JACOBIAN_INPUTS and JACOBIAN_PARAMETERS
+    :params: Parameters object, default parameters are used if None
+
+    :returns: dict of derivatives.  Keys are dflux_d<name> and dpar_d<name>.
+    """
+    params = default_parameters if params is None else params
+    sic = sea_ice_concentration
+    aow = params.albedo_open_water
+    cui = params.underice_flux2par
+    cow = params.openwater_flux2par
+    # Surface flux absorbed by the ice cover as a fraction of grid cell flux
+    absorbed = sic - albedo + aow * (1 - sic)
+    shape = np.broadcast_shapes(np.shape(transmittance), np.shape(absorbed),
+                                np.shape(surface_flux))
+
+    derivatives = {}
+    for name in wrt:
+        if name in dtransmittance:
+            dflux = surface_flux * absorbed * dtransmittance[name]
+            dpar = cui * dflux
+        elif name == "albedo":
+            dflux = -surface_flux * transmittance
+            dpar = cui * dflux
+        elif name == "sw_radiation":
+            dflux = absorbed * transmittance + (1 - sic) * (1 - aow)
+            dpar = cui * absorbed * transmittance + cow * (1 - sic) * (1 - aow)
+        elif name == "sea_ice_concentration":
+            dflux = surface_flux * (1 - aow) * (transmittance - 1)
+            dpar = surface_flux * (1 - aow) * (cui * transmittance - cow)
+        elif name == "albedo_open_water":
+            dflux = surface_flux * (1 - sic) * (transmittance - 1)
+            dpar = surface_flux * (1 - sic) * (cui * transmittance - cow)
+        elif name == "underice_flux2par":
+            dflux = np.zeros(shape)
+            dpar = surface_flux * absorbed * transmittance
+        elif name == "openwater_flux2par":
+            dflux = np.zeros(shape)
+            dpar = surface_flux * (1 - sic) * (1 - aow)
+        else:
+            # Transmittance parameters are always in dtransmittance
+            raise ValueError(f"Unknown variable {name}")
+        derivatives[f"dflux_d{name}"] = np.broadcast_to(dflux, shape)
+        derivatives[f"dpar_d{name}"] = np.broadcast_to(dpar, shape)
+
+    return derivatives
@@ -1,14 +1,41 @@
 """Main model function and helper functions"""
 
-import warnings
+from contextlib import nullcontext
+from functools import partial
 
 import numpy as np
 
 from beer_lambert_rt.transmission import (get_transmittance,
                                           transmission_open_water,
-                                          modify_albedo)
-from beer_lambert_rt.distributions import snow_ice_distribution
-from beer_lambert_rt.constants import underice_flux2par, openwater_flux2par
+                                          modify_albedo,
+                                          surface_type_flag,
+                                          SURFACE_TYPE_FILL_VALUE)
+from beer_lambert_rt.parameters import default_parameters
+from beer_lambert_rt.planner import plan_execution, PeakMemory
+from beer_lambert_rt.quality import validate
+
+
+# Diagnostic fields that run_model can return, and their dtypes
+DIAGNOSTICS = [
+    "surface_type",
+    "ice_albedo",
+    "ice_transmittance",
+    "open_water_fraction",
+    "quality",
+    ]
+DIAGNOSTIC_DTYPES = {
+    "surface_type": np.uint8,
+    "ice_albedo": np.float64,
+    "ice_transmittance": np.float64,
+    "open_water_fraction": np.float64,
+    "quality": np.uint8,
+    }
+
+# Values of masked cells in outputs that are not float
+MASKED_VALUES = {
+    "surface_type": SURFACE_TYPE_FILL_VALUE,
+    "quality": None,
+    }
 
 
 def run_model(ice_thickness: float,
@@ -23,7 +50,17 @@ def run_model(ice_thickness: float,
               nsnow_class=7.,
               max_snow_factor=3.,
               nice_class=15.,
-              max_ice_factor=3.):
+              max_ice_factor=3.,
+              max_memory=None,
+              plan=None,
+              parameters=None,
+              jacobian=None,
+              diagnostics=None,
+              uncertainty=None,
+              fused=False,
+              snow_distribution=None,
+              progress=None,
+              checkpoint=None):
     """Runs Beer-Lambert RT model
 
     Arguments
@@ -35,6 +72,11 @@ def run_model(ice_thickness: float,
     :skin_temperature: Skin temperature in degrees C (scalar or array-like)
     :sea_ice_concentration: Sea ice concentration [0-1] (scalar or array-like).
 
+    Inputs are broadcast against each other, e.g. (y, x) ice thickness and snow
+    depth with (time, y, x) shortwave radiation, and outputs have the broadcast
+    shape.  Broadcast inputs are not copied, and the snow depth and ice thickness
+    distributions of each cell are built once and shared by all time steps.
+
     Keywords
     --------
     :pond_depth: pond_depth in meters (scalar or array-like). Ignored if None.
@@ -49,58 +91,436 @@ def run_model(ice_thickness: float,
                  Default=15.
     :max_ice_factor: **Not Used** Set maximum ice thickness as max_ice_factor*ice_thickness
                      Default=3.
+    :max_memory: Memory budget for model evaluation as bytes or a string, e.g. "4GB".
+                 The grid is evaluated in chunks sized by
+                 beer_lambert_rt.planner.plan_execution.  Default=None evaluates
+                 the whole grid in one pass.
+    :plan: beer_lambert_rt.planner.ExecutionPlan for the grid.  Overrides max_memory.
+           The peak memory observed during the run is recorded in plan.observed_peak.
+    :parameters: beer_lambert_rt.parameters.Parameters object.  Default values from
+                 beer_lambert_rt.constants are used if None.  If parameters define an
+                 ensemble, all members are evaluated in one pass, sharing inputs and
+                 distributions, and the ensemble is the leading dimension of outputs.
+    :jacobian: Return analytic derivatives of flux and PAR.  True for derivatives with
+               respect to all inputs and parameters, or a list of names from
+               beer_lambert_rt.jacobian.JACOBIAN_INPUTS and JACOBIAN_PARAMETERS.
+               Default=None does not calculate derivatives.
+    :diagnostics: Return diagnostic fields.  True for all of DIAGNOSTICS, or a list
+                  of names.  Default=None does not calculate diagnostics.
+                  quality is a uint8 bitmask of the reasons cells are invalid,
+                  see beer_lambert_rt.quality.
+    :uncertainty: Return standard deviations of flux and PAR, flux_std and par_std,
+                  propagated from a dict of standard deviations of inputs and
+                  parameters with the analytic derivatives, see
+                  beer_lambert_rt.jacobian.propagate_uncertainty.  Input standard
+                  deviations can be arrays that broadcast with the inputs, e.g.
+                  {"ice_thickness": thickness_uncertainty, "snow_depth": 0.05}.
+                  Default=None does not calculate uncertainty.
+    :fused: Evaluate transmittance and flux with fused expressions that avoid
+            full-size temporaries, with numexpr if it is installed or blocked
+            multithreaded NumPy otherwise.  True for the best backend, or a
+            name from beer_lambert_rt.fused.BACKENDS.  Default=False uses NumPy.
+    :snow_distribution: dict of snow depth distribution parameters that vary
+                        between cells, keyed by names from
+                        beer_lambert_rt.distributions.SNOW_DISTRIBUTION_PARAMETERS,
+                        e.g. {"skewness": np.where(multiyear, 1.9, 2.54)}.
+                        Values are scalars or arrays that broadcast with the
+                        inputs.  Cells that share parameters share bin weights,
+                        see beer_lambert_rt.distributions.snow_depth_fraction_field.
+                        Default=None uses the same distribution for all cells.
+    :progress: beer_lambert_rt.progress.ProgressReporter, updated after each chunk,
+               or True to report to stderr.  If no memory budget or plan is
+               given, the grid is evaluated in chunks of at most
+               beer_lambert_rt.progress.PROGRESS_CHUNK_SIZE cells.
+    :checkpoint: directory or beer_lambert_rt.checkpoint.Checkpoint.  Outputs are
+                 written to .npy files in the directory as each chunk finishes.
+                 If the directory holds a checkpoint of the same run, verified
+                 chunks are not evaluated again.  Returned arrays are memory
+                 mapped from the checkpoint files.
+
+    Cells with missing, out of range or inconsistent inputs, e.g. zero ice
+    thickness or zero sea ice concentration, are classified by
+    beer_lambert_rt.quality.validate and masked: their flux, PAR and float
+    extra outputs are NaN, and the rest of the grid is evaluated as usual.
 
     :returns: TBD but PAR, Flux, ????
+              If extra outputs are requested, e.g. with jacobian or diagnostics,
+              returns Flux, PAR and a dict of extra output arrays with the same
+              shape as Flux, e.g. dflux_dice_thickness, dpar_dice_thickness or
+              surface_type.
     """
 
     fixed_pond_depth = 0.
     fixed_pond_fraction = 0.
     
     # Prepare data - converts to numpy.ndarrays
-    ice_thickness_a = check_isarray(ice_thickness)
-    snow_depth_a = check_isarray(snow_depth)
-    albedo_a = check_isarray(albedo)
-    sw_radiation_a = check_isarray(sw_radiation)
-    skin_temperature_a = check_isarray(skin_temperature)
-    sea_ice_concentration_a = check_isarray(sea_ice_concentration)
-
+    arrays = [check_isarray(x) for x in [ice_thickness, snow_depth, albedo, sw_radiation,
+                                         skin_temperature, sea_ice_concentration]]
     # Ponds are note included in the model yet so set to fixed zero values
-    pond_depth_a = np.full_like(ice_thickness_a, fixed_pond_depth)
-    pond_fraction_a = np.full_like(ice_thickness_a, fixed_pond_fraction)
-    
-    # Get input dimensions from ice_thickness.  All other inputs are expected
-    # to have same dimensions.
-    shape = ice_thickness_a.shape
-    
-    # Check all inputs have the same dimensions: except pond_depth and pond_fraction
-    for i, arr in enumerate([ice_thickness_a, snow_depth_a, albedo_a, sw_radiation_a,
-                             skin_temperature_a, sea_ice_concentration_a,
-                             pond_depth_a, pond_fraction_a]):
-        if arr.shape != shape:
-            raise ValueError("One or more input arrays have mismatched shaped. "
-                             f"Expects {shape}, got {arr.shape} for input {i}")
-
-
-    zipped = zip(ice_thickness_a.flatten(),
-                 snow_depth_a.flatten(),
-                 albedo_a.flatten(),
-                 sw_radiation_a.flatten(),
-                 skin_temperature_a.flatten(),
-                 sea_ice_concentration_a.flatten(),
-                 pond_depth_a.flatten(),
-                 pond_fraction_a.flatten())
-    flux_list = []
-    par_list = []
-    for hice, hsnow, alb, swrad, stmp, sic, hpond, pfrac in zipped:
-        flux, par = calculate_flux_and_par(hice, hsnow, alb, swrad,
-                                           stmp, sic, hpond, pfrac,
-                                           use_distribution=use_distribution)
-        flux_list.append(flux)
-        par_list.append(par)
-
-    flux_arr = np.asarray(flux_list).reshape(shape)
-    par_arr = np.asarray(par_list).reshape(shape)
-    return flux_arr, par_arr
+    arrays += [np.asarray(fixed_pond_depth), np.asarray(fixed_pond_fraction)]
+
+    # Inputs are broadcast against each other, e.g. (y, x) ice thickness with
+    # (time, y, x) shortwave radiation
+    try:
+        shape = np.broadcast_shapes(*[arr.shape for arr in arrays])
+    except ValueError:
+        raise ValueError("One or more input arrays have mismatched shapes that do not "
+                         "broadcast.  Got "
+                         f"{', '.join(str(arr.shape) for arr in arrays[:6])}") from None
+    ncell = int(np.prod(shape))
+
+    snow_fields = {}
+    if snow_distribution:
+        from beer_lambert_rt.distributions import parse_snow_distribution
+        snow_fields = parse_snow_distribution(snow_distribution)
+        for name, value in snow_fields.items():
+            if np.broadcast_shapes(shape, value.shape) != shape:
+                raise ValueError(f"Snow distribution parameter {name} with shape "
+                                 f"{value.shape} does not broadcast to the inputs {shape}")
+
+    # Leading dimensions along which ice thickness, snow depth and the snow
+    # distribution are constant, e.g. time for static ice, are rows that share
+    # the distributions of each column
+    nlead = static_leading_dims(shape, arrays[0].shape, arrays[1].shape,
+                                *[value.shape for value in snow_fields.values()])
+    if plan is not None:
+        if plan.ncell != ncell:
+            raise ValueError(f"Execution plan is for {plan.ncell} cells, got {ncell}")
+        if plan.repeats == 1:
+            nlead = 0
+        elif plan.repeats != int(np.prod(shape[:nlead])):
+            raise ValueError(f"Execution plan repeats columns {plan.repeats} times, "
+                             f"expects 1 or {int(np.prod(shape[:nlead]))}")
+    inputs = [as_blocks(arr, shape, nlead) for arr in arrays]
+    snow_blocks = {name: as_blocks(value, shape, nlead) for name, value in snow_fields.items()}
+
+    parameters = default_parameters if parameters is None else parameters
+    nens = parameters.ensemble_size
+    ensemble_shape = () if nens is None else (nens,)
+    # Align ensemble parameters with (rows, columns) blocks of cells
+    params = parameters.append_axes(2)
+
+    std_blocks = {}
+    if jacobian is None and diagnostics is None and uncertainty is None:
+        evaluate = calculate_flux_and_par
+        extra_dtypes = {}
+    else:
+        wrt = []
+        if jacobian is not None:
+            from beer_lambert_rt.jacobian import parse_wrt
+            wrt = parse_wrt(jacobian)
+        diagnostics = [] if diagnostics is None else parse_diagnostics(diagnostics)
+        # Quality flags are set by validate, not evaluated with the model
+        evaluate = partial(calculate_flux_and_par_extras, wrt=wrt,
+                           diagnostics=[name for name in diagnostics if name != "quality"])
+        extra_dtypes = extra_output_dtypes(wrt, diagnostics, uncertainty is not None)
+        if uncertainty is not None:
+            from beer_lambert_rt.jacobian import parse_uncertainty
+            std_blocks = {name: as_blocks(value, shape, nlead)
+                          for name, value in parse_uncertainty(uncertainty).items()}
+    extra_names = list(extra_dtypes)
+
+    if progress is True:
+        from beer_lambert_rt.progress import ProgressReporter
+        progress = ProgressReporter()
+    max_chunk_size = None
+    if progress is not None:
+        from beer_lambert_rt.progress import PROGRESS_CHUNK_SIZE
+        max_chunk_size = PROGRESS_CHUNK_SIZE
+
+    if plan is None:
+        plan = plan_execution(shape, max_memory=max_memory,
+                              dtype=np.result_type(*arrays),
+                              nbins_snow=int(nsnow_class),
+                              nbins_ice=int(nice_class),
+                              use_distribution=use_distribution,
+                              ensemble_size=nens,
+                              # Transmittance derivatives are not fused
+                              fused=bool(fused) and jacobian is None and uncertainty is None,
+                              extra_outputs=len(extra_names),
+                              varying_distribution=bool(snow_blocks),
+                              max_chunk_size=max_chunk_size,
+                              repeats=int(np.prod(shape[:nlead])))
+        track_memory = max_memory is not None
+    else:
+        track_memory = True
+
+    output_dtypes = {"flux": np.float64, "par": np.float64, **extra_dtypes}
+    completed = {}
+    if checkpoint is None:
+        outputs = {name: np.empty(ensemble_shape + shape, dtype=dtype)
+                   for name, dtype in output_dtypes.items()}
+    else:
+        from beer_lambert_rt.checkpoint import Checkpoint, fingerprint
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        job = {
+            "shape": shape,
+            "ensemble_shape": ensemble_shape,
+            "chunk_size": plan.chunk_size,
+            "repeats": plan.repeats,
+            "options": [use_distribution, nsnow_class, max_snow_factor, nice_class,
+                        max_ice_factor],
+            "parameters": {name: np.asarray(value).tolist()
+                           for name, value in parameters.items()},
+            "inputs": fingerprint(inputs),
+            "uncertainty": {name: fingerprint([value]) for name, value in std_blocks.items()},
+            "snow_distribution": {name: fingerprint([value])
+                                  for name, value in snow_blocks.items()},
+            }
+        outputs, completed = checkpoint.open(
+            job, {name: (ensemble_shape + shape, np.dtype(dtype).str)
+                  for name, dtype in output_dtypes.items()})
+    block_grid = ensemble_shape + (plan.repeats, ncell // plan.repeats)
+    blocks = {name: arr.reshape(block_grid) for name, arr in outputs.items()}
+    if checkpoint is not None:
+        checkpoint.verify(blocks)
+
+    if progress is not None:
+        progress.start(plan)
+    # Closes the checkpoint state file if the run fails
+    with PeakMemory(enabled=track_memory) as tracker, checkpoint or nullcontext():
+        for tile, (rows, cols) in enumerate(plan.blocks()):
+            if tile in completed:
+                if progress is not None:
+                    progress.skip((rows, cols))
+                continue
+            quality, tile_inputs = validate([tile_view(arr, rows, cols) for arr in inputs])
+            tile_kwargs = {}
+            if snow_blocks:
+                tile_kwargs["snow_distribution"] = {name: tile_view(value, rows, cols)
+                                                    for name, value in snow_blocks.items()}
+            if std_blocks:
+                tile_kwargs["std"] = {name: tile_view(value, rows, cols)
+                                      for name, value in std_blocks.items()}
+            result = evaluate(
+                *tile_inputs,
+                use_distribution=use_distribution,
+                nsnow_class=nsnow_class,
+                max_snow_factor=max_snow_factor,
+                nice_class=nice_class,
+                max_ice_factor=max_ice_factor,
+                params=params,
+                fused=fused,
+                **tile_kwargs)
+            blocks["flux"][..., rows, cols], blocks["par"][..., rows, cols] = result[:2]
+            for name in extra_names:
+                if name != "quality":
+                    blocks[name][..., rows, cols] = result[2][name]
+            mask_invalid(blocks, rows, cols, quality)
+            if checkpoint is not None:
+                checkpoint.record(tile, rows, cols, blocks)
+            if progress is not None:
+                progress.update((rows, cols))
+    plan.observed_peak = tracker.peak
+    if progress is not None:
+        progress.finish()
+
+    if extra_names:
+        return outputs["flux"], outputs["par"], {name: outputs[name] for name in extra_names}
+    return outputs["flux"], outputs["par"]
+
+
+def extra_output_dtypes(jacobian=None, diagnostics=None, uncertainty=False):
+    """Returns the names and dtypes of the extra outputs of run_model
+
+    :jacobian, diagnostics: as run_model
+    :uncertainty: True if uncertainty is propagated
+
+    :returns: dict of name to dtype, in the order of the extras dict
+    """
+    extra_dtypes = {}
+    if jacobian is not None:
+        from beer_lambert_rt.jacobian import parse_wrt
+        extra_dtypes.update({f"d{output}_d{name}": np.float64
+                             for name in parse_wrt(jacobian) for output in ["flux", "par"]})
+    if diagnostics is not None:
+        extra_dtypes.update({name: DIAGNOSTIC_DTYPES[name]
+                             for name in parse_diagnostics(diagnostics)})
+    if uncertainty:
+        from beer_lambert_rt.jacobian import UNCERTAINTY_OUTPUTS
+        extra_dtypes.update({name: np.float64 for name in UNCERTAINTY_OUTPUTS})
+    return extra_dtypes
+
+
+def mask_invalid(blocks, rows, cols, quality):
+    """Masks outputs of the invalid cells of a tile, and writes quality flags
+    to blocks["quality"] if it is requested
+
+    :blocks: dict of output arrays viewed as (..., rows, columns)
+    :quality: quality flags of the tile from beer_lambert_rt.quality.validate
+    """
+    quality = np.broadcast_to(quality, blocks["flux"][..., rows, cols].shape[-2:])
+    if "quality" in blocks:
+        blocks["quality"][..., rows, cols] = quality
+    invalid = quality > 0
+    if not invalid.any():
+        return
+    for name, arr in blocks.items():
+        fill = MASKED_VALUES.get(name, np.nan)
+        if fill is not None:
+            arr[..., rows, cols][..., invalid] = fill
+
+
+def parse_diagnostics(diagnostics):
+    """Returns a list of diagnostic names
+
+    :diagnostics: True for all DIAGNOSTICS, or an iterable of names
+
+    :returns: list of names
+    """
+    if diagnostics is True:
+        return list(DIAGNOSTICS)
+    diagnostics = [diagnostics] if isinstance(diagnostics, str) else list(diagnostics)
+    unknown = [name for name in diagnostics if name not in DIAGNOSTICS]
+    if unknown:
+        raise ValueError(f"Unknown diagnostics {', '.join(unknown)}.  "
+                         f"Expects names from {', '.join(DIAGNOSTICS)}")
+    return diagnostics
+
+
+def calculate_diagnostics(names, transmittance, ice_thickness, snow_depth, albedo,
+                          skin_temperature, sea_ice_concentration, pond_depth,
+                          params=None):
+    """Returns diagnostic fields
+
+    Surface type is for the grid cell mean ice thickness, snow depth and
+    pond depth, and is encoded as a flag, see
+    beer_lambert_rt.transmission.surface_type_flag.
+
+    :names: list of names from DIAGNOSTICS
+    :transmittance: transmittance of the ice cover from get_transmittance
+    :params: Parameters object, default parameters are used if None
+
+    :returns: dict of diagnostic fields keyed by name
+    """
+    params = default_parameters if params is None else params
+    shape = np.broadcast_shapes(*[np.shape(x) for x in [transmittance, ice_thickness,
+                                                        albedo, skin_temperature,
+                                                        sea_ice_concentration,
+                                                        params.albedo_open_water]])
+    result = {}
+    for name in names:
+        if name == "surface_type":
+            value = surface_type_flag(ice_thickness, snow_depth, pond_depth,
+                                      skin_temperature, params)
+        elif name == "ice_albedo":
+            value = modify_albedo(albedo, sea_ice_concentration, params)
+        elif name == "ice_transmittance":
+            value = transmittance
+        elif name == "open_water_fraction":
+            value = 1. - sea_ice_concentration
+        result[name] = np.broadcast_to(value, shape)
+    return result
+
+
+def calculate_flux_and_par_extras(
+        ice_thickness,
+        snow_depth,
+        albedo,
+        surface_flux,
+        skin_temperature,
+        sea_ice_concentration,
+        pond_depth,
+        pond_fraction,
+        wrt=(),
+        diagnostics=(),
+        std=None,
+        use_distribution=True,
+        nsnow_class=7.,
+        max_snow_factor=3.,
+        nice_class=15.,
+        max_ice_factor=3.,
+        params=None,
+        fused=False,
+        snow_distribution=None):
+    """Calculates flux and PAR with derivatives and diagnostics in one pass
+
+    Arguments are as calculate_flux_and_par.  Transmittance derivatives are
+    always evaluated with NumPy.
+
+    :wrt: list of names to differentiate with respect to, see
+          beer_lambert_rt.jacobian.parse_wrt
+    :diagnostics: list of names from DIAGNOSTICS
+    :std: dict of standard deviations of inputs and parameters, see
+          beer_lambert_rt.jacobian.parse_uncertainty.  Derivatives with respect
+          to each are calculated, and flux_std and par_std are returned.
+
+    :returns: total_flux, total_par, dict of extra outputs
+    """
+    params = default_parameters if params is None else params
+    distribution_kwargs = dict(use_distribution=use_distribution,
+                               nbins_snow=int(nsnow_class),
+                               max_factor_snow=max_snow_factor,
+                               nbins_ice=int(nice_class),
+                               max_factor_ice=max_ice_factor,
+                               params=params,
+                               snow_distribution=snow_distribution)
+    std = {} if std is None else std
+    # Uncertainty needs derivatives that are not returned
+    wrt_all = list(wrt) + [name for name in std if name not in wrt]
+    if wrt_all:
+        from beer_lambert_rt.jacobian import (transmittance_and_derivatives,
+                                              flux_and_par_derivatives,
+                                              propagate_uncertainty)
+        transmittance, dtransmittance = transmittance_and_derivatives(
+            ice_thickness, snow_depth, pond_depth, skin_temperature, wrt_all,
+            **distribution_kwargs)
+    else:
+        transmittance = get_transmittance(ice_thickness, snow_depth, pond_depth,
+                                          skin_temperature, fused=fused,
+                                          **distribution_kwargs)
+    total_flux, total_par = flux_and_par(transmittance, albedo, surface_flux,
+                                         sea_ice_concentration, params, fused=fused)
+    extras = {}
+    if wrt_all:
+        derivatives = flux_and_par_derivatives(transmittance, dtransmittance, albedo,
+                                               surface_flux, sea_ice_concentration,
+                                               wrt_all, params)
+        extras.update({f"d{output}_d{name}": derivatives[f"d{output}_d{name}"]
+                       for name in wrt for output in ["flux", "par"]})
+    if std:
+        extras["flux_std"], extras["par_std"] = propagate_uncertainty(derivatives, std)
+    extras.update(calculate_diagnostics(diagnostics, transmittance, ice_thickness,
+                                        snow_depth, albedo, skin_temperature,
+                                        sea_ice_concentration, pond_depth, params))
+    return total_flux, total_par, extras
+
+
+def tile_view(arr, rows, cols):
+    """Returns the (rows, cols) tile of an array from as_blocks.  Arrays that
+    are constant along rows or columns are not sliced along them."""
+    return arr[rows if arr.shape[0] > 1 else slice(None),
+               cols if arr.shape[1] > 1 else slice(None)]
+
+
+def static_leading_dims(shape, *static_shapes):
+    """Returns the number of leading dimensions of shape along which arrays
+    with static_shapes are constant, i.e. have length 1 or are broadcast"""
+    nlead = 0
+    for axis in range(len(shape)):
+        offset = len(shape) - axis
+        if any(len(s) >= offset and s[-offset] != 1 for s in static_shapes):
+            break
+        nlead += 1
+    # Keeps at least one column dimension
+    return min(nlead, max(len(shape) - 1, 0))
+
+
+def as_blocks(arr, shape, nlead):
+    """Returns arr broadcast to shape as a (rows, columns) array, where rows
+    are the nlead leading dimensions of shape and columns the remaining
+    dimensions.  Rows or columns along which arr is constant have length 1,
+    so broadcast inputs are not copied.
+
+    :returns: 2D array with shape (1 or nrows, 1 or ncolumns)
+    """
+    arr = arr.reshape((1,) * (len(shape) - arr.ndim) + arr.shape)
+    lead, trail = arr.shape[:nlead], arr.shape[nlead:]
+    rows = shape[:nlead] if any(n != 1 for n in lead) else lead
+    cols = shape[nlead:] if any(n != 1 for n in trail) else trail
+    return np.broadcast_to(arr, rows + cols).reshape(int(np.prod(rows)),
+                                                     int(np.prod(cols)))
 
 
 def check_isarray(x):
@@ -121,36 +541,77 @@ def calculate_flux_and_par(
         nsnow_class=7.,
         max_snow_factor=3.,
         nice_class=15.,
-        max_ice_factor=3.):
+        max_ice_factor=3.,
+        params=None,
+        fused=False,
+        snow_distribution=None):
     """Calculates flux and PAR for one input.  
-    Function can be mapped to scalar, 1D and 2D arrays
+    Inputs can be scalars, or 1D and 2D arrays of the same shape, in which case
+    all cells are evaluated in one vectorized pass.
 
-    """
+    params is a Parameters object with array-valued parameters aligned to the
+    inputs (see Parameters.append_axes).  Default parameters are used if None.
 
-    for arr in [ice_thickness, snow_depth, albedo, surface_flux,
-                skin_temperature, sea_ice_concentration, pond_depth, pond_fraction]:
-        if not np.isscalar(arr):
-            warnings.warn(f"One or more inputs is not scalar: shape: {arr.shape} "
-                          "This may cause unexpected results", UserWarning)
+    fused selects fused evaluation, and snow_distribution sets snow depth
+    distribution parameters for each cell, see run_model.
+    """
+    params = default_parameters if params is None else params
 
-    # Get ice cover albedo - check Key user guide
-    ice_albedo = modify_albedo(albedo, sea_ice_concentration)
-    
     # Calculate transmittance for ice fraction as distribution of single values
     ice_cover_transmittance = get_transmittance(ice_thickness, snow_depth,
                                                 pond_depth, skin_temperature,
-                                                use_distribution=use_distribution)
-    ice_cover_transmittance = (1 - ice_albedo) * ice_cover_transmittance
+                                                use_distribution=use_distribution,
+                                                nbins_snow=int(nsnow_class),
+                                                max_factor_snow=max_snow_factor,
+                                                nbins_ice=int(nice_class),
+                                                max_factor_ice=max_ice_factor,
+                                                params=params,
+                                                fused=fused,
+                                                snow_distribution=snow_distribution)
+    return flux_and_par(ice_cover_transmittance, albedo, surface_flux,
+                        sea_ice_concentration, params, fused=fused)
+
+
+def flux_and_par(transmittance, albedo, surface_flux, sea_ice_concentration,
+                 params=None, fused=False):
+    """Returns grid cell mean flux and PAR with flux_and_par_from_transmittance,
+    or beer_lambert_rt.fused.fused_flux_and_par if fused"""
+    if fused:
+        from beer_lambert_rt.fused import fused_flux_and_par
+        return fused_flux_and_par(transmittance, albedo, surface_flux,
+                                  sea_ice_concentration, params, fused=fused)
+    return flux_and_par_from_transmittance(transmittance, albedo, surface_flux,
+                                           sea_ice_concentration, params)
+
+
+def flux_and_par_from_transmittance(transmittance, albedo, surface_flux,
+                                    sea_ice_concentration, params=None):
+    """Returns grid cell mean flux and PAR given the transmittance of the ice cover
+
+    :transmittance: transmittance of the snow and ice column from get_transmittance
+    :albedo: grid cell albedo
+    :surface_flux: shortwave flux at the surface
+    :sea_ice_concentration: sea ice concentration
+    :params: Parameters object, default parameters are used if None
+
+    :returns: total_flux, total_par
+    """
+    params = default_parameters if params is None else params
+
+    # Get ice cover albedo - check Key user guide
+    ice_albedo = modify_albedo(albedo, sea_ice_concentration, params)
+
+    ice_cover_transmittance = (1 - ice_albedo) * transmittance
 
     # Calculate flux for open water
-    ow_transmittance = transmission_open_water()
+    ow_transmittance = transmission_open_water(params)
     
     # Calculate total flux
     ice_swflux = surface_flux * ice_cover_transmittance
     ow_swflux = surface_flux * ow_transmittance
 
-    ice_par = ice_swflux * underice_flux2par
-    ow_par = ow_swflux * openwater_flux2par
+    ice_par = ice_swflux * params.underice_flux2par
+    ow_par = ow_swflux * params.openwater_flux2par
 
     total_par = ((ice_par * sea_ice_concentration) +
                  (ow_par * (1 - sea_ice_concentration)))
@@ -160,5 +621,3 @@ def calculate_flux_and_par(
                   (ow_swflux * (1 - sea_ice_concentration)))
                   
     return total_flux, total_par
-
-
@@ -0,0 +1,158 @@
+"""Packed integer encoding of output variables
+
+Daily 361 x 361 float64 fields of flux and PAR are stored with far more
+precision than the model has.  The functions here build an xarray to_netcdf
+encoding that packs output variables to 16 bit integers following the CF
+conventions: values are stored as round((value - add_offset) / scale_factor),
+missing values as _FillValue, and readers unpack them as
+packed * scale_factor + add_offset.
+
+The scale factor of a variable is the requested precision, and the offset
+is chosen so that the physical range of the variable, PACKING_RANGES, fits
+the packed type.  Non-negative variables are packed to uint16.  Round-trip
+error is at most half the precision, and is checked before a file is written.
+Variables are compressed with zlib after a byte shuffle, and chunked by
+time step.
+
+Example
+-------
+>>> result = io.make_netcdf(flux, par, dims, coords, input_file)
+>>> io.write_results(result, outpath, encoding=make_encoding(result, {"par": 0.05}))
+"""
+
+import numpy as np
+
+from beer_lambert_rt.constants import underice_flux2par, openwater_flux2par
+
+
+# Upper bound of surface shortwave flux in W m-2, above the solar constant
+MAX_SW_FLUX = 1400.
+
+# Physical range of packed variables as (valid_min, valid_max).  ice_albedo
+# is derived from the grid cell albedo by removing open water, so is not
+# bounded at low sea ice concentration and is compressed but not packed.
+PACKING_RANGES = {
+    "sw_flux": (0., MAX_SW_FLUX),
+    "par": (0., MAX_SW_FLUX * max(underice_flux2par, openwater_flux2par)),
+    "ice_transmittance": (0., 1.),
+    "open_water_fraction": (0., 1.),
+    }
+
+# Default precision of packed variables, in the units of the variable
+DEFAULT_PRECISION = {
+    "sw_flux": 0.05,
+    "par": 0.1,
+    "ice_transmittance": 1e-4,
+    "open_water_fraction": 1e-4,
+    }
+
+# zlib compression level, 1 to 9
+COMPRESSION_LEVEL = 4
+
+# Number of values checked at a time by check_packing
+CHECK_BLOCK_SIZE = 2**20
+
+
+def packing_params(valid_min, valid_max, precision):
+    """Returns the packed dtype, scale_factor, add_offset and _FillValue for a
+    variable
+
+    :valid_min, valid_max: physical range of the variable
+    :precision: step between packed values
+
+    :returns: dict of encoding keys for xarray to_netcdf
+    """
+    if not precision > 0.:
+        raise ValueError(f"precision must be positive, got {precision}")
+    dtype = np.dtype(np.uint16 if valid_min >= 0. else np.int16)
+    info = np.iinfo(dtype)
+    # The largest uint16 or smallest int16 value is reserved for _FillValue
+    fill = info.max if dtype.kind == "u" else info.min
+    lowest, highest = packed_limits(dtype, fill)
+    nsteps = int(np.ceil((valid_max - valid_min) / precision))
+    if nsteps > highest - lowest:
+        raise ValueError(f"A range of {valid_min} to {valid_max} needs {nsteps + 1} values "
+                         f"at a precision of {precision}, more than {dtype.name} holds")
+    return {
+        "dtype": dtype.name,
+        "scale_factor": float(precision),
+        "add_offset": float(valid_min - lowest * precision),
+        "_FillValue": dtype.type(fill),
+        }
+
+
+def packed_limits(dtype, fill):
+    """Returns the smallest and largest packed values that are not fill"""
+    info = np.iinfo(dtype)
+    return (info.min + 1, info.max) if fill == info.min else (info.min, info.max - 1)
+
+
+def check_packing(values, params, precision, name="values"):
+    """Checks that values round trip through packing within precision
+
+    NaN is written as _FillValue, so is not checked.
+
+    :values: array of unpacked values
+    :params: see packing_params
+    :precision: maximum allowed absolute round-trip error
+
+    :returns: maximum absolute round-trip error
+    """
+    lowest, highest = packed_limits(np.dtype(params["dtype"]), params["_FillValue"])
+    scale, offset = params["scale_factor"], params["add_offset"]
+    flat = np.asarray(values, dtype=np.float64).reshape(-1)
+    max_error = 0.
+    for start in range(0, flat.size, CHECK_BLOCK_SIZE):
+        block = flat[start:start + CHECK_BLOCK_SIZE]
+        block = block[np.isfinite(block)]
+        if block.size == 0:
+            continue
+        packed = np.round((block - offset) / scale)
+        if packed.min() < lowest or packed.max() > highest:
+            raise ValueError(f"{name} has values from {block.min()} to {block.max()}, "
+                             f"outside the packed range of {lowest * scale + offset} "
+                             f"to {highest * scale + offset}")
+        max_error = max(max_error, np.abs(packed * scale + offset - block).max())
+    if max_error > precision:
+        raise ValueError(f"Round-trip error of {name} is {max_error}, more than the "
+                         f"precision {precision}")
+    return max_error
+
+
+def output_chunks(shape):
+    """Returns chunk sizes of one time step, the last two dimensions, for
+    gridded variables, or the whole variable for tables.  Leading dimensions,
+    e.g. ensemble and time, have chunks of 1."""
+    if len(shape) < 2:
+        return tuple(shape)
+    return (1,) * (len(shape) - 2) + tuple(shape[-2:])
+
+
+def make_encoding(ds, precision=None, complevel=COMPRESSION_LEVEL):
+    """Returns a to_netcdf encoding that packs and compresses output variables
+
+    Float variables in PACKING_RANGES are packed to 16 bit integers after
+    checking that they round trip within precision.  Other variables, e.g.
+    derivatives, ice_albedo and surface_type flags, are compressed but not packed.
+
+    :ds: xarray.Dataset from io.make_netcdf
+    :precision: dict of variable name to precision, overriding DEFAULT_PRECISION
+    :complevel: zlib compression level
+
+    :returns: dict of variable name to encoding
+    """
+    precision = {**DEFAULT_PRECISION, **(precision or {})}
+    unknown = [name for name in precision if name not in PACKING_RANGES]
+    if unknown:
+        raise ValueError(f"Cannot pack {', '.join(unknown)}, expects "
+                         f"{', '.join(PACKING_RANGES)}")
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = {"zlib": True, "shuffle": True, "complevel": complevel}
+        if var.ndim > 0:
+            encoding[name]["chunksizes"] = output_chunks(var.shape)
+        if name in PACKING_RANGES and np.issubdtype(var.dtype, np.floating):
+            params = packing_params(*PACKING_RANGES[name], precision[name])
+            check_packing(var.values, params, precision[name], name=name)
+            encoding[name].update(params)
+    return encoding
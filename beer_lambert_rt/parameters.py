@@ -0,0 +1,110 @@
+"""Model parameters as a single frozen object
+
+The Apparent Optical Properties and flux to PAR conversion factors defined in
+beer_lambert_rt.constants are collected in a Parameters object that is passed
+through the model functions.  Default values are taken from constants.
+
+Each parameter can be a scalar or a 1D array of values.  Array values define
+a parameter ensemble: all array-valued parameters must have the same length,
+and scalar parameters are shared by every member.  The ensemble is evaluated
+in one broadcast pass, with the ensemble as the leading dimension of outputs.
+
+Example
+-------
+>>> params = Parameters(k_dry_snow=np.linspace(5., 9., 100))
+>>> params.ensemble_size
+100
+>>> flux, par = run_model(..., parameters=params)
+>>> flux.shape
+(100, ...)
+"""
+
+from dataclasses import dataclass, fields, replace
+
+import numpy as np
+
+import beer_lambert_rt.constants as constants
+
+
+@dataclass(frozen=True)
+class Parameters:
+    """Apparent optical properties and conversion factors used by the model
+
+    See beer_lambert_rt.constants for a description of each parameter.
+    """
+    albedo_open_water: float = constants.albedo_open_water
+
+    hssl_ice: float = constants.hssl_ice
+    hssl_dry_snow: float = constants.hssl_dry_snow
+    hssl_wet_snow: float = constants.hssl_wet_snow
+    hssl_thin_wet_snow: float = constants.hssl_thin_wet_snow
+
+    k_ice: float = constants.k_ice
+    k_thin_ice: float = constants.k_thin_ice
+    k_dry_snow: float = constants.k_dry_snow
+    k_wet_snow: float = constants.k_wet_snow
+    k_thin_wet_snow: float = constants.k_thin_wet_snow
+
+    i0_ice: float = constants.i0_ice
+    i0_dry_snow: float = constants.i0_dry_snow
+    i0_wet_snow: float = constants.i0_wet_snow
+    i0_melt_ponds: float = constants.i0_melt_ponds
+
+    underice_flux2par: float = constants.underice_flux2par
+    openwater_flux2par: float = constants.openwater_flux2par
+
+    def __post_init__(self):
+        sizes = set()
+        for name, value in self.items():
+            if np.ndim(value) == 0:
+                object.__setattr__(self, name, float(value))
+                continue
+            value = np.array(value, dtype=np.float64)
+            if value.ndim > 1 and value.shape[1:] != (1,) * (value.ndim - 1):
+                raise ValueError(f"Parameter {name} must be a scalar or 1D array, "
+                                 f"got shape {value.shape}")
+            value.flags.writeable = False
+            object.__setattr__(self, name, value)
+            sizes.add(value.shape[0])
+        if len(sizes) > 1:
+            raise ValueError("Array-valued parameters must have the same length, "
+                             f"got lengths {sorted(sizes)}")
+
+    def items(self):
+        """Returns (name, value) pairs for each parameter"""
+        return [(field.name, getattr(self, field.name)) for field in fields(self)]
+
+    @property
+    def ensemble_size(self):
+        """Number of ensemble members, or None if all parameters are scalar"""
+        for name, value in self.items():
+            if np.ndim(value) > 0:
+                return np.shape(value)[0]
+        return None
+
+    @property
+    def varying(self):
+        """Names of array-valued parameters"""
+        return [name for name, value in self.items() if np.ndim(value) > 0]
+
+    def append_axes(self, naxes):
+        """Returns Parameters with naxes singleton axes appended to array-valued
+        parameters, so that they broadcast against arrays with naxes dimensions
+        and the ensemble becomes the leading dimension.  Scalar parameters are
+        unchanged.
+        """
+        if self.ensemble_size is None or naxes == 0:
+            return self
+        changes = {}
+        for name in self.varying:
+            value = getattr(self, name)
+            changes[name] = value.reshape(value.shape + (1,) * naxes)
+        return replace(self, **changes)
+
+    def member(self, index):
+        """Returns scalar Parameters for one ensemble member"""
+        changes = {name: getattr(self, name).reshape(-1)[index] for name in self.varying}
+        return replace(self, **changes)
+
+
+default_parameters = Parameters()
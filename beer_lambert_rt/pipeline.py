@@ -0,0 +1,482 @@
+"""Config-driven pipeline: load, regrid, model, reduce and write
+
+beer_lambert_rt.orig.py loops over hardcoded years and months, with a path
+template and a loader for each source dataset.  Here a run is described by
+a PipelineConfig, usually loaded from a json file with load_config, and
+run_pipeline executes it one date at a time:
+
+1. load: each model input is read from its source file for the date
+2. regrid: fields are interpolated to the target grid
+3. model: run_model is run on the daily fields
+4. reduce: daily outputs are stacked, or reduced, over each output period
+5. write: each output period is written to a netcdf file
+
+Regridded daily inputs are cached on disk as .npz files, keyed by the
+source and grid configuration, so that reruns with different model options
+skip loading and regridding.  A cached date is reloaded if a source file has
+changed.  Dates are independent, so they are run concurrently in worker
+processes; HDF5 is not thread-safe and the model is CPU bound.
+
+Example config
+--------------
+{
+  "start": "2020-03-01",
+  "end": "2020-04-30",
+  "grid": {"path": "ease_grid.nc"},
+  "sources": {
+    "ice_thickness": {"path": "SIT/SIT_CS2_CPOM_{date:%Y}.nc",
+                      "variable": "Sea Ice Thickness", "regrid": "nearest",
+                      "lat": "Latitude", "lon": "Longitude"},
+    "snow_depth": {"path": "snow/SM_snod_{date:%Y}.nc", "variable": "snod"},
+    "albedo": {"path": "APPX/{date:%Y}/appx_{date:%Y%m%d}.nc",
+               "variable": "cdr_surface_albedo", "valid_range": [0, 1]},
+    "sw_radiation": {"path": "APPX/{date:%Y}/appx_{date:%Y%m%d}.nc",
+                     "variable": "cdr_surface_downwelling_shortwave_flux"},
+    "surface_temperature": {"path": "APPX/{date:%Y}/appx_{date:%Y%m%d}.nc",
+                            "variable": "cdr_surface_temperature",
+                            "offset": -273.15},
+    "sea_ice_concentration": {"path": "SIC/nt_{date:%Y%m%d}.nc",
+                              "variable": "sic", "scale": 0.01}
+  },
+  "model": {"max_memory": "2GB"},
+  "output": {"path": "out/under_ice_par_{date:%Y%m}.nc", "period": "month"},
+  "cache": "cache",
+  "workers": 4
+}
+
+>>> written = run_pipeline(load_config(Path("run.json")))
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+import datetime as dt
+from functools import partial
+import hashlib
+from itertools import groupby
+import json
+import os
+from pathlib import Path
+import warnings
+
+import numpy as np
+
+from beer_lambert_rt.checkpoint import fingerprint
+from beer_lambert_rt.profiling import stage
+from beer_lambert_rt.tables import MODEL_INPUTS
+from beer_lambert_rt.trajectory import (get_projection, fractional_index,
+                                        bilinear_weights, bilinear_sample)
+
+
+REGRID_METHODS = ["none", "bilinear", "nearest"]
+
+PERIODS = ["day", "month", "year", "all"]
+
+# Masked cells are NaN, so reductions skip them and a cell is only NaN if it
+# is masked on every day of a period
+REDUCTIONS = {
+    "mean": np.nanmean,
+    "min": np.nanmin,
+    "max": np.nanmax,
+    }
+
+# Flag outputs reduced with any reduction.  The quality of a period flags
+# every reason a cell was masked on any of its days.
+FLAG_REDUCTIONS = {
+    "quality": np.bitwise_or.reduce,
+    }
+
+MODEL_OPTIONS = ["use_distribution", "max_memory", "parameters", "diagnostics"]
+
+SOURCE_KEYS = ["path", "variable", "value", "time_dim", "y", "x", "lat", "lon",
+               "regrid", "scale", "offset", "valid_range", "max_distance"]
+
+# Regridding indices and weights of each source geometry, computed once per
+# process
+_regrid_cache = {}
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    """Description of a pipeline run
+
+    :start, end: first and last date, inclusive
+    :grid: target grid, a dict with the path of a netcdf file holding the y
+           and x coordinates of the grid, and optionally the names "y" and "x"
+           of the coordinates and the "projection" passed to
+           trajectory.get_projection
+    :sources: dict of model input name to source, see load_source
+    :model: keywords passed to run_model, see MODEL_OPTIONS.  parameters is a
+            dict of parameter values or the path of a json parameter file.
+    :output: dict with the "path" template of output files, formatted with
+             the first date of each period, the "period" of each file, from
+             PERIODS, the "reduce" function over a period, from REDUCTIONS or
+             None to write daily fields, and "pack", a dict of precisions
+             passed to packing.make_encoding, or None to write floats
+    :cache: directory for regridded daily inputs, or None to not cache
+    :workers: number of dates run concurrently
+    :path: path of the config file, written to output attributes
+    """
+    start: dt.date
+    end: dt.date
+    grid: dict
+    sources: dict
+    model: dict = field(default_factory=dict)
+    output: dict = field(default_factory=dict)
+    cache: str = None
+    workers: int = 1
+    path: Path = None
+
+    def __post_init__(self):
+        for name in ["start", "end"]:
+            value = getattr(self, name)
+            if isinstance(value, str):
+                object.__setattr__(self, name, dt.date.fromisoformat(value))
+        if self.end < self.start:
+            raise ValueError(f"end {self.end} is before start {self.start}")
+        if "path" not in self.grid:
+            raise ValueError("grid must give the path of a file with the grid coordinates")
+        missing = [name for name in MODEL_INPUTS if name not in self.sources]
+        if missing:
+            raise ValueError(f"sources must be given for {', '.join(missing)}")
+        for name, source in self.sources.items():
+            unknown = [key for key in source if key not in SOURCE_KEYS]
+            if unknown:
+                raise ValueError(f"Unknown keys for source {name}: {', '.join(unknown)}")
+            if ("path" in source) == ("value" in source):
+                raise ValueError(f"Source {name} must give either a path or a value")
+            if source.get("regrid", "none") not in REGRID_METHODS:
+                raise ValueError(f"Unknown regrid method for source {name}, expects "
+                                 f"{', '.join(REGRID_METHODS)}")
+        unknown = [key for key in self.model if key not in MODEL_OPTIONS]
+        if unknown:
+            raise ValueError(f"Unknown model options {', '.join(unknown)}, expects "
+                             f"{', '.join(MODEL_OPTIONS)}")
+        if "path" not in self.output:
+            raise ValueError("output must give a path template")
+        if self.output.get("period", "month") not in PERIODS:
+            raise ValueError(f"Unknown output period, expects {', '.join(PERIODS)}")
+        reduce = self.output.get("reduce")
+        if reduce is not None and reduce not in REDUCTIONS:
+            raise ValueError(f"Unknown reduction {reduce}, expects "
+                             f"{', '.join(REDUCTIONS)} or null")
+        diagnostics = self.model.get("diagnostics")
+        if reduce is not None and (diagnostics is True or "surface_type" in (diagnostics or [])):
+            raise ValueError("surface_type flags cannot be reduced")
+
+    def dates(self):
+        """Returns the list of dates from start to end"""
+        ndays = (self.end - self.start).days + 1
+        return [self.start + dt.timedelta(days=day) for day in range(ndays)]
+
+
+def load_config(filepath):
+    """Loads a PipelineConfig from a json file
+
+    Relative paths in the config are relative to the directory of the file.
+
+    :filepath: pathlib.Path object for config file
+    """
+    with open(filepath) as f:
+        values = json.load(f)
+    root = filepath.parent
+    values["grid"] = {**values.get("grid", {})}
+    if "path" in values["grid"]:
+        values["grid"]["path"] = str(root / values["grid"]["path"])
+    values["sources"] = {name: {**source, "path": str(root / source["path"])}
+                         if "path" in source else source
+                         for name, source in values.get("sources", {}).items()}
+    values["output"] = {**values.get("output", {})}
+    if "path" in values["output"]:
+        values["output"]["path"] = str(root / values["output"]["path"])
+    if values.get("cache") is not None:
+        values["cache"] = str(root / values["cache"])
+    parameters = values.get("model", {}).get("parameters")
+    if isinstance(parameters, str):
+        values["model"] = {**values["model"], "parameters": str(root / parameters)}
+    return PipelineConfig(**values, path=filepath)
+
+
+def load_grid(grid):
+    """Returns the y and x coordinates of the target grid"""
+    import xarray as xr
+    with xr.open_dataset(grid["path"]) as ds:
+        return ds[grid.get("y", "y")].values, ds[grid.get("x", "x")].values
+
+
+def period_start(date, period):
+    """Returns the first date of the output period that contains date"""
+    if period == "day":
+        return date
+    if period == "month":
+        return date.replace(day=1)
+    if period == "year":
+        return date.replace(month=1, day=1)
+    return None
+
+
+def source_path(source, date):
+    """Returns the path of the source file for a date"""
+    return Path(source["path"].format(date=date))
+
+
+def select_date(da, date, time_dim):
+    """Returns the field of a DataArray for a date, the mean if there are
+    several time steps in the date.  Fields without time_dim are returned
+    unchanged."""
+    if time_dim not in da.dims:
+        return da
+    field = da.sel({time_dim: date.isoformat()})
+    if time_dim in field.dims:
+        if field.sizes[time_dim] == 0:
+            raise ValueError(f"{da.name} has no data for {date}")
+        field = field.mean(time_dim)
+    return field
+
+
+def regrid(field, source, ds, grid, projection):
+    """Interpolates a source field to the target grid
+
+    Source fields can be on the target grid ("none"), on a regular grid in
+    the target projection with 1D y and x coordinates ("bilinear"), or on a
+    curvilinear grid with 2D latitude and longitude ("nearest").  Indices and
+    weights depend only on the source grid, so are computed once.
+
+    :field: 2D array on the source grid
+    :source: source config
+    :ds: xarray.Dataset of the source file, with the source grid coordinates
+    :grid: (y, x) coordinates of the target grid
+    :projection: see trajectory.get_projection
+
+    :returns: 2D array on the target grid
+    """
+    y, x = grid
+    method = source.get("regrid", "none")
+    if method == "none":
+        if field.shape != (y.size, x.size):
+            raise ValueError(f"Source field of shape {field.shape} is not on the target "
+                             f"grid of shape {(y.size, x.size)}, set a regrid method")
+        return field
+    if method == "bilinear":
+        src_y = ds[source.get("y", "y")].values
+        src_x = ds[source.get("x", "x")].values
+        key = ("bilinear", fingerprint([src_y, src_x, y, x]))
+        if key not in _regrid_cache:
+            fy, fx = np.meshgrid(fractional_index(y, src_y), fractional_index(x, src_x),
+                                 indexing="ij")
+            _regrid_cache[key] = bilinear_weights(fy, fx, (src_y.size, src_x.size))
+        return bilinear_sample(field, *_regrid_cache[key])
+    lat = ds[source.get("lat", "lat")].values
+    lon = ds[source.get("lon", "lon")].values
+    key = ("nearest", fingerprint([lat, lon, y, x]), source.get("max_distance"))
+    if key not in _regrid_cache:
+        from scipy.spatial import cKDTree
+        src_x, src_y = get_projection(projection)(lat.reshape(-1), lon.reshape(-1))
+        tree = cKDTree(np.column_stack([src_x, src_y]))
+        xx, yy = np.meshgrid(x, y)
+        distance, index = tree.query(np.column_stack([xx.reshape(-1), yy.reshape(-1)]))
+        valid = np.ones(index.shape, dtype=bool)
+        if source.get("max_distance") is not None:
+            valid = distance <= source["max_distance"]
+        _regrid_cache[key] = (index.reshape(yy.shape), valid.reshape(yy.shape))
+    index, valid = _regrid_cache[key]
+    return np.where(valid, np.asarray(field, dtype=np.float64).reshape(-1)[index], np.nan)
+
+
+def load_source(source, date, grid, projection=None):
+    """Loads a model input for a date on the target grid
+
+    A source is a dict with either a constant "value", or the "path" template
+    of a file, formatted with date, and the "variable" to read.  Optional keys:
+
+    - time_dim: name of the time dimension, default "time".  Variables
+      without it are used for every date.
+    - regrid: "none", "bilinear" or "nearest", see regrid, with "y" and "x"
+      or "lat" and "lon", the names of the source coordinates, and
+      "max_distance" in meters for nearest neighbours
+    - valid_range: [min, max], values outside are set to NaN
+    - scale, offset: converts units as value * scale + offset
+
+    :returns: 2D float array
+    """
+    import xarray as xr
+    y, x = grid
+    if "value" in source:
+        return np.full((y.size, x.size), float(source["value"]))
+    with xr.open_dataset(source_path(source, date)) as ds:
+        field = select_date(ds[source["variable"]], date, source.get("time_dim", "time"))
+        field = np.asarray(field.values, dtype=np.float64)
+        if "valid_range" in source:
+            low, high = source["valid_range"]
+            field = np.where((field >= low) & (field <= high), field, np.nan)
+        field = regrid(field, source, ds, grid, projection)
+    return field * source.get("scale", 1.) + source.get("offset", 0.)
+
+
+def cache_key(config):
+    """Returns a hex digest of the source and grid configuration"""
+    text = json.dumps({"sources": config.sources, "grid": config.grid}, sort_keys=True)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def source_stamp(config, date):
+    """Returns the path, size and modification time of each source file for
+    a date, used to detect changed files"""
+    stamp = []
+    for name in MODEL_INPUTS:
+        source = config.sources[name]
+        if "path" in source:
+            path = source_path(source, date)
+            stat = path.stat()
+            stamp.append([str(path), stat.st_size, stat.st_mtime_ns])
+    return json.dumps(stamp)
+
+
+def cache_path(config, date):
+    """Returns the path of the cached inputs for a date"""
+    return Path(config.cache) / cache_key(config) / f"{date:%Y%m%d}.npz"
+
+
+def load_inputs(config, date, grid):
+    """Returns a dict of model input name to 2D array on the target grid,
+    from the cache if the source files have not changed"""
+    stamp = source_stamp(config, date) if config.cache is not None else None
+    if config.cache is not None and cache_path(config, date).exists():
+        with np.load(cache_path(config, date)) as cached:
+            if str(cached["stamp"]) == stamp:
+                return {name: cached[name] for name in MODEL_INPUTS}
+    projection = config.grid.get("projection")
+    inputs = {name: load_source(config.sources[name], date, grid, projection)
+              for name in MODEL_INPUTS}
+    if config.cache is not None:
+        path = cache_path(config, date)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary file and renamed, so that a cached date is
+        # never partly written
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(tmp, stamp=np.array(stamp), **inputs)
+        os.replace(tmp, path)
+    return inputs
+
+
+def model_options(config):
+    """Returns keywords for run_model from the model config"""
+    from beer_lambert_rt.parameters import Parameters
+    import beer_lambert_rt.io as io
+    options = dict(config.model)
+    parameters = options.get("parameters")
+    if isinstance(parameters, str):
+        options["parameters"] = io.load_parameters(Path(parameters))
+    elif parameters is not None:
+        options["parameters"] = Parameters(**parameters)
+    return options
+
+
+def run_date(config, date, grid):
+    """Loads inputs and runs the model for a date
+
+    :returns: dict of output name to array: sw_flux, par and any extra outputs
+    """
+    from beer_lambert_rt.model import run_model
+    with stage("load"):
+        inputs = load_inputs(config, date, grid)
+    flux, par, *extras = run_model(*[inputs[name] for name in MODEL_INPUTS],
+                                   **model_options(config))
+    return {"sw_flux": flux, "par": par, **(extras[0] if extras else {})}
+
+
+def ordered_map(executor, func, items, ahead):
+    """Yields func(item) for items in order, with at most ahead items
+    submitted to executor at a time, so that finished results do not pile up"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def reduce_period(results, reduce=None):
+    """Stacks daily results along a time dimension before the grid dimensions,
+    and reduces them over time if reduce is given
+
+    :results: list of dicts from run_date
+    :reduce: name of a function in REDUCTIONS, or None.  Outputs in
+             FLAG_REDUCTIONS are reduced with their own function.
+
+    :returns: dict of output name to array
+    """
+    stacked = {}
+    for name in results[0]:
+        values = np.stack([result[name] for result in results], axis=-3)
+        if reduce is not None:
+            func = FLAG_REDUCTIONS.get(name, REDUCTIONS[reduce])
+            with warnings.catch_warnings():
+                # Cells masked on every day are NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                values = func(values, axis=-3, keepdims=True)
+        stacked[name] = values
+    return stacked
+
+
+def write_period(config, start, dates, outputs, grid):
+    """Writes the outputs of an output period to netcdf and returns the path"""
+    import beer_lambert_rt.io as io
+    y, x = grid
+    period = config.output.get("period", "month")
+    path = Path(config.output["path"].format(date=start or dates[0]))
+    time = dates[:1] if config.output.get("reduce") is not None else dates
+    outputs = dict(outputs)
+    result = io.make_netcdf(outputs.pop("sw_flux"), outputs.pop("par"), ("time", "y", "x"),
+                            {"time": np.array(time, dtype="datetime64[ns]"), "y": y, "x": x},
+                            config.path or path,
+                            parameters=model_options(config).get("parameters"),
+                            extras=outputs)
+    result.attrs["period"] = period
+    if config.output.get("reduce") is not None:
+        result.attrs["reduction"] = config.output["reduce"]
+    encoding = None
+    if config.output.get("pack") is not None:
+        from beer_lambert_rt.packing import make_encoding
+        encoding = make_encoding(result, precision=config.output["pack"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    io.write_results(result, path, encoding=encoding)
+    return path
+
+
+def run_pipeline(config, workers=None, verbose=False):
+    """Runs a pipeline and writes an output file for each period
+
+    Dates are run concurrently in worker processes, and the outputs of a
+    period are written as soon as all of its dates have finished.
+
+    :config: PipelineConfig
+    :workers: number of worker processes, overrides config.workers.  1 runs
+              dates in this process.
+
+    :returns: list of paths of output files
+    """
+    workers = config.workers if workers is None else workers
+    period = config.output.get("period", "month")
+    grid = load_grid(config.grid)
+    dates = config.dates()
+    written = []
+    executor = ProcessPoolExecutor(workers) if workers > 1 else nullcontext()
+    with executor:
+        func = partial(run_date, config, grid=grid)
+        if workers > 1:
+            results = ordered_map(executor, func, dates, ahead=2 * workers)
+        else:
+            results = map(func, dates)
+        daily = zip(dates, results)
+        for start, group in groupby(daily, key=lambda item: period_start(item[0], period)):
+            period_dates, period_results = zip(*group)
+            outputs = reduce_period(period_results, config.output.get("reduce"))
+            with stage("write"):
+                path = write_period(config, start, list(period_dates), outputs, grid)
+            if verbose:
+                print(f"Wrote {path}")
+            written.append(path)
+    return written
@@ -0,0 +1,299 @@
+"""Memory-budgeted execution planning for the batched model engine
+
+get_transmittance evaluates all cells in one vectorized pass, with the joint
+snow depth and ice thickness distribution laid out along a trailing bin axis.
+Intermediate arrays therefore scale as ncell x nbins_snow x nbins_ice, and a
+single call on a large grid can exhaust memory.
+
+The planner estimates the working memory needed per cell from the number of
+bins and the input dtype, and chooses a chunk size so that each call to the
+engine stays within a memory budget.  The peak memory actually allocated
+while executing a plan is measured with tracemalloc and recorded on the plan.
+
+Example
+-------
+>>> plan = plan_execution((361, 361), max_memory="512MB")
+>>> flux, par = run_model(..., plan=plan)
+>>> plan.observed_peak
+"""
+
+from dataclasses import dataclass
+import re
+import tracemalloc
+
+import numpy as np
+
+
+# Number of full-size (cell x bin) temporaries alive at the peak of
+# calculate_transmittance.  np.select promotes choices to float64, so these
+# are float64 whatever the input dtype.  Estimated using tracemalloc, which
+# gives 10 for large chunks and up to 11 for chunks of a few hundred cells.
+BINNED_TEMPORARIES = 11
+BINNED_ITEMSIZE = 8
+
+# Number of full-size (cell x bin) arrays alive with fused evaluation, see
+# beer_lambert_rt.fused: the snow and ice distributions and transmittance.
+# Other temporaries are held for one block in each thread.
+FUSED_BINNED_TEMPORARIES = 3
+
+# Number of (cell x bin) arrays added when snow distribution parameters vary
+# between cells: the joint probabilities of each cell, and the parameter sets,
+# fractions and scipy temporaries of fields that vary from cell to cell.
+# Estimated using tracemalloc.  Joint probabilities are shared by ensemble
+# members.
+VARYING_DISTRIBUTION_TEMPORARIES = 3
+
+# Number of per-cell temporaries alive in calculate_flux_and_par, including
+# contiguous copies of the input chunks.
+CELL_TEMPORARIES = 16
+
+# Memory used by each chunk independent of chunk size, e.g. distribution tables
+CHUNK_OVERHEAD = 64 * 1024
+
+# Number of per-cell output arrays (flux and par) allocated for the whole grid
+CELL_OUTPUTS = 2
+OUTPUT_ITEMSIZE = 8
+
+MEMORY_UNITS = {
+    "": 1,
+    "B": 1,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "KIB": 1024,
+    "MIB": 1024**2,
+    "GIB": 1024**3,
+    "TIB": 1024**4,
+}
+
+
+@dataclass
+class ExecutionPlan:
+    """Describes how a grid of ncell cells is split into chunks
+
+    :shape: shape of the model grid
+    :ncell: number of cells in the grid
+    :chunk_size: number of cells evaluated in each call to the engine
+    :nchunks: number of chunks
+    :max_memory: memory budget in bytes, None if unlimited
+    :bytes_per_cell: estimated working memory for each cell in a chunk
+    :estimated_peak: estimated peak memory in bytes
+    :observed_peak: peak memory in bytes allocated while executing the plan,
+                    None until the plan has been executed
+    :repeats: number of rows when the grid is viewed as (repeats, ncell // repeats),
+              e.g. time steps that share the ice thickness and snow depth of
+              each column.  Blocks of rows are evaluated together so that the
+              distributions of a column are built once.
+    """
+    shape: tuple
+    ncell: int
+    chunk_size: int
+    nchunks: int
+    max_memory: int = None
+    bytes_per_cell: int = 0
+    estimated_peak: int = 0
+    observed_peak: int = None
+    repeats: int = 1
+
+    def chunks(self):
+        """Returns an iterator of slices into the flattened grid"""
+        for start in range(0, self.ncell, self.chunk_size):
+            yield slice(start, min(start + self.chunk_size, self.ncell))
+
+    def block_shape(self):
+        """Returns the number of rows and columns in each block"""
+        nrows = max(min(self.repeats, self.chunk_size), 1)
+        return nrows, max(self.chunk_size // nrows, 1)
+
+    def blocks(self):
+        """Returns an iterator of (rows, columns) slices into the grid viewed as
+        (repeats, ncell // repeats).  Each block has at most chunk_size cells.
+        All rows of a block of columns are evaluated before the next block of
+        columns."""
+        ncols = self.ncell // max(self.repeats, 1)
+        block_rows, block_cols = self.block_shape()
+        for col in range(0, ncols, block_cols):
+            cols = slice(col, min(col + block_cols, ncols))
+            for row in range(0, self.repeats, block_rows):
+                yield slice(row, min(row + block_rows, self.repeats)), cols
+
+
+def parse_memory(max_memory):
+    """Returns a memory size in bytes
+
+    :max_memory: int number of bytes or a string such as "4GB", "512 MiB" or
+                 "1.5e9".  Decimal (KB, MB, GB, TB) and binary (KiB, MiB, GiB,
+                 TiB) units are recognised.
+
+    :returns: int number of bytes
+    """
+    if isinstance(max_memory, (int, np.integer)):
+        nbytes = int(max_memory)
+    else:
+        match = re.fullmatch(r"\s*([0-9.eE+]+)\s*([A-Za-z]*)\s*", str(max_memory))
+        if match is None or match.group(2).upper() not in MEMORY_UNITS:
+            raise ValueError(f"Unable to parse memory size {max_memory}")
+        nbytes = int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+    if nbytes <= 0:
+        raise ValueError(f"Memory size must be positive, got {max_memory}")
+    return nbytes
+
+
+def bytes_per_cell(nbins_snow=7, nbins_ice=15, dtype=np.float64,
+                   use_distribution=True, ensemble_size=None, fused=False,
+                   varying_distribution=False):
+    """Returns estimated working memory in bytes needed to evaluate one cell
+
+    :nbins_snow: number of snow depth bins
+    :nbins_ice: number of ice thickness bins
+    :dtype: dtype of input arrays
+    :use_distribution: if False, transmittance is evaluated for the mean
+                       thickness and depth only, so there is one bin
+    :ensemble_size: number of parameter ensemble members, None if parameters
+                    are not an ensemble
+    :fused: True if transmittance is evaluated with beer_lambert_rt.fused
+    :varying_distribution: True if snow distribution parameters vary between
+                           cells, see beer_lambert_rt.distributions.snow_depth_fraction_field
+
+    :returns: int
+    """
+    nbins = nbins_snow * nbins_ice if use_distribution else 1
+    nens = 1 if ensemble_size is None else ensemble_size
+    itemsize = np.dtype(dtype).itemsize
+    temporaries = FUSED_BINNED_TEMPORARIES if fused else BINNED_TEMPORARIES
+    per_cell = nens * (nbins * temporaries * BINNED_ITEMSIZE +
+                       CELL_TEMPORARIES * itemsize)
+    if varying_distribution and use_distribution:
+        per_cell += nbins * VARYING_DISTRIBUTION_TEMPORARIES * BINNED_ITEMSIZE
+    return per_cell
+
+
+def fused_overhead():
+    """Returns memory in bytes of the block temporaries of fused evaluation in
+    all threads"""
+    from beer_lambert_rt.fused import FUSED_BLOCK_SIZE, default_workers
+    return default_workers() * FUSED_BLOCK_SIZE * BINNED_TEMPORARIES * BINNED_ITEMSIZE
+
+
+def plan_execution(shape, max_memory=None, dtype=np.float64,
+                   nbins_snow=7, nbins_ice=15, use_distribution=True,
+                   ensemble_size=None, extra_outputs=0, max_chunk_size=None,
+                   repeats=1, fused=False, varying_distribution=False):
+    """Returns an ExecutionPlan for a grid
+
+    Output arrays for the whole grid and a fixed overhead are counted against
+    the budget, the remainder is available for the working memory of each chunk.
+
+    :shape: shape of model grid
+    :max_memory: memory budget as bytes or a string, e.g. "4GB".  If None,
+                 the grid is evaluated in a single chunk.
+    :dtype: dtype of input arrays
+    :nbins_snow: number of snow depth bins
+    :nbins_ice: number of ice thickness bins
+    :use_distribution: see bytes_per_cell
+    :ensemble_size: see bytes_per_cell
+    :extra_outputs: number of output arrays in addition to flux and par,
+                    e.g. derivatives
+    :max_chunk_size: largest number of cells in a chunk, e.g. to report
+                     progress regularly.  If None, chunks are limited by
+                     max_memory only.
+    :repeats: number of leading cells that share the ice thickness and snow
+              depth of the remaining cells, e.g. the number of time steps for
+              static ice.  Must divide the number of cells.
+    :fused: see bytes_per_cell.  The block temporaries of each thread are
+            counted as fixed overhead.
+    :varying_distribution: see bytes_per_cell
+
+    :returns: ExecutionPlan
+    """
+    shape = tuple(shape)
+    ncell = int(np.prod(shape))
+    repeats = max(int(repeats), 1)
+    if ncell % repeats:
+        raise ValueError(f"repeats must divide the number of cells {ncell}, got {repeats}")
+    per_cell = bytes_per_cell(nbins_snow, nbins_ice, dtype, use_distribution,
+                              ensemble_size, fused, varying_distribution)
+    overhead = CHUNK_OVERHEAD + (fused_overhead() if fused else 0)
+    nens = 1 if ensemble_size is None else ensemble_size
+    noutputs = CELL_OUTPUTS + extra_outputs
+    outputs = nens * ncell * noutputs * OUTPUT_ITEMSIZE
+    # Extra outputs are also held for each chunk before they are copied
+    per_cell += nens * extra_outputs * OUTPUT_ITEMSIZE
+
+    if max_memory is None:
+        chunk_size = max(ncell, 1)
+    else:
+        max_memory = parse_memory(max_memory)
+        chunk_size = (max_memory - outputs - overhead) // per_cell
+        if chunk_size < 1:
+            raise ValueError(f"Memory budget of {max_memory} bytes is too small for a "
+                             f"grid of {ncell} cells, at least "
+                             f"{outputs + overhead + per_cell} bytes are needed")
+        chunk_size = min(chunk_size, max(ncell, 1))
+    if max_chunk_size is not None:
+        chunk_size = max(min(chunk_size, int(max_chunk_size)), 1)
+
+    plan = ExecutionPlan(
+        shape=shape,
+        ncell=ncell,
+        chunk_size=int(chunk_size),
+        nchunks=-(-ncell // chunk_size),
+        max_memory=max_memory,
+        bytes_per_cell=per_cell,
+        estimated_peak=outputs + overhead + chunk_size * per_cell,
+        repeats=repeats,
+        )
+    # Blocks are rounded to whole rows and columns
+    block_rows, block_cols = plan.block_shape()
+    plan.nchunks = -(-repeats // block_rows) * -(-(ncell // repeats) // block_cols)
+    return plan
+
+
+class PeakMemory:
+    """Context manager that records the peak memory traced by tracemalloc
+
+    If tracemalloc is not already running, it is started on entry and stopped
+    on exit.  On exit, the peak allocated above the memory in use on entry is
+    stored in the peak attribute.
+
+    PeakMemory contexts can be nested.  tracemalloc has a single peak, which
+    is reset on entry to each context, so the peak seen by an inner context
+    is passed to the enclosing context on exit.
+
+    :enabled: if False, memory is not tracked and peak is None
+    """
+    _active = []
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.peak = None
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        if PeakMemory._active:
+            outer = PeakMemory._active[-1]
+            outer._traced_peak = max(outer._traced_peak, peak)
+        self._baseline = current
+        self._traced_peak = current
+        tracemalloc.reset_peak()
+        PeakMemory._active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        if not self.enabled:
+            return False
+        PeakMemory._active.remove(self)
+        traced_peak = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+        self.peak = max(traced_peak - self._baseline, 0)
+        if PeakMemory._active:
+            outer = PeakMemory._active[-1]
+            outer._traced_peak = max(outer._traced_peak, traced_peak)
+        if self._started:
+            tracemalloc.stop()
+        return False
@@ -0,0 +1,190 @@
+"""Peak memory tracking for each stage of a model run
+
+Batch schedulers need the memory used by a job to pack jobs onto nodes.
+A MemoryProfiler records the wall time and peak memory of named pipeline
+stages: loading inputs, building the snow depth and ice thickness
+distributions, evaluating transmittance and writing results.
+
+Code marks stages with the stage context manager.  When no profiler is
+active, stage does nothing, so library functions can be marked at no cost.
+
+Two measures of peak memory are recorded for each stage:
+
+- tracemalloc_peak_bytes: the peak memory allocated by Python and numpy
+  during the stage, above the memory in use when the stage started.
+- rss_peak_bytes: the peak resident set size of the process while the
+  stage was running, sampled by a background thread.  RSS includes memory
+  in use before the stage started.  RSS is read with psutil if it is
+  installed, or from /proc on Linux, and is None otherwise.
+
+Stages that run more than once, e.g. once for each chunk of a grid, record
+the number of calls, total time and the largest peak.
+
+Example
+-------
+>>> with MemoryProfiler() as profiler:
+...     with stage("load"):
+...         data = load_data(path)
+...     flux, par = run_model(...)
+>>> profiler.summary()
+"""
+
+from contextlib import nullcontext
+import contextvars
+import os
+import threading
+import time
+
+from beer_lambert_rt.planner import PeakMemory
+
+
+# Stages recorded by the model and CLI, in pipeline order
+PIPELINE_STAGES = ["load", "distribution", "transmittance", "write"]
+
+_active_profiler = contextvars.ContextVar("beer_lambert_rt_profiler", default=None)
+
+
+def current_rss():
+    """Returns the resident set size of the process in bytes, or None if it
+    cannot be read"""
+    try:
+        import psutil
+    except ImportError:
+        pass
+    else:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def stage(name):
+    """Returns a context manager that records a stage with the active
+    MemoryProfiler, or does nothing if no profiler is active"""
+    profiler = _active_profiler.get()
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
+
+
+class StageRecord:
+    """Calls, wall time and peak memory of one stage"""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+        self.tracemalloc_peak = None
+        self.rss_peak = None
+
+    def update_rss(self, rss):
+        if rss is not None:
+            self.rss_peak = rss if self.rss_peak is None else max(self.rss_peak, rss)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "tracemalloc_peak_bytes": self.tracemalloc_peak,
+            "rss_peak_bytes": self.rss_peak,
+            }
+
+
+class MemoryProfiler:
+    """Context manager that records time and peak memory of stages
+
+    :trace: record tracemalloc peaks.  tracemalloc runs for the lifetime of
+            the profiler, which slows allocation heavy code.
+    :sample_rss: sample RSS in a background thread
+    :interval: RSS sampling interval in seconds
+    """
+
+    def __init__(self, trace=True, sample_rss=True, interval=0.01):
+        self.trace = trace
+        self.sample_rss = sample_rss and current_rss() is not None
+        self.interval = interval
+        self.stages = {}
+        self._running = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._token = None
+        self._tracker = None
+
+    def __enter__(self):
+        self._token = _active_profiler.set(self)
+        # Keeps tracemalloc running between stages
+        self._tracker = PeakMemory(enabled=self.trace).__enter__()
+        if self.sample_rss:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True,
+                                             name="blrt-rss-sampler")
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        self._tracker.__exit__(*exc)
+        _active_profiler.reset(self._token)
+        return False
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._record_rss()
+
+    def _record_rss(self):
+        rss = current_rss() if self.sample_rss else None
+        with self._lock:
+            for record in self._running:
+                record.update_rss(rss)
+
+    def stage(self, name):
+        """Returns a context manager that records the named stage"""
+        return _Stage(self, name)
+
+    def summary(self):
+        """Returns a dict of stage name to calls, seconds and peak bytes"""
+        with self._lock:
+            return {name: record.to_dict() for name, record in self.stages.items()}
+
+    def peak_rss(self):
+        """Returns the largest RSS sampled in any stage, or None"""
+        peaks = [record.rss_peak for record in self.stages.values()
+                 if record.rss_peak is not None]
+        return max(peaks) if peaks else None
+
+
+class _Stage:
+    """Records one call of a stage"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        with profiler._lock:
+            self.record = profiler.stages.setdefault(self.name, StageRecord())
+            profiler._running.append(self.record)
+        profiler._record_rss()
+        self._tracker = PeakMemory(enabled=profiler.trace).__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        self._tracker.__exit__(*exc)
+        profiler = self.profiler
+        profiler._record_rss()
+        with profiler._lock:
+            profiler._running.remove(self.record)
+            self.record.calls += 1
+            self.record.seconds += seconds
+            if self._tracker.peak is not None:
+                self.record.tracemalloc_peak = max(self.record.tracemalloc_peak or 0,
+                                                   self._tracker.peak)
+        return False
@@ -0,0 +1,172 @@
+"""Progress and throughput reporting for long model runs
+
+run_model evaluates a grid in chunks (tiles), see beer_lambert_rt.planner.
+A ProgressReporter passed to run_model as progress= is updated after each
+tile and reports cells done, tiles done, throughput in cells per second,
+estimated time remaining and the current time step.  Tiles restored from
+a checkpoint are recorded with skip, so they count as done but not towards
+throughput.
+
+On a terminal, progress is drawn as a single line progress bar.  Otherwise,
+e.g. when stderr is redirected to a log file, each report is written as a
+JSON line so that it can be parsed by monitoring tools:
+
+    {"event": "progress", "cells_done": 65536, "cells_total": 130321, ...}
+
+Reports are emitted at most once every min_interval seconds, plus a final
+report when the run finishes, so reporting cost does not depend on the
+number of tiles.
+"""
+
+import json
+import sys
+import time
+
+import numpy as np
+
+
+# Largest tile evaluated by run_model when progress is reported and no memory
+# budget is given, so that a single grid gives regular updates
+PROGRESS_CHUNK_SIZE = 2**14
+
+# Width of the progress bar in characters
+BAR_WIDTH = 30
+
+
+def format_seconds(seconds):
+    """Returns seconds as H:MM:SS, or ? if unknown"""
+    if seconds is None or not np.isfinite(seconds):
+        return "?"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+class ProgressReporter:
+    """Reports progress of a chunked model run
+
+    :stream: file object to write to.  Defaults to sys.stderr
+    :mode: "bar", "json" or "auto".  auto draws a bar if stream is a terminal
+           and writes JSON lines otherwise
+    :min_interval: minimum time in seconds between reports
+    :time_steps: labels of the leading dimension of the grid, e.g. dates.
+                 If None, the index of the leading dimension is reported.
+    """
+
+    def __init__(self, stream=None, mode="auto", min_interval=1., time_steps=None):
+        self.stream = sys.stderr if stream is None else stream
+        if mode == "auto":
+            isatty = getattr(self.stream, "isatty", lambda: False)
+            mode = "bar" if isatty() else "json"
+        if mode not in ("bar", "json"):
+            raise ValueError(f"Unknown progress mode {mode}, expects bar, json or auto")
+        self.mode = mode
+        self.min_interval = min_interval
+        self.time_steps = None if time_steps is None else list(time_steps)
+        self.shape = ()
+        self.cells_total = 0
+        self.tiles_total = 0
+        self.cells_done = 0
+        self.tiles_done = 0
+        self.cells_skipped = 0
+        self._last_cell = 0
+        self._ncols = 0
+        self._start = None
+        self._last_report = None
+        self._line_width = 0
+
+    def start(self, plan):
+        """Starts timing a run of an ExecutionPlan"""
+        self.shape = tuple(plan.shape)
+        self.cells_total = plan.ncell
+        self.tiles_total = plan.nchunks
+        self._ncols = plan.ncell // plan.repeats
+        self.cells_done = 0
+        self.tiles_done = 0
+        self.cells_skipped = 0
+        self._start = time.perf_counter()
+        self._last_report = self._start
+
+    def update(self, chunk):
+        """Records a finished tile
+
+        :chunk: slice into the flattened grid that was evaluated, or a tuple of
+                (rows, columns) slices from ExecutionPlan.blocks
+        """
+        self._advance(chunk)
+        now = time.perf_counter()
+        if now - self._last_report >= self.min_interval:
+            self._last_report = now
+            self.report(now)
+
+    def skip(self, chunk):
+        """Records a tile that was not evaluated, e.g. restored from a checkpoint.
+        It counts as done but not towards cells per second or the ETA.
+
+        :chunk: see update
+        """
+        self.cells_skipped += self._advance(chunk)
+
+    def _advance(self, chunk):
+        """Moves the done counters past chunk and returns its number of cells"""
+        rows, cols = chunk if isinstance(chunk, tuple) else (slice(0, 1), chunk)
+        ncell = (rows.stop - rows.start) * (cols.stop - cols.start)
+        self.cells_done += ncell
+        self.tiles_done += 1
+        self._last_cell = (rows.stop - 1) * self._ncols + cols.stop - 1
+        return ncell
+
+    def finish(self):
+        """Writes a final report"""
+        self.report(time.perf_counter(), final=True)
+
+    def time_step(self):
+        """Returns the label or index of the leading dimension of the last
+        cell done, or None for grids with fewer than 2 dimensions"""
+        if len(self.shape) < 2 or self.cells_done == 0:
+            return None
+        index = int(np.unravel_index(self._last_cell, self.shape)[0])
+        if self.time_steps is None:
+            return index
+        return str(self.time_steps[index])
+
+    def status(self, now=None):
+        """Returns a dict describing progress"""
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self._start
+        evaluated = self.cells_done - self.cells_skipped
+        rate = evaluated / elapsed if elapsed > 0 and evaluated > 0 else None
+        remaining = self.cells_total - self.cells_done
+        eta = remaining / rate if rate else None
+        return {
+            "cells_done": self.cells_done,
+            "cells_total": self.cells_total,
+            "tiles_done": self.tiles_done,
+            "tiles_total": self.tiles_total,
+            "time_step": self.time_step(),
+            "cells_per_second": rate,
+            "elapsed_seconds": elapsed,
+            "eta_seconds": eta,
+            }
+
+    def report(self, now=None, final=False):
+        """Writes a progress report"""
+        status = self.status(now)
+        if self.mode == "json":
+            event = "finished" if final else "progress"
+            self.stream.write(json.dumps({"event": event, **status}) + "\n")
+        else:
+            fraction = status["cells_done"] / max(status["cells_total"], 1)
+            filled = int(BAR_WIDTH * fraction)
+            rate = status["cells_per_second"] or 0.
+            line = (f"\r[{'#' * filled}{'.' * (BAR_WIDTH - filled)}] {100 * fraction:5.1f}% "
+                    f"{status['tiles_done']}/{status['tiles_total']} tiles "
+                    f"{rate:.3g} cells/s ETA {format_seconds(status['eta_seconds'])}")
+            if status["time_step"] is not None:
+                line += f" time {status['time_step']}"
+            # Pads with spaces to overwrite a longer previous line
+            width = len(line)
+            line = line.ljust(self._line_width)
+            self._line_width = width
+            self.stream.write(line + ("\n" if final else ""))
+        self.stream.flush()
@@ -0,0 +1,134 @@
+"""Vectorized validation of model inputs with per-cell quality flags
+
+The transmittance functions raise ValueError for a whole grid if any ice
+thickness is zero or any snow lies on a pond, and cells with missing or
+unphysical inputs, e.g. surface temperature in Kelvin, give meaningless
+results.  run_model instead classifies every cell of each tile in one
+vectorized pass, replaces the inputs of invalid cells with harmless
+SUBSTITUTE_VALUES so the rest of the tile is evaluated as usual, and sets
+the outputs of invalid cells to NaN.
+
+The classification is a uint8 bitmask, one bit for each of
+QUALITY_FLAG_MEANINGS, following the CF flag_masks convention.  A cell with
+quality 0 is valid.  Each input is checked at its own shape, so inputs that
+are broadcast, e.g. static ice thickness, are checked once and are only
+copied if they have invalid cells.
+
+Example
+-------
+>>> flux, par, extras = run_model(..., diagnostics=["quality"])
+>>> quality_counts(extras["quality"])
+{'valid_cells': 130321, 'missing_input_cells': 120, ...}
+"""
+
+import numpy as np
+
+from beer_lambert_rt.packing import MAX_SW_FLUX
+
+
+# Reasons a cell is invalid, in bit order.  Names follow the CF flag_meanings
+# convention.
+QUALITY_FLAG_MEANINGS = [
+    "missing_input",
+    "out_of_range",
+    "zero_ice_thickness",
+    "snow_on_pond",
+    "no_sea_ice",
+    ]
+QUALITY_FLAG_MASKS = (1 << np.arange(len(QUALITY_FLAG_MEANINGS))).astype(np.uint8)
+MISSING_INPUT, OUT_OF_RANGE, ZERO_ICE_THICKNESS, SNOW_ON_POND, NO_SEA_ICE = (
+    QUALITY_FLAG_MASKS)
+
+# Inputs of calculate_flux_and_par in order
+INPUT_NAMES = [
+    "ice_thickness",
+    "snow_depth",
+    "albedo",
+    "sw_radiation",
+    "skin_temperature",
+    "sea_ice_concentration",
+    "pond_depth",
+    "pond_fraction",
+    ]
+
+# Physically valid range of each input as (valid_min, valid_max), inclusive
+VALID_RANGES = {
+    "ice_thickness": (0., 30.),
+    "snow_depth": (0., 5.),
+    "albedo": (0., 1.),
+    "sw_radiation": (0., MAX_SW_FLUX),
+    "skin_temperature": (-90., 40.),
+    "sea_ice_concentration": (0., 1.),
+    "pond_depth": (0., 5.),
+    "pond_fraction": (0., 1.),
+    }
+
+# Values evaluated in place of the inputs of invalid cells
+SUBSTITUTE_VALUES = {
+    "ice_thickness": 1.,
+    "snow_depth": 0.,
+    "albedo": 0.5,
+    "sw_radiation": 0.,
+    "skin_temperature": -10.,
+    "sea_ice_concentration": 1.,
+    "pond_depth": 0.,
+    "pond_fraction": 0.,
+    }
+
+
+def input_flags(name, arr):
+    """Returns quality flags of one input with the shape of arr"""
+    valid_min, valid_max = VALID_RANGES[name]
+    flags = np.where(np.isnan(arr), MISSING_INPUT, np.uint8(0))
+    flags[(arr < valid_min) | (arr > valid_max)] |= OUT_OF_RANGE
+    if name == "ice_thickness":
+        flags[arr == 0.] |= ZERO_ICE_THICKNESS
+    elif name == "sea_ice_concentration":
+        flags[arr == 0.] |= NO_SEA_ICE
+    return flags
+
+
+def validate(inputs):
+    """Classifies each cell of a tile of inputs
+
+    :inputs: list of arrays that broadcast against each other, in the order
+             of INPUT_NAMES
+
+    :returns: quality flags with the broadcast shape of inputs, and inputs
+              with invalid values replaced by SUBSTITUTE_VALUES.  Inputs
+              without invalid values are returned unchanged.
+    """
+    quality = np.zeros(np.broadcast_shapes(*[np.shape(arr) for arr in inputs]),
+                       dtype=np.uint8)
+    cleaned = []
+    for name, arr in zip(INPUT_NAMES, inputs):
+        flags = input_flags(name, arr)
+        if flags.any():
+            quality |= flags
+            arr = np.where(flags > 0, SUBSTITUTE_VALUES[name], arr)
+        cleaned.append(arr)
+
+    # The model does not allow ponds on snow
+    snow, pond = INPUT_NAMES.index("snow_depth"), INPUT_NAMES.index("pond_depth")
+    conflict = (inputs[snow] > 0.) & (inputs[pond] > 0.)
+    if conflict.any():
+        quality |= np.where(conflict, SNOW_ON_POND, np.uint8(0))
+        cleaned[pond] = np.where(conflict, 0., cleaned[pond])
+    return quality, cleaned
+
+
+def quality_counts(quality):
+    """Returns the number of valid cells and of cells with each quality flag
+
+    A cell with several flags is counted for each of them.
+
+    :quality: uint8 quality flags from validate
+    :returns: dict of counts keyed by valid_cells and <flag>_cells
+    """
+    values = np.bincount(np.asarray(quality, dtype=np.uint8).reshape(-1),
+                         minlength=256)
+    flagged = np.arange(values.size)
+    counts = {"valid_cells": int(values[0])}
+    for meaning, mask in zip(QUALITY_FLAG_MEANINGS, QUALITY_FLAG_MASKS):
+        counts[f"{meaning}_cells"] = int(values[(flagged & mask) > 0].sum())
+    return counts
@@ -0,0 +1,347 @@
+"""Persistent model server with micro-batching
+
+A long-running server keeps the model, distribution tables and parameters
+loaded, so that clients that call the model many times for single points or
+small regions do not pay Python startup and import costs on every call.
+
+Requests are JSON objects with the run_model inputs as numbers or (nested)
+lists of numbers, e.g.
+
+    {"ice_thickness": [1.5, 1.0], "snow_depth": [0.3, 0.2], "albedo": [0.8, 0.8],
+     "sw_radiation": [100., 90.], "skin_temperature": [-5., -2.],
+     "sea_ice_concentration": [1., 0.9]}
+
+Scalars are broadcast to the shape of the array inputs.  The response is a
+JSON object with "sw_flux" and "par" lists of the same shape.  Cells with
+invalid inputs are masked, see beer_lambert_rt.quality, and returned as null.
+
+Concurrent requests are coalesced by a MicroBatcher: the first request in a
+batch waits at most max_latency seconds for other requests to arrive, then
+all inputs are concatenated and evaluated with a single call to run_model.
+
+Endpoints
+---------
+POST /run      run the model for the inputs in the request body
+GET  /metrics  request latency and batch size metrics
+GET  /health   returns {"status": "ok"}
+
+The server listens on a localhost TCP port or on a Unix socket, see serve.
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+from beer_lambert_rt.model import run_model
+
+
+INPUT_VARIABLES = [
+    "ice_thickness",
+    "snow_depth",
+    "albedo",
+    "sw_radiation",
+    "skin_temperature",
+    "sea_ice_concentration",
+    ]
+
+# Number of recent requests and batches kept to calculate metrics
+METRICS_WINDOW = 10000
+
+
+class ServerMetrics:
+    """Thread-safe record of request latencies and batch sizes"""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.server_errors = 0
+        self.batches = 0
+        self.cells = 0
+        self._latency = deque(maxlen=window)
+        self._batch_requests = deque(maxlen=window)
+        self._batch_cells = deque(maxlen=window)
+
+    def record_request(self, latency, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            self._latency.append(latency)
+
+    def record_server_error(self):
+        """Records a request that failed with an unexpected exception"""
+        with self._lock:
+            self.server_errors += 1
+
+    def record_batch(self, nrequests, ncells):
+        with self._lock:
+            self.batches += 1
+            self.cells += ncells
+            self._batch_requests.append(nrequests)
+            self._batch_cells.append(ncells)
+
+    def summary(self):
+        """Returns a dict of metrics.  Latencies are in seconds and statistics
+        are calculated over the most recent requests and batches."""
+        with self._lock:
+            latency = np.array(self._latency)
+            batch_requests = np.array(self._batch_requests)
+            batch_cells = np.array(self._batch_cells)
+            counts = {
+                "uptime": time.time() - self.started,
+                "requests": self.requests,
+                "errors": self.errors,
+                "server_errors": self.server_errors,
+                "batches": self.batches,
+                "cells": self.cells,
+                }
+
+        def stats(x, percentiles=()):
+            if x.size == 0:
+                return None
+            result = {"mean": float(x.mean()), "max": float(x.max())}
+            for p in percentiles:
+                result[f"p{p}"] = float(np.percentile(x, p))
+            return result
+
+        return {
+            **counts,
+            "latency": stats(latency, percentiles=(50, 95, 99)),
+            "batch_requests": stats(batch_requests),
+            "batch_cells": stats(batch_cells),
+            }
+
+
+class MicroBatcher:
+    """Coalesces concurrent model requests into batched run_model calls
+
+    :max_latency: maximum time in seconds a request waits for other requests
+                  to join its batch
+    :max_batch_cells: a batch is evaluated as soon as it holds this many cells
+    :metrics: ServerMetrics, a new instance is created if None
+    :run_kwargs: keywords passed to run_model for every batch, e.g.
+                 use_distribution, parameters or max_memory
+    """
+
+    def __init__(self, max_latency=0.005, max_batch_cells=100000, metrics=None,
+                 **run_kwargs):
+        self.max_latency = max_latency
+        self.max_batch_cells = max_batch_cells
+        self.metrics = ServerMetrics() if metrics is None else metrics
+        self.run_kwargs = run_kwargs
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True,
+                                        name="blrt-microbatcher")
+        self._running = False
+
+    def start(self):
+        """Starts the batching thread and warms caches with a single cell run"""
+        run_model(1.5, 0.3, 0.8, 100., -5., 1., **self.run_kwargs)
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the batching thread after pending requests are evaluated"""
+        if self._running:
+            self._running = False
+            self._queue.put(None)
+            self._thread.join()
+
+    def submit(self, inputs):
+        """Queues a request and returns a concurrent.futures.Future
+
+        :inputs: dict of run_model inputs, see INPUT_VARIABLES
+
+        :returns: Future whose result is a (flux, par) tuple of arrays
+        """
+        future = Future()
+        try:
+            arrays = np.broadcast_arrays(*[np.asarray(inputs[name], dtype=np.float64)
+                                           for name in INPUT_VARIABLES])
+        except KeyError as err:
+            future.set_exception(KeyError(f"Request is missing input {err}"))
+            return future
+        except ValueError as err:
+            future.set_exception(err)
+            return future
+        self._queue.put((time.perf_counter(), arrays, future))
+        return future
+
+    def run(self, inputs, timeout=None):
+        """Submits a request and waits for the result"""
+        return self.submit(inputs).result(timeout)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            ncells = item[1][0].size
+            deadline = item[0] + self.max_latency
+            while ncells < self.max_batch_cells:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                ncells += item[1][0].size
+            self._evaluate(batch, ncells)
+
+    def _evaluate(self, batch, ncells):
+        try:
+            inputs = [np.concatenate([arrays[i].reshape(-1) for _, arrays, _ in batch])
+                      for i in range(len(INPUT_VARIABLES))]
+            flux, par = run_model(*inputs, **self.run_kwargs)
+        except Exception as err:
+            if len(batch) > 1:
+                # Evaluate requests separately so that one bad request does not
+                # fail the others
+                for item in batch:
+                    self._evaluate([item], item[1][0].size)
+                return
+            submitted, arrays, future = batch[0]
+            future.set_exception(err)
+            self.metrics.record_request(time.perf_counter() - submitted, error=True)
+            return
+        self.metrics.record_batch(len(batch), ncells)
+
+        start = 0
+        for submitted, arrays, future in batch:
+            shape = arrays[0].shape
+            stop = start + arrays[0].size
+            future.set_result((flux[..., start:stop].reshape(flux.shape[:-1] + shape),
+                               par[..., start:stop].reshape(par.shape[:-1] + shape)))
+            self.metrics.record_request(time.perf_counter() - submitted)
+            start = stop
+
+
+def to_json_list(arr):
+    """Returns arr as nested lists with NaN, i.e. masked cells, as None"""
+    return np.where(np.isnan(arr), None, arr).tolist()
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    """Handles model requests.  The server must have a batcher attribute."""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.server.batcher.metrics.summary())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/run":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            inputs = json.loads(self.rfile.read(length))
+            flux, par = self.server.batcher.run(inputs)
+        except (KeyError, ValueError, TypeError) as err:
+            self._send_json(400, {"error": str(err)})
+            return
+        except Exception as err:
+            # e.g. MemoryError from run_model.  The client gets a response
+            # instead of a dropped connection.
+            self.server.batcher.metrics.record_server_error()
+            self._send_json(500, {"error": f"{type(err).__name__}: {err}"})
+            return
+        self._send_json(200, {"sw_flux": to_json_list(flux), "par": to_json_list(par)})
+
+    def _send_json(self, status, content):
+        # NaN is not valid JSON, so raises rather than sending it
+        body = json.dumps(content, allow_nan=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ModelHTTPServer(ThreadingHTTPServer):
+    """HTTP server on a TCP port that evaluates requests with a MicroBatcher"""
+    daemon_threads = True
+
+    def __init__(self, address, batcher, verbose=False):
+        super().__init__(address, ModelRequestHandler)
+        self.batcher = batcher
+        self.verbose = verbose
+
+
+class ModelUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket that evaluates requests with a MicroBatcher"""
+    daemon_threads = True
+
+    def __init__(self, path, batcher, verbose=False):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, ModelRequestHandler)
+        self.batcher = batcher
+        self.verbose = verbose
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(host="127.0.0.1", port=8750, socket_path=None,
+                max_latency=0.005, max_batch_cells=100000, verbose=False,
+                **run_kwargs):
+    """Returns a started MicroBatcher wrapped in an HTTP server
+
+    :host: address to listen on.  Defaults to localhost
+    :port: TCP port, 0 selects a free port
+    :socket_path: path of a Unix socket to listen on instead of a TCP port
+    :max_latency: see MicroBatcher
+    :max_batch_cells: see MicroBatcher
+    :verbose: log each request to stderr
+    :run_kwargs: keywords passed to run_model
+
+    :returns: ModelHTTPServer or ModelUnixHTTPServer.  Call serve_forever()
+              to handle requests, and shutdown() then batcher.stop() to stop.
+    """
+    batcher = MicroBatcher(max_latency=max_latency, max_batch_cells=max_batch_cells,
+                           **run_kwargs).start()
+    if socket_path is not None:
+        return ModelUnixHTTPServer(socket_path, batcher, verbose=verbose)
+    return ModelHTTPServer((host, port), batcher, verbose=verbose)
+
+
+def serve(**kwargs):
+    """Runs a model server until interrupted.  See make_server for keywords"""
+    server = make_server(**kwargs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.stop()
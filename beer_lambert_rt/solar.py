@@ -0,0 +1,237 @@
+"""Solar geometry, sub-daily forcing and daily PAR dose
+
+APP-x shortwave radiation is a daily field: either a daily mean or a
+snapshot at a fixed local solar time, e.g. 14:00 for the 1400 product.
+Light budgets, e.g. of under-ice phytoplankton, need the diurnal cycle.  The
+functions here compute the cosine of the solar zenith angle for all
+(time, cell) pairs in one vectorized pass, spread daily shortwave radiation
+over sub-daily steps in proportion to it, run the model on the sub-daily
+stack, and integrate PAR back to a daily dose.
+
+Solar declination and the equation of time use the Fourier series of
+Spencer (1971), accurate to about 0.05 degrees, which is ample for hourly
+steps.  Times are UTC.
+
+Snow and ice fields are constant over a day, so run_model builds the snow
+depth and ice thickness distribution of each cell once and shares it across
+sub-daily steps.  The grid is processed in blocks of cells so that the
+sub-daily arrays and model working memory stay within max_memory.
+
+Example
+-------
+>>> flux, dose = daily_par_dose(dates, lat, lon, ice_thickness, snow_depth, albedo,
+...                             sw_radiation, surface_temperature,
+...                             sea_ice_concentration, max_memory="2GB")
+"""
+
+import numpy as np
+
+from beer_lambert_rt.planner import parse_memory
+
+
+# Number of sub-daily steps
+STEPS_PER_DAY = 24
+
+SECONDS_PER_DAY = 86400.
+
+# Number of (step x cell) float64 arrays held for a block of cells while the
+# model runs: cos zenith, sub-daily shortwave, flux and par
+SUBDAILY_ARRAYS = 4
+
+
+def solar_position(time):
+    """Returns solar declination in radians and the equation of time in
+    minutes, after Spencer (1971)
+
+    :time: datetime64 array-like, UTC
+    """
+    time = np.asarray(time, dtype="datetime64[s]")
+    year = time.astype("datetime64[Y]")
+    year_start = year.astype("datetime64[D]")
+    days = (time - year_start) / np.timedelta64(1, "D")
+    days_in_year = ((year + 1).astype("datetime64[D]") - year_start) / np.timedelta64(1, "D")
+    gamma = 2. * np.pi * days / days_in_year
+    declination = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma)
+                   - 0.006758 * np.cos(2. * gamma) + 0.000907 * np.sin(2. * gamma)
+                   - 0.002697 * np.cos(3. * gamma) + 0.00148 * np.sin(3. * gamma))
+    equation_of_time = 229.18 * (0.000075 + 0.001868 * np.cos(gamma)
+                                 - 0.032077 * np.sin(gamma)
+                                 - 0.014615 * np.cos(2. * gamma)
+                                 - 0.040849 * np.sin(2. * gamma))
+    return declination, equation_of_time
+
+
+def cos_zenith(time, lat, lon):
+    """Returns the cosine of the solar zenith angle, negative when the sun is
+    below the horizon
+
+    :time: datetime64 array-like, UTC
+    :lat: latitude in degrees north
+    :lon: longitude in degrees east, with the same shape as lat
+
+    :returns: array of shape time.shape + lat.shape
+    """
+    time = np.asarray(time, dtype="datetime64[s]")
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    declination, equation_of_time = solar_position(time)
+    minutes = (time - time.astype("datetime64[D]")) / np.timedelta64(1, "m")
+    # Appends axes for the grid to the time arrays
+    expand = (...,) + (np.newaxis,) * lat.ndim
+    solar_minutes = minutes[expand] + equation_of_time[expand] + 4. * lon
+    hour_angle = np.radians(solar_minutes / 4. - 180.)
+    phi = np.radians(lat)
+    declination = declination[expand]
+    return (np.sin(phi) * np.sin(declination) +
+            np.cos(phi) * np.cos(declination) * np.cos(hour_angle))
+
+
+def subdaily_times(dates, nsteps=STEPS_PER_DAY):
+    """Returns the UTC midpoints of nsteps equal steps of each date
+
+    :dates: datetime64 array-like of dates
+    :returns: datetime64[s] array of shape dates.shape + (nsteps,)
+    """
+    dates = np.asarray(dates, dtype="datetime64[D]").astype("datetime64[s]")
+    step = SECONDS_PER_DAY / nsteps
+    offsets = ((np.arange(nsteps) + 0.5) * step).astype("timedelta64[s]")
+    return dates[..., np.newaxis] + offsets
+
+
+def daily_mean_sw(sw_radiation, date, lat, observed_hour):
+    """Converts shortwave radiation observed at a local solar hour to a daily
+    mean, assuming it is proportional to the cosine of the solar zenith angle
+
+    Cells where the sun is below the horizon at observed_hour are NaN, unless
+    the sun does not rise, e.g. in polar night, when they are 0.
+
+    :sw_radiation: shortwave radiation at observed_hour, with the shape of lat
+    :date: datetime64 date
+    :lat: latitude in degrees north
+    :observed_hour: local solar time of the observation in hours
+    """
+    declination, _ = solar_position(np.datetime64(date, "D") + np.timedelta64(12, "h"))
+    phi = np.radians(np.asarray(lat, dtype=np.float64))
+    sin_term = np.sin(phi) * np.sin(declination)
+    cos_term = np.cos(phi) * np.cos(declination)
+    observed = sin_term + cos_term * np.cos(np.radians(15. * (observed_hour - 12.)))
+    # Daily mean of max(cos zenith, 0) from the sunset hour angle
+    sunset = np.arccos(np.clip(-sin_term / np.where(cos_term > 0., cos_term, 1.), -1., 1.))
+    daily_mean = (sunset * sin_term + cos_term * np.sin(sunset)) / np.pi
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(observed > 0., daily_mean / observed, np.nan)
+    ratio = np.where(daily_mean > 0., ratio, 0.)
+    return np.asarray(sw_radiation, dtype=np.float64) * ratio
+
+
+def subdaily_sw(sw_radiation, cosz):
+    """Spreads daily mean shortwave radiation over sub-daily steps in
+    proportion to the cosine of the solar zenith angle
+
+    The mean over steps equals the daily mean.  Steps with the sun below the
+    horizon, and days when the sun does not rise, have no shortwave radiation.
+
+    :sw_radiation: daily mean shortwave radiation, shape (ncell,)
+    :cosz: cosine of the solar zenith angle, shape (nsteps, ncell).  It is
+           overwritten with the sub-daily shortwave radiation.
+
+    :returns: cosz
+    """
+    np.clip(cosz, 0., None, out=cosz)
+    mean = cosz.mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(mean > 0., sw_radiation / mean, 0.)
+    cosz *= scale
+    return cosz
+
+
+def block_size(ncell, nsteps, max_memory=None):
+    """Returns the number of cells in a block whose sub-daily arrays take at
+    most half of max_memory, leaving the rest for model working memory"""
+    if max_memory is None:
+        return max(ncell, 1)
+    per_cell = SUBDAILY_ARRAYS * nsteps * np.dtype(np.float64).itemsize
+    size = parse_memory(max_memory) // 2 // per_cell
+    if size < 1:
+        raise ValueError(f"Memory budget of {max_memory} is too small for {nsteps} "
+                         "sub-daily steps")
+    return int(min(size, max(ncell, 1)))
+
+
+def daily_par_dose(dates, lat, lon, ice_thickness, snow_depth, albedo, sw_radiation,
+                   surface_temperature, sea_ice_concentration, nsteps=STEPS_PER_DAY,
+                   observed_hour=None, max_memory=None, use_distribution=True,
+                   parameters=None):
+    """Runs the model at sub-daily steps and returns daily mean under-ice flux
+    and daily PAR dose
+
+    Inputs are daily fields that broadcast to (ndays,) + lat.shape.  For each
+    day and block of cells, shortwave radiation is spread over nsteps steps,
+    the model is run on the (nsteps, cells) stack in one call, and PAR is
+    integrated over the day.
+
+    :dates: datetime64 array-like of ndays dates
+    :lat, lon: latitude and longitude of grid cells in degrees
+    :ice_thickness, ...: daily model inputs, see model.run_model.
+                         sw_radiation is a daily mean, unless observed_hour
+                         is given.
+    :nsteps: number of sub-daily steps
+    :observed_hour: if given, sw_radiation is observed at this local solar
+                    time in hours, e.g. 14. for APP-x 1400, and is converted
+                    to a daily mean with daily_mean_sw
+    :max_memory: memory budget for sub-daily arrays and model evaluation,
+                 as bytes or a string, e.g. "2GB"
+    :use_distribution, parameters: see model.run_model
+
+    :returns: daily mean flux and daily PAR dose, with shape (ndays,) +
+              lat.shape, after any leading ensemble dimension.  The dose is
+              PAR integrated over seconds, e.g. mol m-2 for PAR in
+              mol m-2 s-1.
+    """
+    from beer_lambert_rt.model import run_model
+
+    dates = np.asarray(dates, dtype="datetime64[D]").reshape(-1)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if lat.shape != lon.shape:
+        raise ValueError(f"lat and lon must have the same shape, got {lat.shape} "
+                         f"and {lon.shape}")
+    shape = (dates.size,) + lat.shape
+    ncell = lat.size
+    # Views of each input as (ndays, ncell) without copies
+    inputs = [np.broadcast_to(np.asarray(arr, dtype=np.float64), shape).reshape(dates.size, ncell)
+              for arr in [ice_thickness, snow_depth, albedo, sw_radiation,
+                          surface_temperature, sea_ice_concentration]]
+    lat = lat.reshape(-1)
+    lon = lon.reshape(-1)
+
+    times = subdaily_times(dates, nsteps)
+    step_seconds = SECONDS_PER_DAY / nsteps
+    nens = 1 if parameters is None or parameters.ensemble_size is None else parameters.ensemble_size
+    model_memory = None
+    if max_memory is not None:
+        # Daily flux and dose of the whole grid are held for the whole run
+        max_memory = parse_memory(max_memory) - 2 * nens * dates.size * ncell * 8
+    size = block_size(ncell, nsteps * nens, max_memory)
+    if max_memory is not None:
+        model_memory = max_memory - SUBDAILY_ARRAYS // 2 * nsteps * size * 8
+
+    flux_mean = None
+    for day in range(dates.size):
+        for start in range(0, ncell, size):
+            cells = slice(start, min(start + size, ncell))
+            ice, snow, alb, sw, temp, sic = [arr[day, cells] for arr in inputs]
+            if observed_hour is not None:
+                sw = daily_mean_sw(sw, dates[day], lat[cells], observed_hour)
+            hourly_sw = subdaily_sw(sw, cos_zenith(times[day], lat[cells], lon[cells]))
+            flux, par = run_model(ice, snow, alb, hourly_sw, temp, sic,
+                                  use_distribution=use_distribution,
+                                  max_memory=model_memory, parameters=parameters)
+            if flux_mean is None:
+                ensemble_shape = flux.shape[:-2]
+                flux_mean = np.empty(ensemble_shape + (dates.size, ncell))
+                dose = np.empty(ensemble_shape + (dates.size, ncell))
+            flux_mean[..., day, cells] = flux.mean(axis=-2)
+            dose[..., day, cells] = par.sum(axis=-2) * step_seconds
+    return (flux_mean.reshape(ensemble_shape + shape),
+            dose.reshape(ensemble_shape + shape))
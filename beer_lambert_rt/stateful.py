@@ -0,0 +1,320 @@
+"""Stateful model for repeated calls on the same grid
+
+Coupled models and time loops call run_model once per time step with
+arrays of the same shape.  Each call converts its inputs, builds the snow
+depth and ice thickness distributions, plans its chunks and allocates every
+intermediate and output array.
+
+A Model is constructed once with the grid shape, model options and
+parameters.  It holds the bin weights of the distributions and preallocated
+work buffers, and its step method copies inputs into the buffers and
+evaluates the model with in-place NumPy operations, writing flux and PAR
+into caller-provided arrays.  After the first step, steps do not allocate
+any arrays.
+
+Results match run_model to within floating point rounding.  Invalid cells
+are masked as in run_model, see beer_lambert_rt.quality: their flux and PAR
+are NaN.  Ponds are not included in the model yet, so pond depth is zero.
+
+Example
+-------
+>>> model = Model((361, 361), max_memory="256MB")
+>>> flux, par = np.empty((361, 361)), np.empty((361, 361))
+>>> for inputs in forcing:
+...     model.step(inputs, out=(flux, par))
+"""
+
+import numpy as np
+
+from beer_lambert_rt.distributions import (ice_thickness_distribution,
+                                           snow_depth_distribution)
+from beer_lambert_rt.parameters import default_parameters
+from beer_lambert_rt.planner import parse_memory
+from beer_lambert_rt.quality import (INPUT_NAMES, VALID_RANGES, SUBSTITUTE_VALUES,
+                                     MISSING_INPUT, OUT_OF_RANGE, ZERO_ICE_THICKNESS,
+                                     NO_SEA_ICE)
+from beer_lambert_rt.tables import MODEL_INPUTS
+from beer_lambert_rt.transmission import transmission_open_water
+
+
+# Number of (cell x bin) float64 and bool work buffers
+WORKSPACE_BINNED_FLOATS = 5
+WORKSPACE_BINNED_MASKS = 2
+
+# Number of per-cell float64 work buffers: the six inputs, transmittance and
+# four terms of flux and PAR.  Each cell also has a uint8 quality flag and
+# two bool masks.
+WORKSPACE_CELL_FLOATS = 11
+WORKSPACE_CELL_MASKS = 3
+
+
+def workspace_bytes_per_cell(nbins):
+    """Returns the work buffer memory for each cell of a chunk"""
+    return (nbins * (WORKSPACE_BINNED_FLOATS * 8 + WORKSPACE_BINNED_MASKS) +
+            WORKSPACE_CELL_FLOATS * 8 + WORKSPACE_CELL_MASKS)
+
+
+class Model:
+    """Beer-Lambert model with preallocated work buffers for a fixed grid
+
+    :shape: shape of the model grid
+    :use_distribution: use ice thickness and snow depth distributions, as
+                       run_model
+    :nsnow_class: number of snow classes in the snow depth distribution
+    :max_snow_factor: maximum snow depth of the distribution as a factor of
+                      snow depth
+    :parameters: scalar beer_lambert_rt.parameters.Parameters.  Use
+                 run_model for parameter ensembles.
+    :max_memory: memory budget for the work buffers as bytes or a string,
+                 e.g. "256MB".  The grid is evaluated in chunks of rows along
+                 its first axis, and a ValueError is raised if a single row
+                 does not fit.  Default=None evaluates the whole grid in
+                 one pass.
+    """
+
+    def __init__(self, shape, use_distribution=True, nsnow_class=7,
+                 max_snow_factor=3., parameters=None, max_memory=None):
+        self.shape = (int(shape),) if np.isscalar(shape) else tuple(int(n) for n in shape)
+        self.params = default_parameters if parameters is None else parameters
+        if self.params.ensemble_size is not None:
+            raise ValueError("Model does not support parameter ensembles, use run_model")
+        self.use_distribution = use_distribution
+
+        # Distributions scale with the mean, so bin centers are factors of
+        # the mean and weights do not depend on the cell
+        if use_distribution:
+            ice_factor, ice_prob = ice_thickness_distribution(1.)
+            snow_factor, snow_prob = snow_depth_distribution(1., nbins=int(nsnow_class),
+                                                             factor=max_snow_factor)
+        else:
+            ice_factor = ice_prob = snow_factor = snow_prob = np.ones(1)
+        # Bins are flattened as in snow_ice_distribution.  Factors are (1, nbins)
+        # so that bins of a chunk are the matrix product with the (ncell, 1)
+        # means, which unlike a broadcast multiply does not allocate buffers.
+        shape = (np.size(snow_prob), np.size(ice_prob))
+        self.ice_factor = np.broadcast_to(ice_factor, shape).reshape(1, -1).astype(np.float64)
+        self.snow_factor = np.broadcast_to(np.reshape(snow_factor, (-1, 1)),
+                                           shape).reshape(1, -1).astype(np.float64)
+        self.weights = np.outer(snow_prob, ice_prob).reshape(-1)
+        self.nbins = self.weights.size
+
+        # The grid is viewed as (rows, ...) and chunked along rows
+        self._grid = self.shape or (1,)
+        row_cells = int(np.prod(self._grid[1:]))
+        chunk_rows = self._grid[0]
+        if max_memory is not None:
+            max_memory = parse_memory(max_memory)
+            row_bytes = row_cells * workspace_bytes_per_cell(self.nbins)
+            if max_memory < row_bytes:
+                raise ValueError(f"Memory budget of {max_memory} bytes is too small for a "
+                                 f"row of {row_cells} cells, at least {row_bytes} bytes "
+                                 "are needed")
+            chunk_rows = min(max_memory // row_bytes, chunk_rows)
+        self.chunk_rows = int(chunk_rows)
+        ncell = self.chunk_rows * row_cells
+        binned = (ncell, self.nbins)
+        self._binned = np.empty((WORKSPACE_BINNED_FLOATS,) + binned)
+        self._binned_masks = np.empty((WORKSPACE_BINNED_MASKS,) + binned, dtype=bool)
+        self._cell = np.empty((WORKSPACE_CELL_FLOATS, ncell))
+        self._quality = np.empty(ncell, dtype=np.uint8)
+        self._cell_masks = np.empty((WORKSPACE_CELL_MASKS - 1, ncell), dtype=bool)
+        self._views = {}
+
+    @property
+    def nbytes(self):
+        """Size of the work buffers in bytes"""
+        return sum(arr.nbytes for arr in [self._binned, self._binned_masks, self._cell,
+                                          self._quality, self._cell_masks])
+
+    def workspace(self, nrows):
+        """Returns views of the work buffers for a chunk of nrows rows,
+        created on first use"""
+        if nrows not in self._views:
+            ncell = nrows * int(np.prod(self._grid[1:]))
+            cell = self._cell[:, :ncell]
+            self._views[nrows] = {
+                "inputs": [arr.reshape((nrows,) + self._grid[1:]) for arr in cell[:6]],
+                "cell": cell,
+                "binned": self._binned[:, :ncell],
+                "binned_masks": self._binned_masks[:, :ncell],
+                "quality": self._quality[:ncell],
+                "cell_masks": self._cell_masks[:, :ncell],
+                }
+        return self._views[nrows]
+
+    def step(self, inputs, out=None):
+        """Evaluates flux and PAR for one set of inputs
+
+        :inputs: dict of arrays keyed by beer_lambert_rt.tables.MODEL_INPUTS,
+                 or a sequence of arrays in that order.  Inputs are scalars or
+                 arrays that broadcast to the grid shape.
+        :out: tuple of C-contiguous float64 flux and PAR arrays with the grid
+              shape, written in place.  New arrays are allocated if None.
+
+        :returns: flux, par
+        """
+        if isinstance(inputs, dict):
+            missing = [name for name in MODEL_INPUTS if name not in inputs]
+            if missing:
+                raise ValueError(f"Missing model inputs {', '.join(missing)}")
+            inputs = [inputs[name] for name in MODEL_INPUTS]
+        if len(inputs) != len(MODEL_INPUTS):
+            raise ValueError(f"Expects {len(MODEL_INPUTS)} inputs, got {len(inputs)}")
+        try:
+            inputs = [np.broadcast_to(arr, self.shape).reshape(self._grid) for arr in inputs]
+        except ValueError:
+            raise ValueError("One or more inputs do not broadcast to the model grid "
+                             f"{self.shape}") from None
+
+        if out is None:
+            out = (np.empty(self.shape), np.empty(self.shape))
+        for arr in out:
+            if (not isinstance(arr, np.ndarray) or arr.shape != self.shape or
+                    arr.dtype != np.float64 or not arr.flags.c_contiguous):
+                raise ValueError("Outputs must be C-contiguous float64 arrays with "
+                                 f"shape {self.shape}")
+        flux, par = [arr.reshape(self._grid) for arr in out]
+
+        for start in range(0, self._grid[0], self.chunk_rows):
+            rows = slice(start, min(start + self.chunk_rows, self._grid[0]))
+            ws = self.workspace(rows.stop - rows.start)
+            for buffer, arr in zip(ws["inputs"], inputs):
+                np.copyto(buffer, arr[rows])
+            self._validate(ws)
+            self._transmittance(ws)
+            self._flux_and_par(ws, flux[rows].reshape(-1), par[rows].reshape(-1))
+        return out
+
+    def _validate(self, ws):
+        """Sets quality flags of a chunk, as beer_lambert_rt.quality.validate,
+        and substitutes the inputs of invalid cells in place"""
+        quality = ws["quality"]
+        mask, invalid = ws["cell_masks"]
+        quality.fill(0)
+        for name, arr in zip(INPUT_NAMES, ws["cell"][:6]):
+            valid_min, valid_max = VALID_RANGES[name]
+            np.isnan(arr, out=mask)
+            np.bitwise_or(quality, MISSING_INPUT, out=quality, where=mask)
+            np.less(arr, valid_min, out=mask)
+            np.bitwise_or(quality, OUT_OF_RANGE, out=quality, where=mask)
+            np.greater(arr, valid_max, out=mask)
+            np.bitwise_or(quality, OUT_OF_RANGE, out=quality, where=mask)
+            if name in ["ice_thickness", "sea_ice_concentration"]:
+                np.equal(arr, 0., out=mask)
+                np.bitwise_or(quality,
+                              ZERO_ICE_THICKNESS if name == "ice_thickness" else NO_SEA_ICE,
+                              out=quality, where=mask)
+        np.greater(quality, 0, out=invalid)
+        for name, arr in zip(INPUT_NAMES, ws["cell"][:6]):
+            np.copyto(arr, SUBSTITUTE_VALUES[name], where=invalid)
+
+    def _transmittance(self, ws):
+        """Evaluates the transmittance of each cell of a chunk into the
+        transmittance buffer, as beer_lambert_rt.transmission.get_transmittance
+        with zero pond depth"""
+        p = self.params
+        hice, hsnow, _, _, tsurf, _, transmittance = ws["cell"][:7]
+        hice_bins, hsnow_bins, i0, hssl, k = ws["binned"]
+        m1, m2 = ws["binned_masks"]
+        # Surface temperature is the same in all bins of a cell, so its
+        # conditions are evaluated per cell and copied across bins
+        mask = ws["cell_masks"][0][:, np.newaxis]
+        np.matmul(hice[:, np.newaxis], self.ice_factor, out=hice_bins)
+        np.matmul(hsnow[:, np.newaxis], self.snow_factor, out=hsnow_bins)
+
+        # Surface transmission, as select_surface_transmission
+        i0.fill(np.nan)
+        np.equal(hsnow_bins, 0., out=m1)
+        np.greater_equal(hice_bins, 0.5, out=m2)
+        np.logical_and(m1, m2, out=m2)
+        np.copyto(i0, p.i0_ice, where=m2)
+        np.less(hice_bins, 0.5, out=m2)
+        np.logical_and(m1, m2, out=m2)
+        np.copyto(i0, 1., where=m2)
+        np.greater(hsnow_bins, 0., out=m1)
+        np.less(tsurf, 0., out=mask[:, 0])
+        np.copyto(m2, mask)
+        np.logical_and(m1, m2, out=m2)
+        np.copyto(i0, p.i0_dry_snow, where=m2)
+        np.greater_equal(tsurf, 0., out=mask[:, 0])
+        np.copyto(m2, mask)
+        np.logical_and(m1, m2, out=m2)
+        np.copyto(i0, p.i0_wet_snow, where=m2)
+
+        # Snow attenuation, as green_edge_hssl_snow and select_attenuation_snow
+        hssl.fill(0.)
+        k.fill(0.)
+        np.less(tsurf, 0., out=mask[:, 0])
+        np.copyto(m2, mask)
+        np.logical_and(m1, m2, out=m2)
+        np.copyto(hssl, p.hssl_dry_snow, where=m2)
+        np.copyto(k, p.k_dry_snow, where=m2)
+        np.greater_equal(tsurf, 0., out=mask[:, 0])
+        np.copyto(m2, mask)
+        np.greater(hsnow_bins, p.hssl_wet_snow, out=m1)
+        np.logical_and(m1, m2, out=m1)
+        np.copyto(hssl, p.hssl_wet_snow, where=m1)
+        np.copyto(k, p.k_wet_snow, where=m1)
+        np.less_equal(hsnow_bins, p.hssl_wet_snow, out=m1)
+        np.logical_and(m1, m2, out=m1)
+        np.copyto(hssl, p.hssl_thin_wet_snow, where=m1)
+        np.greater(hsnow_bins, 0., out=m2)
+        np.logical_and(m1, m2, out=m2)
+        np.copyto(k, p.k_thin_wet_snow, where=m2)
+        self._attenuate(i0, hsnow_bins, hssl, k)
+
+        # Ice attenuation, as green_edge_hssl_ice and select_attenuation_ice
+        hssl.fill(0.)
+        np.equal(hsnow_bins, 0., out=m1)
+        np.greater_equal(hice_bins, 0.5, out=m2)
+        np.logical_and(m1, m2, out=m2)
+        np.divide(hice_bins, 3., out=hssl, where=m2)
+        np.subtract(hssl, 1./6., out=hssl, where=m2)
+        np.greater_equal(hice_bins, 0.8, out=m2)
+        np.logical_and(m1, m2, out=m2)
+        np.copyto(hssl, p.hssl_ice, where=m2)
+        k.fill(p.k_ice)
+        np.less(hice_bins, p.hssl_ice, out=m1)
+        np.copyto(k, p.k_thin_ice, where=m1)
+        self._attenuate(i0, hice_bins, hssl, k)
+
+        np.matmul(i0, self.weights, out=transmittance)
+
+    @staticmethod
+    def _attenuate(i0, h, hssl, k):
+        """Multiplies i0 by exp(-k * (h - hssl)) in place, overwriting hssl"""
+        np.subtract(h, hssl, out=hssl)
+        np.multiply(hssl, k, out=hssl)
+        np.negative(hssl, out=hssl)
+        np.exp(hssl, out=hssl)
+        np.multiply(i0, hssl, out=i0)
+
+    def _flux_and_par(self, ws, flux, par):
+        """Writes flux and PAR of a chunk, as
+        beer_lambert_rt.model.flux_and_par_from_transmittance, and masks
+        invalid cells"""
+        p = self.params
+        _, _, albedo, sw, _, sic, transmittance, ow_fraction, ice_flux, ow_flux, term = (
+            ws["cell"])
+        # Ice cover albedo, as modify_albedo
+        np.subtract(1., sic, out=ow_fraction)
+        np.multiply(ow_fraction, p.albedo_open_water, out=ice_flux)
+        np.subtract(albedo, ice_flux, out=ice_flux)
+        np.divide(ice_flux, sic, out=ice_flux)
+        # Shortwave flux through the ice cover and open water
+        np.subtract(1., ice_flux, out=ice_flux)
+        np.multiply(ice_flux, transmittance, out=ice_flux)
+        np.multiply(sw, ice_flux, out=ice_flux)
+        np.multiply(sw, transmission_open_water(p), out=ow_flux)
+        np.multiply(ice_flux, sic, out=flux)
+        np.multiply(ow_flux, ow_fraction, out=term)
+        np.add(flux, term, out=flux)
+        np.multiply(ice_flux, p.underice_flux2par, out=par)
+        np.multiply(par, sic, out=par)
+        np.multiply(ow_flux, p.openwater_flux2par, out=term)
+        np.multiply(term, ow_fraction, out=term)
+        np.add(par, term, out=par)
+
+        invalid = ws["cell_masks"][1]
+        np.copyto(flux, np.nan, where=invalid)
+        np.copyto(par, np.nan, where=invalid)
@@ -0,0 +1,366 @@
+"""Chunked reading and writing of tabular point data
+
+Buoy and ship tracks are point datasets with one row per observation, and
+can have millions of rows.  io.load_csv reads a whole file into memory and
+converts it to an xarray Dataset.  The functions here read a csv or parquet
+file in batches of rows, run the model on each batch and append the results
+to the output file, so memory use is bounded by the batch size, not the file
+size.
+
+Batches are dicts of column name to numpy array, with an index column first.
+The first column of a csv file is the index, e.g. dates or observation ids.
+It is read as strings and written to the output unchanged.  Only the index
+and model input columns are read, as float64.  The index of a
+parquet file is the pandas index stored in the file.
+
+pyarrow is used to parse and write csv files if it is installed, otherwise
+pandas is used.  Parquet files require pyarrow.  Both are imported on first
+use.
+
+Example
+-------
+>>> nrows = run_csv(Path("buoys.csv"), Path("buoys.flux_and_par.csv"),
+...                 batch_size=100_000)
+"""
+
+import csv
+
+import numpy as np
+
+from beer_lambert_rt.io import EXPECTED_VARIABLES
+from beer_lambert_rt.profiling import stage
+
+
+# Default number of rows in a batch
+BATCH_SIZE = 2**16
+
+# Bytes read from the start of a file to estimate the length of a row
+SAMPLE_BYTES = 2**16
+
+ENGINES = ["pyarrow", "pandas"]
+
+# Columns passed to run_model, in order
+MODEL_INPUTS = [
+    "ice_thickness",
+    "snow_depth",
+    "albedo",
+    "sw_radiation",
+    "surface_temperature",
+    "sea_ice_concentration",
+    ]
+
+
+def get_engine(engine=None):
+    """Returns the name of the csv engine
+
+    :engine: "pyarrow", "pandas" or None to use pyarrow if it is installed
+    """
+    if engine is None:
+        try:
+            import pyarrow.csv  # noqa: F401
+        except ImportError:
+            return "pandas"
+        return "pyarrow"
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown csv engine {engine}, expects {' or '.join(ENGINES)}")
+    return engine
+
+
+def read_header(filepath):
+    """Returns the column names of a csv file"""
+    with open(filepath, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def bytes_per_row(filepath):
+    """Returns the mean length in bytes of the rows at the start of a csv file"""
+    with open(filepath, "rb") as f:
+        f.readline()
+        sample = f.read(SAMPLE_BYTES)
+    nrows = sample.count(b"\n")
+    return max(len(sample) // max(nrows, 1), 1)
+
+
+def read_csv_batches(filepath, batch_size=BATCH_SIZE, engine=None):
+    """Yields batches of rows from a csv file
+
+    :filepath: pathlib.Path object for csv file
+    :batch_size: maximum number of rows in a batch
+    :engine: see get_engine
+
+    :returns: iterator of dicts of column name to numpy array
+    """
+    columns = read_header(filepath)
+    if not all([var in columns for var in EXPECTED_VARIABLES]):
+        raise KeyError(f"Input file {filepath} must contain columns: "
+                       f"{', '.join(EXPECTED_VARIABLES)}")
+    if get_engine(engine) == "pyarrow":
+        batches = _read_csv_batches_pyarrow(filepath, columns, batch_size)
+    else:
+        batches = _read_csv_batches_pandas(filepath, columns, batch_size)
+    for batch in batches:
+        # pyarrow blocks are sized in bytes, so may hold more than batch_size rows
+        nrows = len(batch[columns[0]])
+        for start in range(0, nrows, batch_size):
+            yield {name: value[start:start + batch_size] for name, value in batch.items()}
+
+
+def _read_csv_batches_pyarrow(filepath, columns, batch_size):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    read_options = pa_csv.ReadOptions(block_size=batch_size * bytes_per_row(filepath))
+    # Types are otherwise guessed from the first block, so a column of zeros
+    # would be read as integers and fail on a later fractional value
+    convert_options = pa_csv.ConvertOptions(
+        column_types={columns[0]: pa.string(),
+                      **{name: pa.float64() for name in EXPECTED_VARIABLES}},
+        include_columns=[columns[0]] + EXPECTED_VARIABLES,
+        )
+    with pa_csv.open_csv(filepath, read_options=read_options,
+                         convert_options=convert_options) as reader:
+        for record_batch in reader:
+            yield {name: record_batch.column(i).to_numpy(zero_copy_only=False)
+                   for i, name in enumerate(record_batch.schema.names)}
+
+
+def _read_csv_batches_pandas(filepath, columns, batch_size):
+    import pandas as pd
+    usecols = [columns[0]] + EXPECTED_VARIABLES
+    dtype = {columns[0]: str, **{name: np.float64 for name in EXPECTED_VARIABLES}}
+    with pd.read_csv(filepath, header=0, names=columns, usecols=usecols, dtype=dtype,
+                     chunksize=batch_size) as reader:
+        for df in reader:
+            yield {name: df[name].to_numpy() for name in usecols}
+
+
+class CsvBatchWriter:
+    """Appends batches of rows to a csv file
+
+    Columns are taken from the first batch written.  Use as a context manager
+    to close the file.  pyarrow encloses the header and string values in
+    quotes, pandas only quotes values that contain delimiters.
+
+    :filepath: pathlib.Path object for output file
+    :engine: see get_engine
+    """
+
+    def __init__(self, filepath, engine=None):
+        self.filepath = filepath
+        self.engine = get_engine(engine)
+        self.nrows = 0
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, batch):
+        """Writes a dict of column name to array"""
+        if self.engine == "pyarrow":
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
+            record_batch = pa.RecordBatch.from_pydict(batch)
+            if self._writer is None:
+                self._writer = pa_csv.CSVWriter(str(self.filepath), record_batch.schema)
+            self._writer.write_batch(record_batch)
+        else:
+            import pandas as pd
+            if self._writer is None:
+                self._writer = open(self.filepath, "w", newline="")
+            pd.DataFrame(batch).to_csv(self._writer, header=self.nrows == 0, index=False)
+        self.nrows += len(next(iter(batch.values())))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def run_batches(batches, use_distribution=True, max_memory=None, parameters=None,
+                diagnostics=None):
+    """Runs the model on batches of rows
+
+    :batches: iterator of dicts of column name to array, with the index first
+    :use_distribution, max_memory, diagnostics: see model.run_model
+    :parameters: Parameters object.  Parameter ensembles cannot be written to tables.
+
+    :returns: iterator of dicts with the index column, named "index" if it has
+              no name, sw_flux and par, followed by diagnostics if requested
+    """
+    from beer_lambert_rt.model import run_model
+
+    if parameters is not None and parameters.ensemble_size is not None:
+        raise ValueError("Cannot write a parameter ensemble to a table")
+
+    while True:
+        with stage("load"):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        index_name = next(iter(batch))
+        flux, par, *extras = run_model(
+            *[batch[name].astype(np.float64) for name in MODEL_INPUTS],
+            use_distribution=use_distribution,
+            max_memory=max_memory,
+            parameters=parameters,
+            diagnostics=diagnostics,
+            )
+        yield {
+            index_name or "index": batch[index_name],
+            "sw_flux": flux,
+            "par": par,
+            **(extras[0] if extras else {}),
+            }
+
+
+def write_batches(results, writer):
+    """Writes results from run_batches with writer and returns the number of rows"""
+    with writer:
+        for result in results:
+            with stage("write"):
+                writer.write(result)
+    return writer.nrows
+
+
+def run_csv(input_path, output_path, batch_size=BATCH_SIZE, engine=None, **run_kwargs):
+    """Runs the model on a csv file of points in batches of rows
+
+    :input_path: pathlib.Path object for csv input file
+    :output_path: pathlib.Path object for csv output file
+    :batch_size: number of rows read, evaluated and written at a time
+    :engine: see get_engine
+    :run_kwargs: keywords passed to run_batches
+
+    :returns: number of rows written
+    """
+    batches = read_csv_batches(input_path, batch_size=batch_size, engine=engine)
+    return write_batches(run_batches(batches, **run_kwargs),
+                         CsvBatchWriter(output_path, engine=engine))
+
+
+def parquet_index_column(schema):
+    """Returns the name of the column holding a pandas index in a parquet schema,
+    or None if the index is not stored as a column"""
+    metadata = schema.pandas_metadata or {}
+    index_columns = [name for name in metadata.get("index_columns", [])
+                     if isinstance(name, str)]
+    return index_columns[0] if index_columns else None
+
+
+def read_parquet_batches(filepath, batch_size=BATCH_SIZE):
+    """Yields batches of rows from a parquet file
+
+    Only the index and EXPECTED_VARIABLES columns are read, in batches of
+    batch_size rows.  Batches may span row groups.  The index is the
+    pandas index stored in the file, or the row number if there is none.
+    Requires pyarrow.
+
+    :filepath: pathlib.Path object for parquet file
+    :batch_size: maximum number of rows in a batch
+
+    :returns: iterator of dicts of column name to numpy array
+    """
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(filepath)
+    schema = parquet_file.schema_arrow
+    if not all([var in schema.names for var in EXPECTED_VARIABLES]):
+        raise KeyError(f"Input file {filepath} must contain columns: "
+                       f"{', '.join(EXPECTED_VARIABLES)}")
+    index_column = parquet_index_column(schema)
+    columns = EXPECTED_VARIABLES if index_column is None else [index_column] + EXPECTED_VARIABLES
+    # pandas names an unnamed index __index_level_0__
+    index_name = index_column
+    if index_column is None or index_column.startswith("__index_level_"):
+        index_name = "index"
+    start = 0
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        batch = {name: record_batch.column(name).to_numpy(zero_copy_only=False)
+                 for name in columns}
+        if index_column is None:
+            index = np.arange(start, start + record_batch.num_rows)
+        else:
+            index = batch.pop(index_column)
+        start += record_batch.num_rows
+        yield {index_name: index, **batch}
+
+
+class ParquetBatchWriter:
+    """Writes batches of rows to a parquet file, one row group per batch
+
+    If partition_by is "date", rows are written to a directory of files
+    partitioned by the date of the index, e.g. date=2020-06-01/part-0.parquet,
+    so that queries for a date range only read matching files.  The index must
+    be datetime-like.  The directory must not already contain files.
+    Requires pyarrow.
+
+    :filepath: pathlib.Path object for output file or directory
+    :partition_by: None or "date"
+    """
+
+    def __init__(self, filepath, partition_by=None):
+        if partition_by not in (None, "date"):
+            raise ValueError(f"Unknown partitioning {partition_by}, expects None or date")
+        if partition_by is not None and filepath.exists() and any(filepath.iterdir()):
+            raise FileExistsError(f"Output directory {filepath} is not empty")
+        self.filepath = filepath
+        self.partition_by = partition_by
+        self.nrows = 0
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, batch):
+        """Writes a dict of column name to array"""
+        import pyarrow as pa
+        if self.partition_by == "date":
+            import pyarrow.dataset as pa_ds
+            index = next(iter(batch.values()))
+            if not np.issubdtype(index.dtype, np.datetime64):
+                raise ValueError("Partitioning by date requires a datetime index, "
+                                 f"got {index.dtype}")
+            table = pa.Table.from_pydict({**batch, "date": index.astype("datetime64[D]")})
+            pa_ds.write_dataset(
+                table, self.filepath, format="parquet",
+                partitioning=pa_ds.partitioning(table.select(["date"]).schema,
+                                                flavor="hive"),
+                basename_template=f"part-{self.nrows}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+                max_partitions=max(len(index), 1))
+        else:
+            import pyarrow.parquet as pq
+            record_batch = pa.RecordBatch.from_pydict(batch)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.filepath, record_batch.schema)
+            self._writer.write_batch(record_batch)
+        self.nrows += len(next(iter(batch.values())))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def run_parquet(input_path, output_path, batch_size=BATCH_SIZE, partition_by=None,
+                **run_kwargs):
+    """Runs the model on a parquet file of points in batches of rows
+
+    :input_path: pathlib.Path object for parquet input file
+    :output_path: pathlib.Path object for parquet output file, or directory if
+                  partition_by is given
+    :batch_size: maximum number of rows read, evaluated and written at a time
+    :partition_by: see ParquetBatchWriter
+    :run_kwargs: keywords passed to run_batches
+
+    :returns: number of rows written
+    """
+    batches = read_parquet_batches(input_path, batch_size=batch_size)
+    return write_batches(run_batches(batches, **run_kwargs),
+                         ParquetBatchWriter(output_path, partition_by=partition_by))
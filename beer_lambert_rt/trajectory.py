@@ -0,0 +1,199 @@
+"""Lagrangian trajectory mode: runs the model along buoy or parcel tracks
+
+Lagrangian products, e.g. the NSIDC-0758 snow depths, and drifting buoys
+give positions along a track rather than values on the model grid.  The
+functions here sample gridded forcing at each (time, lat, lon) point of a
+set of tracks and run the model on the sampled columns.
+
+Points are projected to the grid once, and converted to fractional grid
+indices.  Points are then grouped by the forcing time step that contains
+them, so that each daily field is loaded once and sampled for all tracks
+with vectorized bilinear interpolation.  Points outside the grid or time
+range, or next to a missing value, are NaN.
+
+The default projection is the north polar Lambert azimuthal equal-area
+projection of the original EASE-Grid (EPSG:3408), used by the 361 x 361
+grid of Stroeve et al (2021).  Other grids can be used by passing a
+function of (lat, lon) that returns (x, y), or a CRS understood by pyproj if
+it is installed.
+
+Example
+-------
+>>> forcing = xr.open_mfdataset("forcing_2020*.nc")
+>>> result = run_trajectories(buoys.time, buoys.lat, buoys.lon, forcing)
+>>> result["par"]
+"""
+
+import numpy as np
+
+from beer_lambert_rt.profiling import stage
+from beer_lambert_rt.tables import MODEL_INPUTS
+
+
+# Radius in meters of the sphere used by the original EASE-Grid
+EASE_GRID_EARTH_RADIUS = 6371228.
+
+
+def ease_grid_north(lat, lon):
+    """Returns x and y in meters of the north polar EASE-Grid (EPSG:3408)
+
+    :lat: latitude in degrees north
+    :lon: longitude in degrees east
+
+    :returns: x, y
+    """
+    phi = np.radians(lat)
+    lam = np.radians(lon)
+    rho = 2. * EASE_GRID_EARTH_RADIUS * np.sin(np.pi / 4. - phi / 2.)
+    return rho * np.sin(lam), -rho * np.cos(lam)
+
+
+def get_projection(projection=None):
+    """Returns a function of (lat, lon) that returns grid (x, y)
+
+    :projection: None for ease_grid_north, a function, or a CRS passed to
+                 pyproj.Transformer.from_crs
+    """
+    if projection is None:
+        return ease_grid_north
+    if callable(projection):
+        return projection
+    from pyproj import Transformer
+    transformer = Transformer.from_crs("EPSG:4326", projection, always_xy=True)
+
+    def transform(lat, lon):
+        return transformer.transform(lon, lat)
+    return transform
+
+
+def fractional_index(values, coord):
+    """Returns the fractional index of values along a monotonic coordinate,
+    NaN outside the coordinate range"""
+    coord = np.asarray(coord, dtype=np.float64)
+    index = np.arange(coord.size, dtype=np.float64)
+    if coord.size > 1 and coord[0] > coord[-1]:
+        coord, index = coord[::-1], index[::-1]
+    return np.interp(values, coord, index, left=np.nan, right=np.nan)
+
+
+def bilinear_weights(fy, fx, shape):
+    """Returns flattened corner indices and weights for bilinear interpolation
+
+    :fy, fx: fractional row and column indices of points
+    :shape: (ny, nx) shape of the grid.  Both must be at least 2.
+
+    :returns: (indices, weights) tuples of 4 arrays, one for each corner, and
+              a boolean array that is False for points outside the grid
+    """
+    ny, nx = shape
+    if ny < 2 or nx < 2:
+        raise ValueError(f"Bilinear interpolation needs a grid of at least 2 x 2, got {shape}")
+    valid = np.isfinite(fy) & np.isfinite(fx)
+    fy = np.where(valid, fy, 0.)
+    fx = np.where(valid, fx, 0.)
+    y0 = np.clip(np.floor(fy).astype(np.intp), 0, ny - 2)
+    x0 = np.clip(np.floor(fx).astype(np.intp), 0, nx - 2)
+    wy = fy - y0
+    wx = fx - x0
+    corner = y0 * nx + x0
+    indices = (corner, corner + 1, corner + nx, corner + nx + 1)
+    weights = ((1. - wy) * (1. - wx), (1. - wy) * wx, wy * (1. - wx), wy * wx)
+    return indices, weights, valid
+
+
+def bilinear_sample(field, indices, weights, valid):
+    """Returns values of a 2D field at points, see bilinear_weights"""
+    flat = np.asarray(field, dtype=np.float64).reshape(-1)
+    value = sum(flat[index] * weight for index, weight in zip(indices, weights))
+    return np.where(valid, value, np.nan)
+
+
+def time_step_index(time, forcing_time):
+    """Returns the index of the forcing time step that contains each time, or
+    -1 if it is outside the forcing.  A time step runs from its label to the
+    next label, and the last step is as long as the one before it."""
+    time = np.asarray(time, dtype="datetime64[ns]")
+    forcing_time = np.asarray(forcing_time, dtype="datetime64[ns]")
+    step = np.searchsorted(forcing_time, time, side="right") - 1
+    if forcing_time.size > 1:
+        end = forcing_time[-1] + (forcing_time[-1] - forcing_time[-2])
+        step[time >= end] = -1
+    return step
+
+
+def sample_forcing(forcing, time, fy, fx, variables=MODEL_INPUTS, time_dim="time",
+                   y_dim="y", x_dim="x"):
+    """Samples gridded forcing at points
+
+    Points are grouped by time step, and each field is loaded once per time
+    step.  Variables without a time dimension are loaded once.
+
+    :forcing: xarray.Dataset with variables on (time_dim, y_dim, x_dim) or
+              (y_dim, x_dim)
+    :time: time of each point
+    :fy, fx: fractional grid indices of each point, see fractional_index
+
+    :returns: dict of variable name to array of sampled values
+    """
+    shape = (forcing.sizes[y_dim], forcing.sizes[x_dim])
+    indices, weights, valid = bilinear_weights(fy, fx, shape)
+    samples = {name: np.full(np.shape(fy), np.nan) for name in variables}
+
+    static = [name for name in variables if time_dim not in forcing[name].dims]
+    for name in static:
+        with stage("load"):
+            field = forcing[name].transpose(y_dim, x_dim).values
+        samples[name] = bilinear_sample(field, indices, weights, valid)
+
+    varying = [name for name in variables if name not in static]
+    if not varying:
+        return samples
+    step = time_step_index(time, forcing[time_dim].values)
+    order = np.argsort(step, kind="stable")
+    steps, starts = np.unique(step[order], return_index=True)
+    for k, group in zip(steps, np.split(order, starts[1:])):
+        if k < 0:
+            continue
+        group_indices = tuple(index[group] for index in indices)
+        group_weights = tuple(weight[group] for weight in weights)
+        for name in varying:
+            with stage("load"):
+                field = forcing[name].isel({time_dim: k}).transpose(y_dim, x_dim).values
+            samples[name][group] = bilinear_sample(field, group_indices, group_weights,
+                                                   valid[group])
+    return samples
+
+
+def run_trajectories(time, lat, lon, forcing, projection=None, time_dim="time",
+                     y_dim="y", x_dim="x", **run_kwargs):
+    """Runs the model at points along tracks
+
+    :time: time of each point (datetime64 array-like)
+    :lat: latitude of each point in degrees north
+    :lon: longitude of each point in degrees east
+    :forcing: xarray.Dataset of model inputs, see io.EXPECTED_VARIABLES, with
+              projected coordinates in meters along y_dim and x_dim.  Data can
+              be lazy, e.g. from xarray.open_mfdataset.
+    :projection: see get_projection
+    :run_kwargs: keywords passed to run_model, e.g. max_memory or diagnostics
+
+    :returns: dict of arrays with one value per point: the sampled model
+              inputs, sw_flux and par, followed by any extra outputs of run_model
+    """
+    from beer_lambert_rt.model import run_model
+
+    time = np.asarray(time).reshape(-1)
+    lat = np.asarray(lat, dtype=np.float64).reshape(-1)
+    lon = np.asarray(lon, dtype=np.float64).reshape(-1)
+    if not time.size == lat.size == lon.size:
+        raise ValueError(f"time, lat and lon must have the same size, got "
+                         f"{time.size}, {lat.size} and {lon.size}")
+
+    x, y = get_projection(projection)(lat, lon)
+    fy = fractional_index(y, forcing[y_dim].values)
+    fx = fractional_index(x, forcing[x_dim].values)
+    samples = sample_forcing(forcing, time, fy, fx, time_dim=time_dim,
+                             y_dim=y_dim, x_dim=x_dim)
+
+    flux, par, *extras = run_model(*[samples[name] for name in MODEL_INPUTS], **run_kwargs)
+    return {**samples, "sw_flux": flux, "par": par, **(extras[0] if extras else {})}
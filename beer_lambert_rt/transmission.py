@@ -11,6 +11,11 @@ np.piecewise and np.select to parameter values.  The main function
 to calculate transmittance has been vectorized.  See the underice_light.ipynb
 for an deeper explanation.
 
+Parameter values are taken from a beer_lambert_rt.parameters.Parameters
+object passed as params.  If params is None, default values defined in
+beer_lambert_rt.constants are used.  Array-valued (ensemble) parameters
+broadcast as a leading dimension against the other inputs.
+
 Parameters are selected for several cases:
 
 - dry snow over ice
@@ -23,40 +28,77 @@ Parameters are selected for several cases:
 
 """
 
+from functools import partial
 import warnings
 
 import numpy as np
 
-from beer_lambert_rt.constants import (hssl_ice, hssl_dry_snow,
-                                       hssl_wet_snow, hssl_thin_wet_snow,
-                                       k_ice, k_thin_ice, k_dry_snow,
-                                       k_wet_snow, k_thin_wet_snow,
-                                       i0_ice, i0_dry_snow, i0_wet_snow, i0_melt_ponds,
-                                       albedo_open_water)
-from beer_lambert_rt.distributions import snow_ice_distribution
+from beer_lambert_rt.distributions import snow_ice_distribution, bin_average
+from beer_lambert_rt.parameters import default_parameters
+from beer_lambert_rt.profiling import stage
+
+
+# Surface types encoded by surface_type_flag, in flag value order.  Names
+# follow the CF flag_meanings convention.
+SURFACE_TYPE_FLAG_MEANINGS = [
+    "wet_snow",
+    "thin_wet_snow",
+    "dry_snow",
+    "bare_ice",
+    "thin_bare_ice",
+    "melt_pond",
+    ]
+SURFACE_TYPE_FLAG_VALUES = np.arange(len(SURFACE_TYPE_FLAG_MEANINGS), dtype=np.uint8)
+SURFACE_TYPE_FILL_VALUE = np.uint8(255)
 
 
-def surface_type(hice, hsnow, hpond, surface_temperature):
-    conditions = [
-        (hsnow > hssl_wet_snow) & (surface_temperature > 0.),
-        (hsnow <= hssl_wet_snow) & (surface_temperature > 0.),
+def surface_type_conditions(hice, hsnow, hpond, surface_temperature, params=None):
+    """Returns conditions used to select the surface type"""
+    params = default_parameters if params is None else params
+    return [
+        (hsnow > params.hssl_wet_snow) & (surface_temperature > 0.),
+        (hsnow <= params.hssl_wet_snow) & (surface_temperature > 0.),
         (hsnow > 0.) & (surface_temperature <= 0.),
-        (hsnow == 0.) & (hice > hssl_ice),
-        (hsnow == 0.) & (hice <= hssl_ice),
+        (hsnow == 0.) & (hice > params.hssl_ice),
+        (hsnow == 0.) & (hice <= params.hssl_ice),
         (hpond > 0.),
     ]
-    choices = [
-        "Wet snow",
-        "Thin wet snow",
-        "Dry snow",
-        "Bare ice",
-        "Thin bare ice",
-        "Melt pond",
-    ]
-    return np.select(conditions, choices)
 
 
-def green_edge_hssl_snow(hsnow, surface_temperature):
+def surface_type_flag(hice, hsnow, hpond, surface_temperature, params=None):
+    """Returns surface type as a uint8 flag
+
+    Flag values index SURFACE_TYPE_FLAG_MEANINGS.  Cells that match no surface
+    type, e.g. because an input is NaN, are set to SURFACE_TYPE_FILL_VALUE.
+    """
+    conditions = surface_type_conditions(hice, hsnow, hpond, surface_temperature, params)
+    flag = np.full(np.broadcast(*conditions).shape, SURFACE_TYPE_FILL_VALUE)
+    # Assign in reverse so that the first matching condition wins, as np.select
+    for value, condition in reversed(list(zip(SURFACE_TYPE_FLAG_VALUES, conditions))):
+        flag[np.broadcast_to(condition, flag.shape)] = value
+    return flag
+
+
+def surface_type(hice, hsnow, hpond, surface_temperature, params=None):
+    """Returns surface type as strings, or an empty string for cells that match
+    no surface type.  Use surface_type_flag for grids."""
+    labels = np.array(["Wet snow", "Thin wet snow", "Dry snow", "Bare ice",
+                       "Thin bare ice", "Melt pond", ""])
+    flag = surface_type_flag(hice, hsnow, hpond, surface_temperature, params)
+    return labels[np.minimum(flag, len(labels) - 1)]
+
+
+def green_edge_hssl_snow_conditions(hsnow, surface_temperature, params=None):
+    """Returns conditions used to select snow surface scattering layer thickness"""
+    params = default_parameters if params is None else params
+    return [
+        (hsnow > 0.) & (surface_temperature < 0.),
+        (hsnow > params.hssl_wet_snow) & (surface_temperature >= 0.),
+        (hsnow <= params.hssl_wet_snow) & (surface_temperature >= 0.),
+        ]
+
+
+def green_edge_hssl_snow(hsnow, surface_temperature, params=None):
     """Returns thickness of snow surface scattering layer following Green Edge study
 
     Add reference here
@@ -64,20 +106,28 @@ def green_edge_hssl_snow(hsnow, surface_temperature):
     hssl_snow = hssl_dry_snow
     if hsnow > hssl_wet_snow and surface_temperature > 0. hssl_wet_snow, zero otherwise
     """
-    conditions = [
-        (hsnow > 0.) & (surface_temperature < 0.),
-        (hsnow > hssl_wet_snow) & (surface_temperature >= 0.),
-        (hsnow <= hssl_wet_snow) & (surface_temperature >= 0.),
-        ]
+    params = default_parameters if params is None else params
+    conditions = green_edge_hssl_snow_conditions(hsnow, surface_temperature, params)
     choices = [
-        hssl_dry_snow,
-        hssl_wet_snow,
-        hssl_thin_wet_snow,
+        params.hssl_dry_snow,
+        params.hssl_wet_snow,
+        params.hssl_thin_wet_snow,
         ]
     return np.select(conditions, choices)
 
 
-def green_edge_hssl_ice(hice, hsnow, hpond):
+def green_edge_hssl_ice_conditions(hice, hsnow, hpond):
+    """Returns conditions used to select ice surface scattering layer thickness"""
+    return [
+        (hsnow > 0.),
+        (hpond > 0.),
+        (hsnow == 0.) & (hpond == 0.) & (hice < 0.5),
+        (hsnow == 0.) & (hpond == 0.) & (hice >= 0.5) & (hice < 0.8),
+        (hsnow == 0.) & (hpond == 0.) & (hice >= 0.8),
+    ]
+
+
+def green_edge_hssl_ice(hice, hsnow, hpond, params=None):
     """
     Returns the the thickness of the ice surface scattering layer
 
@@ -89,23 +139,21 @@ def green_edge_hssl_ice(hice, hsnow, hpond):
            | hssl_ice; hice > 0.8 
     
     I have no idea where this comes from.  Finding out.
+
+    np.select is used rather than np.piecewise so that hice, hsnow and hpond
+    only need to be broadcastable.
     """
-    ssl_slope = lambda hice: hice/3. - 1./6.
-    conditions = [
-        (hsnow > 0.),
-        (hpond > 0.),
-        (hsnow == 0.) & (hpond == 0.) & (hice < 0.5),
-        (hsnow == 0.) & (hpond == 0.) & (hice >= 0.5) & (hice < 0.8),
-        (hsnow == 0.) & (hpond == 0.) & (hice >= 0.8),
-    ]
+    params = default_parameters if params is None else params
+    ssl_slope = hice/3. - 1./6.
+    conditions = green_edge_hssl_ice_conditions(hice, hsnow, hpond)
     choices = [
         0.0,
         0.0,
         0.0,
         ssl_slope,
-        hssl_ice,
+        params.hssl_ice,
     ]
-    return np.piecewise(hice, conditions, choices)
+    return np.select(conditions, choices)
 
 
 def cice_hssl_snow(hsnow, surface_temperature):
@@ -118,7 +166,16 @@ def cice_hssl_ice(hice, hsnow, hpond, surface_temperature):
     raise NotImplemetedError
 
 
-def select_attenuation_ice(hice):
+def attenuation_ice_conditions(hice, params=None):
+    """Returns conditions used to select the ice attenuation coefficient"""
+    params = default_parameters if params is None else params
+    return [
+        hice < params.hssl_ice,
+        hice >= params.hssl_ice,
+    ]
+
+
+def select_attenuation_ice(hice, params=None):
     """
     Returns attenuation coefficient of ice based on hice
 
@@ -137,52 +194,69 @@ def select_attenuation_ice(hice):
     :hice: scalar or arraylike
            ice thickness in meters
 
+    :params: Parameters object, default parameters are used if None
+
     :returns: scalar or arraylike with same dimensions as hice
     """
-    conditions = [
-        hice < hssl_ice,
-        hice >= hssl_ice,
-    ]
+    params = default_parameters if params is None else params
+    conditions = attenuation_ice_conditions(hice, params)
     choices = [
-        k_thin_ice,
-        k_ice,
+        params.k_thin_ice,
+        params.k_ice,
     ]
     return np.select(conditions, choices)
 
 
-def select_attenuation_snow(hsnow, surface_temperature):
-    """Selects the attenuation coefficient for snow based on 
-    snow depth and surface temperature"""
-    conditions = [
+def attenuation_snow_conditions(hsnow, surface_temperature, params=None):
+    """Returns conditions used to select the snow attenuation coefficient"""
+    params = default_parameters if params is None else params
+    return [
         (hsnow > 0.) & (surface_temperature < 0.),
-        (hsnow > hssl_wet_snow) & (surface_temperature >= 0.),
-        (hsnow > 0.) & (hsnow <= hssl_wet_snow) & (surface_temperature >= 0.),
+        (hsnow > params.hssl_wet_snow) & (surface_temperature >= 0.),
+        (hsnow > 0.) & (hsnow <= params.hssl_wet_snow) & (surface_temperature >= 0.),
     ]
+
+
+def select_attenuation_snow(hsnow, surface_temperature, params=None):
+    """Selects the attenuation coefficient for snow based on 
+    snow depth and surface temperature"""
+    params = default_parameters if params is None else params
+    conditions = attenuation_snow_conditions(hsnow, surface_temperature, params)
     choices = [
-        k_dry_snow,
-        k_wet_snow,
-        k_thin_wet_snow,
+        params.k_dry_snow,
+        params.k_wet_snow,
+        params.k_thin_wet_snow,
     ]
     return np.select(conditions, choices)
 
 
-def select_surface_transmission(hice, hsnow, hpond, surface_temperature):
-    """Selects i_0 based on surface type and temperature"""
-    conditions = [
+def surface_transmission_conditions(hice, hsnow, hpond, surface_temperature):
+    """Returns conditions used to select the surface transmission parameter"""
+    return [
         (hsnow == 0.) & (hpond <= 0.) & (hice >= 0.5),
         (hsnow == 0.) & (hpond <= 0.) & (hice < 0.5),
         hpond > 0.,
         (hsnow > 0.) & (surface_temperature < 0.),
         (hsnow > 0.) & (surface_temperature >= 0.),
     ]
+
+
+def select_surface_transmission(hice, hsnow, hpond, surface_temperature, params=None):
+    """Selects i_0 based on surface type and temperature
+
+    Cells that match none of the surface types, e.g. because an input is NaN,
+    are set to NaN.
+    """
+    params = default_parameters if params is None else params
+    conditions = surface_transmission_conditions(hice, hsnow, hpond, surface_temperature)
     choices = [
-        i0_ice,
+        params.i0_ice,
         1.,
-        i0_melt_ponds,
-        i0_dry_snow,
-        i0_wet_snow,
+        params.i0_melt_ponds,
+        params.i0_dry_snow,
+        params.i0_wet_snow,
     ]
-    return np.select(conditions, choices, None)
+    return np.select(conditions, choices, np.nan)
 
 
 ssl_scheme_snow = {
@@ -195,12 +269,13 @@ ssl_scheme_ice = {
     }
 
 
-def transmission_open_water():
+def transmission_open_water(params=None):
     """Returns transmittance for open water"""
-    return 1 - albedo_open_water
+    params = default_parameters if params is None else params
+    return 1 - params.albedo_open_water
 
 
-def modify_albedo(albedo, sea_ice_concentration):
+def modify_albedo(albedo, sea_ice_concentration, params=None):
     """Calculates a modified ice cover albedo from grid cell albedo
     and sea ice.
 
@@ -215,14 +290,17 @@ def modify_albedo(albedo, sea_ice_concentration):
     ---------
     :albedo: grid cell albedo
     :sea_ice_concentration: sea ice concentration
+    :params: Parameters object, default parameters are used if None
 
     :returns: a modified albedo for the non-open water portion of the grid cell
     """
-    return (albedo - (albedo_open_water * (1 - sea_ice_concentration))) / sea_ice_concentration
+    params = default_parameters if params is None else params
+    return ((albedo - (params.albedo_open_water * (1 - sea_ice_concentration))) /
+            sea_ice_concentration)
 
     
 def calculate_transmittance(hice, hsnow, hpond, surface_temperature,
-                            ssl_parameterization="green_edge"):
+                            ssl_parameterization="green_edge", params=None):
     """Returns transmittance for a snow-ice-pond column_stack
 
     :hice: float - scalar or ndarray - ice thickness in m
@@ -230,8 +308,12 @@ def calculate_transmittance(hice, hsnow, hpond, surface_temperature,
     :hpond: float - scalar or ndarray - pond depth in m.  If hpond > 0, hsnow must
             be zero.  Raises an ValueError exception.
     :surface_temperature: float - scalar or ndarray - surface temperature in deg. C
+    :params: Parameters object, default parameters are used if None.  Array-valued
+             parameters must have trailing singleton axes to broadcast against inputs,
+             see Parameters.append_axes.
 
-    :returns: bulk transmittance with same dimensions as input.
+    :returns: bulk transmittance with same dimensions as input.  If params is an
+              ensemble, the ensemble is the leading dimension.
 
     Parameters are selected based on ice thickness, snow depth, pond depth,
     and skin temperature.  Parameter selection routines adjust surface scattering layer 
@@ -242,17 +324,15 @@ def calculate_transmittance(hice, hsnow, hpond, surface_temperature,
     If hsnow > 0 and hpond > 0. an exeption is raised.  Model does not allow for ponds
     on snow.
     """
-    if (hice <= 0).any():
+    if np.any(hice <= 0):
         raise ValueError("One or more hice is zero.  This condition is not allowed")
 
-    if ((hsnow > 0.) & (hpond > 0)).any():
+    if np.any((hsnow > 0.) & (hpond > 0)):
         raise ValueError("One or more hsnow > 0. and hpond > 0.!")
     
-    i0 = select_surface_transmission(hice, hsnow, hpond, surface_temperature)
-    hssl_ice = green_edge_hssl_ice(hice, hsnow, hpond)
-    hssl_snow = green_edge_hssl_snow(hsnow, surface_temperature)
-    kice = select_attenuation_ice(hice)
-    ksnow = select_attenuation_snow(hsnow, surface_temperature)
+    i0, hssl_ice, hssl_snow, kice, ksnow = transmittance_terms(hice, hsnow, hpond,
+                                                              surface_temperature,
+                                                              params)
 
     # Evaluates to zero when hsnow is zero
     esnow = np.exp(-1. * ksnow * (hsnow - hssl_snow))
@@ -262,6 +342,19 @@ def calculate_transmittance(hice, hsnow, hpond, surface_temperature,
     return i0 * esnow * eice
 
 
+def transmittance_terms(hice, hsnow, hpond, surface_temperature, params=None):
+    """Returns the parameters selected for each snow-ice-pond column
+
+    :returns: tuple of arrays (i0, hssl_ice, hssl_snow, kice, ksnow)
+    """
+    i0 = select_surface_transmission(hice, hsnow, hpond, surface_temperature, params)
+    hssl_ice = green_edge_hssl_ice(hice, hsnow, hpond, params)
+    hssl_snow = green_edge_hssl_snow(hsnow, surface_temperature, params)
+    kice = select_attenuation_ice(hice, params)
+    ksnow = select_attenuation_snow(hsnow, surface_temperature, params)
+    return i0, hssl_ice, hssl_snow, kice, ksnow
+
+
 def get_transmittance(ice_thickness,
                       snow_depth,
                       pond_depth,
@@ -270,7 +363,10 @@ def get_transmittance(ice_thickness,
                       nbins_snow=7,
                       max_factor_snow=3.,
                       nbins_ice=15,
-                      max_factor_ice=3.):
+                      max_factor_ice=3.,
+                      params=None,
+                      fused=False,
+                      snow_distribution=None):
     """Returns transmittance for a ice_thickness, and snow_depth or pond_depth.  
     The default behaviour is to estimate a mean transmittance for a joint 
     distribution of ice thicknesses and snow depths, or ice thicknesses and 
@@ -285,6 +381,22 @@ def get_transmittance(ice_thickness,
 
     Currently, pond_depth is set to zero.
 
+    Inputs may be scalars or arrays.  All cells are evaluated in a single
+    vectorized pass: the distributions are laid out along a trailing bin axis,
+    so intermediate arrays have shape input.shape + (nbins_snow*nbins_ice,).
+    Use beer_lambert_rt.planner to split large grids into chunks that fit
+    in memory.
+
+    params is a Parameters object with array-valued parameters aligned to the
+    inputs, see calculate_transmittance.  Distributions are shared by all
+    members of a parameter ensemble.
+
+    If fused is True, or a backend name, transmittance is evaluated with the
+    fused expressions of beer_lambert_rt.fused, without full-size temporaries.
+
+    snow_distribution is a dict of snow depth distribution parameters that
+    vary between cells, see beer_lambert_rt.distributions.snow_depth_fraction_field.
+
     Need to add a pond transmittance with pond_fraction"""
 
     # For performance testing
@@ -292,18 +404,31 @@ def get_transmittance(ice_thickness,
 #                  UserWarning)
 #    return 0.5
 
+    if fused:
+        from beer_lambert_rt.fused import fused_transmittance
+        transmit = partial(fused_transmittance, fused=fused)
+    else:
+        transmit = calculate_transmittance
+
     if use_distribution:
-        hice_arr, hsnow_arr, area_fraction = snow_ice_distribution(ice_thickness,
-                                                                   snow_depth,
-                                                                   nbins_ice,
-                                                                   max_factor_ice,
-                                                                   nbins_snow,
-                                                                   max_factor_snow)
-        hpond_arr = np.full_like(hice_arr, pond_depth)
-        tsurf_arr = np.full_like(hice_arr, surface_temperature)
-        transmittance = calculate_transmittance(hice_arr, hsnow_arr, hpond_arr, tsurf_arr)
-        transmittance = (transmittance * area_fraction).sum()
+        with stage("distribution"):
+            hice_arr, hsnow_arr, area_fraction = snow_ice_distribution(ice_thickness,
+                                                                       snow_depth,
+                                                                       nbins_ice,
+                                                                       max_factor_ice,
+                                                                       nbins_snow,
+                                                                       max_factor_snow,
+                                                                       snow_distribution)
+        # Trailing axis broadcasts pond depth and temperature across bins
+        hpond_arr = np.expand_dims(pond_depth, -1)
+        tsurf_arr = np.expand_dims(surface_temperature, -1)
+        binned_params = None if params is None else params.append_axes(1)
+        with stage("transmittance"):
+            transmittance = transmit(hice_arr, hsnow_arr, hpond_arr, tsurf_arr,
+                                     params=binned_params)
+            transmittance = bin_average(transmittance, area_fraction)
     else:
-        transmittance = calculate_transmittance(ice_thickness, snow_depth, pond_depth,
-                                                surface_temperature)
+        with stage("transmittance"):
+            transmittance = transmit(ice_thickness, snow_depth, pond_depth,
+                                     surface_temperature, params=params)
     return transmittance
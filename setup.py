@@ -15,6 +15,9 @@ setup(
         ],
     scripts=[
         'cli/run_beer_lambert_rt',
+        'cli/serve_beer_lambert_rt',
+        'cli/benchmark_beer_lambert_rt',
+        'cli/pipeline_beer_lambert_rt',
         ],
     license='license',
     description='A Beer-Lambert radiative transfer model for sea ice',
@@ -0,0 +1,20 @@
+"""Shared helpers for tests"""
+import numpy as np
+
+
+def make_inputs(shape, seed=0, static=False):
+    """Returns random run_model inputs in valid ranges
+
+    :shape: shape of the inputs
+    :seed: seed of the random number generator
+    :static: if True, ice thickness and snow depth have the shape of the
+             trailing dimensions, e.g. static ice with daily forcing
+
+    :returns: list of ice thickness, snow depth, albedo, sw radiation, skin
+              temperature and sea ice concentration arrays
+    """
+    rng = np.random.default_rng(seed)
+    ice_shape = shape[1:] if static else shape
+    return [rng.uniform(0.05, 3., ice_shape), rng.uniform(0., 0.5, ice_shape),
+            rng.uniform(0.5, 0.9, shape), rng.uniform(0., 300., shape),
+            rng.uniform(-15., 2., shape), rng.uniform(0.3, 1., shape)]
@@ -0,0 +1,85 @@
+"""Tests for the blrt xarray accessor"""
+import pytest
+import numpy as np
+import xarray as xr
+
+import beer_lambert_rt.accessor as accessor
+from beer_lambert_rt.io import par_attrs
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.parameters import Parameters
+from beer_lambert_rt.tables import MODEL_INPUTS
+
+
+def make_dataset(ntime=4, ny=10, nx=12):
+    """Returns inputs with static ice on (y, x) and forcing on (time, y, x)"""
+    rng = np.random.default_rng(0)
+    static, forcing = ("y", "x"), ("time", "y", "x")
+    shape = (ntime, ny, nx)
+    return xr.Dataset(
+        {
+            "ice_thickness": (static, rng.uniform(0.5, 2., shape[1:])),
+            "snow_depth": (static, rng.uniform(0., 0.4, shape[1:])),
+            "albedo": (forcing, rng.uniform(0.5, 0.9, shape)),
+            "sw_radiation": (forcing, rng.uniform(0., 300., shape)),
+            "surface_temperature": (forcing, rng.uniform(-10., 1., shape)),
+            "sea_ice_concentration": (forcing, rng.uniform(0.5, 1., shape)),
+        },
+        coords={"time": np.arange(ntime), "y": np.arange(ny), "x": np.arange(nx)},
+    )
+
+
+def test_run_is_lazy_and_matches_run_model(monkeypatch):
+    ds = make_dataset()
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(np.shape(args[3]))
+        return run_model(*args, **kwargs)
+    monkeypatch.setattr(accessor, "run_model", counted)
+
+    chunked = ds.chunk({"time": 1, "y": 5})
+    result = chunked.blrt.run(diagnostics=["quality"], jacobian=["snow_depth"])
+    assert calls == []
+    assert result.par.dims == ("time", "y", "x")
+    assert result.par.chunks == ((1, 1, 1, 1), (5, 5), (12,))
+    assert result.par.attrs == par_attrs
+    assert result.quality.dtype == np.uint8
+
+    computed = result.compute()
+    assert len(calls) == 8
+    flux, par, extras = run_model(*[ds[name].values for name in MODEL_INPUTS],
+                                  diagnostics=["quality"], jacobian=["snow_depth"])
+    assert np.allclose(computed.par, par)
+    assert np.allclose(computed.dpar_dsnow_depth, extras["dpar_dsnow_depth"])
+    assert np.array_equal(computed.time, ds.time)
+
+
+def test_run_ensemble_uncertainty_and_snow_distribution():
+    ds = make_dataset().chunk({"time": 2})
+    std = 0.1 * ds.ice_thickness
+    params = Parameters(k_dry_snow=[6., 7., 8.])
+    skewness = xr.where(ds.ice_thickness > 1.5, 1.8, 2.54)
+    result = ds.blrt.run(parameters=params,
+                         uncertainty={"ice_thickness": std, "snow_depth": 0.05},
+                         snow_distribution={"skewness": skewness, "cv": 0.35})
+    assert result.par.dims == ("ensemble", "time", "y", "x")
+    assert np.array_equal(result.k_dry_snow, [6., 7., 8.])
+
+    flux, par, extras = run_model(*[ds[name].values for name in MODEL_INPUTS],
+                                  parameters=params,
+                                  uncertainty={"ice_thickness": std.values,
+                                               "snow_depth": 0.05},
+                                  snow_distribution={"skewness": skewness.values,
+                                                     "cv": 0.35})
+    assert np.allclose(result.par, par)
+    assert np.allclose(result.par_std, extras["par_std"])
+
+
+def test_run_variables():
+    ds = make_dataset().rename({"sw_radiation": "swdn"}).drop_vars("sea_ice_concentration")
+    result = ds.blrt.run(variables={"sw_radiation": "swdn", "sea_ice_concentration": 1.})
+    expected = make_dataset().assign(sea_ice_concentration=1.).blrt.run()
+    assert np.allclose(result.par, expected.par)
+
+    with pytest.raises(ValueError):
+        ds.blrt.run()
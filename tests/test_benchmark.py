@@ -0,0 +1,24 @@
+"""Tests for the end-to-end benchmark"""
+import numpy as np
+
+from beer_lambert_rt.benchmark import legacy_par, legacy_par_loop, run_benchmark
+
+
+def test_legacy_par_matches_original_loops():
+    rng = np.random.default_rng(0)
+    n = 50
+    inputs = (rng.uniform(0.1, 4., n),
+              np.where(rng.uniform(size=n) < 0.2, 0., rng.uniform(0., 0.5, n)),
+              rng.uniform(0.5, 0.9, n),
+              rng.uniform(50., 300., n),
+              rng.uniform(-10., 2., n),
+              rng.uniform(0.2, 1., n))
+    assert np.allclose(legacy_par(*inputs), legacy_par_loop(*inputs))
+
+
+def test_run_benchmark(tmp_path):
+    report = run_benchmark(ndays=2, shape=(20, 30), workdir=tmp_path, legacy_sample=20)
+    assert report["cells"] == 600
+    assert report["pipeline"]["seconds_per_model_day"] > 0
+    assert report["legacy_loop"]["max_absolute_difference_from_vectorized"] < 1e-10
+    assert len(list(tmp_path.glob("*.flux_and_par.nc"))) == 2
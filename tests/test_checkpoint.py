@@ -0,0 +1,109 @@
+"""Tests for tile-level checkpoint and restart"""
+import json
+
+import pytest
+import numpy as np
+
+from conftest import make_inputs
+from beer_lambert_rt.checkpoint import Checkpoint, STATE_FILE
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.planner import plan_execution
+
+
+SHAPE = (4, 30, 20)
+
+
+class Interrupt(Exception):
+    pass
+
+
+class TileCounter:
+    """Progress reporter that counts evaluated tiles and can stop the run"""
+
+    def __init__(self, stop_after=None):
+        self.stop_after = stop_after
+        self.tiles = 0
+        self.skipped = 0
+
+    def start(self, plan):
+        pass
+
+    def update(self, chunk):
+        self.tiles += 1
+        if self.tiles == self.stop_after:
+            raise Interrupt
+
+    def skip(self, chunk):
+        self.skipped += 1
+
+    def finish(self):
+        pass
+
+
+def test_checkpoint_resumes(tmp_path):
+    inputs = make_inputs(SHAPE, static=True)
+    expected_flux, expected_par = run_model(*inputs)
+    plan = plan_execution(SHAPE, max_memory="2MB", repeats=SHAPE[0])
+    assert plan.nchunks > 3
+
+    with pytest.raises(Interrupt):
+        run_model(*inputs, plan=plan, checkpoint=tmp_path, progress=TileCounter(3))
+    lines = (tmp_path / STATE_FILE).read_text().splitlines()
+    assert len(lines) == 1 + 3
+    # A truncated journal line from a crash while recording is ignored
+    with open(tmp_path / STATE_FILE, "a") as f:
+        f.write('{"tile": 3, "rows"')
+
+    checkpoint = Checkpoint(tmp_path)
+    flux, par = run_model(*inputs, plan=plan, checkpoint=checkpoint)
+    assert checkpoint.resumed == 3
+    assert np.allclose(flux, expected_flux)
+    assert np.allclose(par, expected_par)
+
+
+def test_checkpoint_resumes_after_truncated_record(tmp_path):
+    """Tiles recorded after a truncated line are found by the next resume"""
+    inputs = make_inputs(SHAPE, static=True)
+    expected_flux, _ = run_model(*inputs)
+    plan = plan_execution(SHAPE, max_memory="2MB", repeats=SHAPE[0])
+    assert plan.nchunks > 5
+
+    with pytest.raises(Interrupt):
+        run_model(*inputs, plan=plan, checkpoint=tmp_path, progress=TileCounter(3))
+    with open(tmp_path / STATE_FILE, "a") as f:
+        f.write('{"tile": 3, "rows"')
+    with pytest.raises(Interrupt):
+        run_model(*inputs, plan=plan, checkpoint=tmp_path, progress=TileCounter(2))
+
+    counter = TileCounter()
+    checkpoint = Checkpoint(tmp_path)
+    flux, _ = run_model(*inputs, plan=plan, checkpoint=checkpoint, progress=counter)
+    assert checkpoint.resumed == 5
+    assert counter.tiles == plan.nchunks - 5
+    assert np.allclose(flux, expected_flux)
+
+
+def test_checkpoint_recomputes_corrupt_tiles(tmp_path):
+    inputs = make_inputs(SHAPE, static=True)
+    plan = plan_execution(SHAPE, max_memory="2MB", repeats=SHAPE[0])
+    expected_flux, _ = run_model(*inputs, plan=plan, checkpoint=tmp_path)
+
+    flux = np.load(tmp_path / "flux.npy", mmap_mode="r+")
+    flux[0, 0, 0] = -1.
+    flux.flush()
+    del flux
+    counter = TileCounter()
+    checkpoint = Checkpoint(tmp_path)
+    flux, _ = run_model(*inputs, plan=plan, checkpoint=checkpoint, progress=counter)
+    assert checkpoint.resumed == counter.skipped == plan.nchunks - 1
+    assert counter.tiles == 1
+    assert np.allclose(flux, expected_flux)
+
+
+def test_checkpoint_for_different_job_raises(tmp_path):
+    run_model(*make_inputs(SHAPE, static=True), max_memory="2MB", checkpoint=tmp_path)
+    with pytest.raises(ValueError):
+        run_model(*make_inputs(SHAPE, seed=1, static=True), max_memory="2MB",
+                  checkpoint=tmp_path)
+    job = json.loads((tmp_path / STATE_FILE).read_text().splitlines()[0])
+    assert job["shape"] == list(SHAPE)
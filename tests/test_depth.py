@@ -0,0 +1,64 @@
+"""Tests for PAR profiles below the ice"""
+from pathlib import Path
+import tracemalloc
+
+import pytest
+import numpy as np
+import xarray as xr
+import dask
+
+import beer_lambert_rt.io as io
+from beer_lambert_rt.depth import par_profile, add_depth_profile
+
+
+def test_par_profile_attenuates_par():
+    par = np.random.default_rng(0).uniform(0., 500., (3, 4, 5))
+    par[0, 0, 0] = np.nan
+    depth = [0., 2., 10., 40.]
+    profile = par_profile(par, depth, k_water=0.2)
+    assert profile.shape == (3, 4, 4, 5)
+    assert profile.chunks[1] == (1, 1, 1, 1)
+    expected = par[:, np.newaxis] * np.exp(-0.2 * np.array(depth))[:, np.newaxis, np.newaxis]
+    assert np.allclose(profile.compute(), expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("shape,expected",
+                         [
+                             ((), (4,)),
+                             ((6,), (4, 6)),
+                             ((2, 3, 6, 7), (2, 3, 4, 6, 7)),
+                         ])
+def test_par_profile_depth_axis(shape, expected):
+    assert par_profile(np.ones(shape), np.arange(4.)).shape == expected
+
+
+@pytest.mark.parametrize("depth,k_water",
+                         [
+                             ([-1., 5.], 0.1),
+                             ([[1., 5.]], 0.1),
+                             ([1., np.nan], 0.1),
+                             ([1., 5.], -0.1),
+                         ])
+def test_par_profile_invalid_raises(depth, k_water):
+    with pytest.raises(ValueError):
+        par_profile(np.ones((2, 2)), depth, k_water=k_water)
+
+
+def test_depth_profile_written_level_by_level(tmp_path):
+    """Writing 50 levels of a 200 x 200 grid holds a few levels in memory, not 50"""
+    par = np.random.default_rng(0).uniform(0., 500., (1, 200, 200))
+    result = io.make_netcdf(par / 3.5, par, ("time", "y", "x"), {}, Path("test.nc"))
+    result = add_depth_profile(result, np.linspace(0., 98., 50), k_water=0.05)
+    assert result.par_depth.dims == ("time", "depth", "y", "x")
+
+    tracemalloc.start()
+    with dask.config.set(scheduler="synchronous"):
+        io.write_results(result, tmp_path / "profile.nc")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < 10 * par.nbytes
+
+    with xr.open_dataset(tmp_path / "profile.nc") as written:
+        assert written.depth.attrs["positive"] == "down"
+        assert np.allclose(written.par_depth.isel(depth=10),
+                           par * np.exp(-0.05 * written.depth.values[10]))
@@ -1,9 +1,14 @@
 """Tests for snow and ice thickness distributions"""
+import pytest
 import numpy as np
 
+import beer_lambert_rt.distributions as distributions
 from beer_lambert_rt.distributions import (snow_depth_distribution,
                                            ice_thickness_distribution,
-                                           snow_ice_distribution)
+                                           snow_ice_distribution,
+                                           snow_depth_fractions,
+                                           snow_depth_fraction_field,
+                                           parse_snow_distribution)
 
 
 def test_snow_depth_distribution():
@@ -48,3 +53,66 @@ def test_snow_ice_distribution():
                                                 nbins_ice=nbins_ice,
                                                 max_factor_ice=factor_ice)
     assert np.allclose(prob.sum(), 1.)
+
+
+def test_snow_depth_fraction_field_shares_sets(monkeypatch):
+    """Cells with the same parameters share fractions, and each distinct set
+    is evaluated once across calls"""
+    distributions._snow_fraction_cache.clear()
+    evaluated = []
+    table = distributions.snow_fraction_table
+
+    def counted(nbins, factor, parameter_sets):
+        evaluated.append(len(parameter_sets))
+        return table(nbins, factor, parameter_sets)
+    monkeypatch.setattr(distributions, "snow_fraction_table", counted)
+
+    region = np.array([[0, 1, 1], [2, 0, 1]])
+    field = {"skewness": np.array([2.54, 1.8, 3.2])[region], "cv": 0.3}
+    fraction = snow_depth_fraction_field(7, 3., field)
+    assert fraction.shape == (2, 3, 7)
+    assert np.allclose(fraction.sum(axis=-1), 1.)
+    assert evaluated == [3]
+    assert np.array_equal(fraction[0, 0], fraction[1, 1])
+    assert not np.allclose(fraction[0, 0], fraction[0, 1])
+
+    snow_depth_fraction_field(7, 3., {"skewness": field["skewness"][:, :2], "cv": 0.3})
+    assert evaluated == [3]
+
+
+def test_snow_depth_fraction_field_cache_cleared_concurrently(monkeypatch):
+    """Sets found in the cache are kept if another thread clears it"""
+    distributions._snow_fraction_cache.clear()
+    snow_depth_fraction_field(7, 3., {"skewness": 2.54})
+    table = distributions.snow_fraction_table
+
+    def clearing(nbins, factor, parameter_sets):
+        distributions._snow_fraction_cache.clear()
+        return table(nbins, factor, parameter_sets)
+    monkeypatch.setattr(distributions, "snow_fraction_table", clearing)
+
+    fraction = snow_depth_fraction_field(7, 3., {"skewness": np.array([2.54, 1.8])})
+    assert np.allclose(fraction.sum(axis=-1), 1.)
+    assert np.allclose(fraction[0], table(7, 3., [[2.54, distributions.location,
+                                                    distributions.scale, distributions.cv]]))
+
+
+def test_snow_depth_fraction_field_matches_defaults():
+    fraction = snow_depth_fraction_field(7, 3., {"skewness": np.full(4, distributions.skewness)})
+    assert np.allclose(fraction, snow_depth_fractions(7, 3.), rtol=1e-12, atol=0.)
+    center, prob = snow_depth_distribution(np.full(4, 0.3), 7, 3., {"cv": [0.2, 0.417, 0.6, 0.8]})
+    assert center.shape == prob.shape == (4, 7)
+    # Wider distributions put more snow in the deepest bins
+    assert np.all(np.diff(prob[:, -1]) > 0.)
+
+
+@pytest.mark.parametrize("snow_distribution",
+                         [
+                             {"shape": 2.},
+                             {"scale": [1.5, 0.]},
+                             {"cv": -0.4},
+                             {"skewness": [2., np.nan]},
+                         ])
+def test_parse_snow_distribution_raises(snow_distribution):
+    with pytest.raises(ValueError):
+        parse_snow_distribution(snow_distribution)
@@ -0,0 +1,99 @@
+"""Tests for fused evaluation of transmittance and flux"""
+import pytest
+import numpy as np
+
+from conftest import make_inputs
+import beer_lambert_rt.fused as fused
+from beer_lambert_rt.model import run_model, flux_and_par_from_transmittance
+from beer_lambert_rt.parameters import Parameters, default_parameters
+from beer_lambert_rt.planner import plan_execution, fused_overhead
+from beer_lambert_rt.transmission import calculate_transmittance
+
+
+def make_columns():
+    """Returns snow-ice-pond columns of every surface type"""
+    rng = np.random.default_rng(1)
+    n = 1000
+    hice = rng.uniform(0.01, 2., n)
+    hsnow = np.where(rng.uniform(size=n) < 0.3, 0., rng.uniform(0., 0.1, n))
+    hpond = np.where((hsnow == 0.) & (rng.uniform(size=n) < 0.5), 0.2, 0.)
+    return hice, hsnow, hpond, rng.uniform(-5., 2., n)
+
+
+def evaluate_expression(expression, local_dict):
+    """Evaluates a numexpr expression with NumPy"""
+    return eval(expression, {"where": np.where, "exp": np.exp}, local_dict)
+
+
+@pytest.mark.parametrize("parameters", [None, Parameters(k_dry_snow=[6., 7., 8.])])
+def test_run_model_fused_numpy_matches_numpy(parameters):
+    inputs = make_inputs((3, 20, 30), static=True)
+    inputs[0][0, 0] = 0.
+    expected = run_model(*inputs, parameters=parameters, diagnostics=["quality"])
+    result = run_model(*inputs, parameters=parameters, diagnostics=["quality"],
+                       fused="numpy")
+    for value, expected_value in zip(result[:2], expected[:2]):
+        assert np.array_equal(value, expected_value, equal_nan=True)
+
+
+def test_evaluate_blocked_workers():
+    hice, hsnow, hpond, temperature = make_columns()
+    params = Parameters(k_ice=[1., 1.5]).append_axes(1)
+    expected = calculate_transmittance(hice, hsnow, hpond, temperature, params=params)
+    for workers in [1, 4]:
+        result = fused.evaluate_blocked(calculate_transmittance,
+                                        [hice, hsnow, hpond, temperature], params,
+                                        block_size=64, workers=workers)
+        assert np.array_equal(result, expected)
+
+
+def test_expressions_match_numpy():
+    hice, hsnow, hpond, temperature = make_columns()
+    params = dict(default_parameters.items())
+    transmittance = evaluate_expression(
+        fused.TRANSMITTANCE_EXPRESSION,
+        {"hice": hice, "hsnow": hsnow, "hpond": hpond, "surface_temperature": temperature,
+         "nan": np.nan, **params})
+    expected = calculate_transmittance(hice, hsnow, hpond, temperature)
+    assert np.allclose(transmittance, expected, rtol=1e-12)
+
+    albedo, surface_flux, sea_ice_concentration = 0.8, 250., np.linspace(0.1, 1., hice.size)
+    local_dict = {"transmittance": transmittance, "albedo": albedo,
+                  "surface_flux": surface_flux,
+                  "sea_ice_concentration": sea_ice_concentration, **params}
+    flux, par = flux_and_par_from_transmittance(expected, albedo, surface_flux,
+                                                sea_ice_concentration)
+    assert np.allclose(evaluate_expression(fused.FLUX_EXPRESSION, local_dict), flux,
+                       rtol=1e-12)
+    assert np.allclose(evaluate_expression(fused.PAR_EXPRESSION, local_dict), par,
+                       rtol=1e-12)
+
+
+def test_run_model_numexpr_matches_numpy():
+    pytest.importorskip("numexpr")
+    inputs = make_inputs((3, 20, 30), static=True)
+    params = Parameters(k_dry_snow=[6., 7.])
+    expected_flux, expected_par = run_model(*inputs, parameters=params)
+    flux, par = run_model(*inputs, parameters=params, fused="numexpr")
+    assert np.allclose(flux, expected_flux, rtol=1e-10, equal_nan=True)
+    assert np.allclose(par, expected_par, rtol=1e-10, equal_nan=True)
+
+
+def test_fused_plan_has_larger_chunks_within_budget():
+    max_memory = fused_overhead() + 8 * 1000**2
+    plan = plan_execution((100, 200), max_memory=max_memory)
+    fused_plan = plan_execution((100, 200), max_memory=max_memory, fused=True)
+    assert fused_plan.chunk_size > plan.chunk_size
+    assert fused_plan.estimated_peak <= max_memory
+    # The block temporaries of each thread are counted in the estimate
+    fixed = [p.estimated_peak - p.chunk_size * p.bytes_per_cell for p in [plan, fused_plan]]
+    assert fixed[1] - fixed[0] == fused_overhead()
+
+    inputs = make_inputs((100, 200), static=True)
+    run_model(*inputs, plan=fused_plan, fused="numpy")
+    assert fused_plan.observed_peak < max_memory
+
+
+def test_get_backend_unknown_raises():
+    with pytest.raises(ValueError):
+        fused.get_backend("numba")
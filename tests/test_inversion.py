@@ -0,0 +1,83 @@
+"""Tests for retrieval of snow depth and ice thickness from observed light"""
+import pytest
+import numpy as np
+
+from beer_lambert_rt.inversion import invert
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.parameters import Parameters
+
+
+def random_inputs(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return {"ice_thickness": rng.uniform(0.2, 3., shape),
+            "snow_depth": rng.uniform(0., 0.6, shape),
+            "albedo": rng.uniform(0.5, 0.9, shape),
+            "sw_radiation": rng.uniform(50., 300., shape),
+            "skin_temperature": rng.uniform(-10., 2., shape),
+            "sea_ice_concentration": rng.uniform(0.5, 1., shape)}
+
+
+@pytest.mark.parametrize("solve_for", ["snow_depth", "ice_thickness"])
+@pytest.mark.parametrize("observable", ["sw_flux", "par"])
+def test_invert_reproduces_observations(solve_for, observable):
+    """Checks retrieved values reproduce the observed flux or PAR.  Retrieved
+    values need not equal the inputs because transmittance is not monotonic
+    everywhere."""
+    inputs = random_inputs((20, 30))
+    flux, par = run_model(*inputs.values())
+    observed = flux if observable == "sw_flux" else par
+
+    result = invert(observed, **{**inputs, solve_for: None},
+                    solve_for=solve_for, observable=observable)
+    assert result.solution.shape == (20, 30)
+    assert result.converged.all()
+    assert result.iterations.max() <= 20
+
+    retrieved = run_model(*{**inputs, solve_for: result.solution}.values())
+    assert np.allclose(retrieved[0 if observable == "sw_flux" else 1], observed, atol=1e-3)
+
+
+def test_invert_dry_snow_recovers_snow_depth():
+    """Flux decreases monotonically with dry snow depth, so the snow depth is
+    recovered"""
+    inputs = random_inputs(200, seed=1)
+    inputs["snow_depth"] = np.random.default_rng(2).uniform(0.05, 0.6, 200)
+    inputs["skin_temperature"] = np.full(200, -5.)
+    flux, _ = run_model(*inputs.values())
+    result = invert(flux, **{**inputs, "snow_depth": None})
+    assert np.allclose(result.solution, inputs["snow_depth"], atol=1e-4)
+
+
+def test_invert_broadcasts_and_flags_unreachable():
+    """Checks scalar inputs are broadcast and observations that cannot be
+    reproduced are not converged"""
+    observed = np.array([5., 1000., np.nan])
+    result = invert(observed, 1.5, None, 0.8, 200., -5., 1.)
+    assert result.converged.tolist() == [True, False, False]
+    assert np.isfinite(result.solution[0])
+    assert np.isnan(result.solution[1:]).all()
+
+
+def test_invert_skips_invalid_cells():
+    """Checks cells with invalid inputs are not solved and do not fail the
+    other cells"""
+    inputs = random_inputs(4)
+    flux, _ = run_model(*inputs.values())
+    inputs["ice_thickness"][1] = 0.
+    inputs["sea_ice_concentration"][2] = 0.
+    inputs["albedo"][3] = np.nan
+    result = invert(flux, **{**inputs, "snow_depth": None})
+    assert result.converged.tolist() == [True, False, False, False]
+    assert np.isnan(result.solution[1:]).all()
+    assert (result.iterations[1:] == 0).all()
+    assert result.quality[0] == 0 and (result.quality[1:] > 0).all()
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"solve_for": "albedo"}, {"observable": "albedo"}, {"bounds": (1., 0.)},
+     {"parameters": Parameters(k_dry_snow=[6., 7.])}],
+)
+def test_invert_raises(kwargs):
+    with pytest.raises(ValueError):
+        invert(5., 1.5, None, 0.8, 200., -5., 1., **kwargs)
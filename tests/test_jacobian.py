@@ -0,0 +1,123 @@
+"""Tests for analytic derivatives of flux and PAR"""
+from dataclasses import replace
+
+import pytest
+import numpy as np
+
+from beer_lambert_rt.jacobian import (calculate_flux_and_par_jacobian, parse_wrt,
+                                      JACOBIAN_INPUTS, JACOBIAN_PARAMETERS)
+from beer_lambert_rt.model import calculate_flux_and_par, run_model
+from beer_lambert_rt.parameters import Parameters
+
+
+# Inputs chosen away from surface type boundaries: thick ice with dry snow,
+# thin ice with wet snow, bare ice and thin ice with a thin wet snow cover
+INPUTS = [
+    np.array([1.5, 0.6, 1.2, 0.3]),
+    np.array([0.3, 0.2, 0., 0.025]),
+    np.array([0.8, 0.7, 0.6, 0.65]),
+    np.array([200., 150., 250., 180.]),
+    np.array([-5., 0.5, -3., 0.5]),
+    np.array([0.9, 0.8, 1., 0.95]),
+    np.zeros(4),
+    np.zeros(4),
+    ]
+INPUT_INDEX = {"ice_thickness": 0, "snow_depth": 1, "albedo": 2,
+               "sw_radiation": 3, "sea_ice_concentration": 5}
+
+
+def finite_difference(name, use_distribution, step=1e-6):
+    """Returns central finite difference derivatives of flux and par"""
+    results = []
+    for sign in [1., -1.]:
+        inputs = [x.copy() for x in INPUTS]
+        params = Parameters()
+        if name in INPUT_INDEX:
+            inputs[INPUT_INDEX[name]] += sign * step
+        else:
+            params = replace(params, **{name: getattr(params, name) + sign * step})
+        results.append(calculate_flux_and_par(*inputs, use_distribution=use_distribution,
+                                              params=params))
+    return [(plus - minus) / (2 * step) for plus, minus in zip(*results)]
+
+
+@pytest.mark.parametrize("use_distribution", [True, False])
+@pytest.mark.parametrize("name", JACOBIAN_INPUTS + JACOBIAN_PARAMETERS)
+def test_jacobian_matches_finite_difference(name, use_distribution):
+    flux, par, derivatives = calculate_flux_and_par_jacobian(
+        *INPUTS, wrt=[name], use_distribution=use_distribution)
+    expected_flux, expected_par = calculate_flux_and_par(
+        *INPUTS, use_distribution=use_distribution)
+    assert np.allclose(flux, expected_flux)
+    assert np.allclose(par, expected_par)
+
+    dflux, dpar = finite_difference(name, use_distribution)
+    # Snow depth cannot be perturbed below zero for bare ice
+    valid = np.isfinite(dflux)
+    assert valid.sum() >= 3
+    assert np.allclose(derivatives[f"dflux_d{name}"][valid], dflux[valid],
+                       rtol=1e-5, atol=1e-6)
+    assert np.allclose(derivatives[f"dpar_d{name}"][valid], dpar[valid],
+                       rtol=1e-5, atol=1e-6)
+
+
+def test_parse_wrt_raises():
+    with pytest.raises(ValueError):
+        parse_wrt(["skin_temperature"])
+
+
+def test_run_model_jacobian():
+    """Checks run_model returns derivatives with the shape of the outputs,
+    including for chunked runs and parameter ensembles"""
+    shape = (2, 2)
+    inputs = [x[:4].reshape(shape) for x in INPUTS[:6]]
+    params = Parameters(k_dry_snow=[6., 7., 8.])
+    flux, par, extras = run_model(*inputs, parameters=params,
+                                  jacobian=["snow_depth", "k_dry_snow"])
+    assert set(extras) == {"dflux_dsnow_depth", "dpar_dsnow_depth",
+                           "dflux_dk_dry_snow", "dpar_dk_dry_snow"}
+    assert all(arr.shape == (3,) + shape for arr in extras.values())
+
+    _, _, chunked = run_model(*inputs, parameters=params, max_memory="1MB",
+                              jacobian=["snow_depth", "k_dry_snow"])
+    for name, arr in extras.items():
+        assert np.allclose(chunked[name], arr)
+
+
+def test_run_model_uncertainty_matches_delta_method():
+    inputs = INPUTS[:6]
+    std = {"ice_thickness": 0.1 * inputs[0], "snow_depth": 0.02, "k_dry_snow": 0.5}
+    flux, par, extras = run_model(*inputs, uncertainty=std, max_memory="1MB")
+    assert set(extras) == {"flux_std", "par_std"}
+    _, _, derivatives = run_model(*inputs, jacobian=list(std))
+    expected = np.sqrt(sum((derivatives[f"dpar_d{name}"] * value) ** 2
+                           for name, value in std.items()))
+    assert np.allclose(extras["par_std"], expected)
+
+
+def test_run_model_uncertainty_matches_monte_carlo():
+    """Checks the delta method against sampling for small input errors on
+    cells away from surface type boundaries"""
+    rng = np.random.default_rng(0)
+    nsample = 4000
+    inputs = [x[:2] for x in INPUTS[:6]]
+    std = {"ice_thickness": 0.05, "snow_depth": 0.01, "sea_ice_concentration": 0.02}
+    _, _, extras = run_model(*inputs, uncertainty=std)
+
+    samples = [np.broadcast_to(x, (nsample, 2)).copy() for x in inputs]
+    for name, value in std.items():
+        samples[INPUT_INDEX[name]] += rng.normal(0., value, (nsample, 2))
+    flux, par = run_model(*samples, max_memory="100MB")
+    assert np.allclose(par.std(axis=0), extras["par_std"], rtol=0.05)
+    assert np.allclose(flux.std(axis=0), extras["flux_std"], rtol=0.05)
+
+
+@pytest.mark.parametrize("uncertainty",
+                         [
+                             {"skin_temperature": 1.},
+                             {"k_dry_snow": [0.5, 1.]},
+                             {"snow_depth": -0.1},
+                         ])
+def test_run_model_uncertainty_raises(uncertainty):
+    with pytest.raises(ValueError):
+        run_model(*INPUTS[:6], uncertainty=uncertainty)
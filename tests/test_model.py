@@ -0,0 +1,128 @@
+"""Tests for run_model broadcasting and diagnostics"""
+from pathlib import Path
+
+import pytest
+import numpy as np
+
+from beer_lambert_rt.io import make_netcdf
+from beer_lambert_rt.model import run_model, parse_diagnostics, DIAGNOSTICS
+from beer_lambert_rt.parameters import Parameters
+from beer_lambert_rt.transmission import (modify_albedo, transmission_open_water,
+                                          SURFACE_TYPE_FLAG_MEANINGS)
+
+
+SHAPE = (2, 3)
+INPUTS = [
+    np.array([1.5, 0.6, 1.2, 0.3, 0.05, 2.]).reshape(SHAPE),
+    np.array([0.3, 0.2, 0., 0.01, 0., 0.4]).reshape(SHAPE),
+    np.array([0.8, 0.7, 0.6, 0.65, 0.5, 0.85]).reshape(SHAPE),
+    np.array([200., 150., 250., 180., 300., 0.]).reshape(SHAPE),
+    np.array([-5., 0.5, -3., 0.5, -1., -20.]).reshape(SHAPE),
+    np.array([0.9, 0.8, 1., 0.95, 0.7, 1.]).reshape(SHAPE),
+    ]
+
+
+@pytest.mark.parametrize("max_memory", [None, "300KB"])
+def test_run_model_broadcasts_static_ice(max_memory):
+    """Checks (y, x) ice thickness and snow depth with (time, y, x) forcing
+    matches inputs repeated for each time step"""
+    rng = np.random.default_rng(0)
+    forcing = [rng.uniform(0.5, 1., (4,) + SHAPE) * x for x in INPUTS[2:]]
+    params = Parameters(k_dry_snow=[6., 7.])
+    flux, par, extras = run_model(INPUTS[0], INPUTS[1], *forcing, parameters=params,
+                                  jacobian=["ice_thickness"], diagnostics=True,
+                                  max_memory=max_memory)
+    assert flux.shape == (2, 4) + SHAPE
+
+    repeated = [np.broadcast_to(x, (4,) + SHAPE).copy() for x in INPUTS[:2]]
+    expected_flux, expected_par, expected = run_model(
+        *repeated, *forcing, parameters=params, jacobian=["ice_thickness"],
+        diagnostics=True)
+    assert np.allclose(flux, expected_flux)
+    assert np.allclose(par, expected_par)
+    for name, value in expected.items():
+        assert np.allclose(extras[name], value)
+
+
+def test_run_model_broadcasts_scalars():
+    flux, par = run_model(*INPUTS[:3], 100., -5., 1.)
+    expected_flux, expected_par = run_model(*INPUTS[:3], *[np.full(SHAPE, x)
+                                                          for x in [100., -5., 1.]])
+    assert flux.shape == SHAPE
+    assert np.allclose(flux, expected_flux)
+
+
+def test_run_model_mismatched_shapes_raises():
+    with pytest.raises(ValueError):
+        run_model(INPUTS[0], INPUTS[1][:1, :2], *INPUTS[2:])
+
+
+def test_parse_diagnostics():
+    assert parse_diagnostics(True) == DIAGNOSTICS
+    assert parse_diagnostics("ice_albedo") == ["ice_albedo"]
+    with pytest.raises(ValueError):
+        parse_diagnostics(["snow_albedo"])
+
+
+@pytest.mark.parametrize("max_memory", [None, "1MB"])
+def test_run_model_diagnostics(max_memory):
+    flux, par, extras = run_model(*INPUTS, diagnostics=True, max_memory=max_memory)
+    assert set(extras) == set(DIAGNOSTICS)
+    assert all(value.shape == SHAPE for value in extras.values())
+    assert extras["surface_type"].dtype == np.uint8
+    assert ([SURFACE_TYPE_FLAG_MEANINGS[v] for v in extras["surface_type"].ravel()] ==
+            ["dry_snow", "wet_snow", "bare_ice", "thin_wet_snow",
+             "thin_bare_ice", "dry_snow"])
+
+    ice_albedo = modify_albedo(INPUTS[2], INPUTS[5])
+    assert np.allclose(extras["ice_albedo"], ice_albedo)
+    assert np.allclose(extras["open_water_fraction"], 1. - INPUTS[5])
+    # Flux is the area weighted sum of flux through ice and open water
+    expected = INPUTS[3] * (INPUTS[5] * (1. - ice_albedo) * extras["ice_transmittance"] +
+                            (1. - INPUTS[5]) * transmission_open_water())
+    assert np.allclose(flux, expected)
+
+
+def test_make_netcdf_diagnostic_attrs():
+    flux, par, extras = run_model(*INPUTS, diagnostics=["surface_type", "ice_albedo"])
+    ds = make_netcdf(flux, par, ("y", "x"), {}, Path("test.nc"), extras=extras)
+    attrs = ds.surface_type.attrs
+    assert attrs["flag_meanings"].split() == SURFACE_TYPE_FLAG_MEANINGS
+    assert list(attrs["flag_values"]) == list(range(len(SURFACE_TYPE_FLAG_MEANINGS)))
+    assert ds.ice_albedo.attrs["units"] == "1"
+
+
+@pytest.mark.parametrize("max_memory", [None, "200KB"])
+def test_run_model_snow_distribution_fields(max_memory):
+    """Regions with different snow distributions match runs of each region"""
+    rng = np.random.default_rng(0)
+    shape = (3, 8, 9)
+    region = rng.integers(0, 2, shape[1:])
+    ice_thickness = rng.uniform(0.5, 2.5, shape[1:])
+    snow_depth = rng.uniform(0.05, 0.5, shape[1:])
+    sw_radiation = rng.uniform(0., 300., shape)
+    skewness, cv = np.array([2.54, 1.5])[region], np.array([0.417, 0.6])[region]
+    flux, par = run_model(ice_thickness, snow_depth, 0.7, sw_radiation, -5., 0.9,
+                          snow_distribution={"skewness": skewness, "cv": cv},
+                          max_memory=max_memory)
+    for value in range(2):
+        cells = region == value
+        expected = run_model(ice_thickness[cells], snow_depth[cells], 0.7,
+                             sw_radiation[:, cells], -5., 0.9,
+                             snow_distribution={"skewness": skewness[cells][0],
+                                                "cv": cv[cells][0]})
+        assert np.allclose(par[:, cells], expected[1])
+    default = run_model(ice_thickness, snow_depth, 0.7, sw_radiation, -5., 0.9)
+    assert np.allclose(par[:, region == 0], default[1][:, region == 0])
+    assert not np.allclose(par[:, region == 1], default[1][:, region == 1])
+
+    # Parameters that change with time are not shared by time steps
+    varying = run_model(ice_thickness, snow_depth, 0.7, sw_radiation, -5., 0.9,
+                        snow_distribution={"cv": np.array([0.417, 0.6, 0.3])[:, None, None]},
+                        max_memory=max_memory)
+    assert np.allclose(varying[1][0], default[1][0])
+    assert not np.allclose(varying[1][1], default[1][1])
+
+    with pytest.raises(ValueError):
+        run_model(ice_thickness, snow_depth, 0.7, 200., -5., 0.9,
+                  snow_distribution={"cv": np.full((2, 8, 9), 0.4)})
@@ -0,0 +1,84 @@
+"""Tests for packed integer encoding of output variables"""
+from pathlib import Path
+
+import pytest
+import numpy as np
+import xarray as xr
+
+import beer_lambert_rt.io as io
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.packing import (packing_params, check_packing, make_encoding,
+                                     PACKING_RANGES, DEFAULT_PRECISION)
+
+
+@pytest.mark.parametrize("valid_min,valid_max,precision,dtype",
+                         [
+                             (0., 1400., 0.05, "uint16"),
+                             (-10., 10., 1e-3, "int16"),
+                         ])
+def test_packing_params_round_trip(valid_min, valid_max, precision, dtype):
+    params = packing_params(valid_min, valid_max, precision)
+    assert params["dtype"] == dtype
+    values = np.linspace(valid_min, valid_max, 100001)
+    assert check_packing(values, params, precision) <= precision / 2 + 1e-9
+
+
+def test_packing_params_precision_too_fine_raises():
+    with pytest.raises(ValueError):
+        packing_params(0., 1400., 0.01)
+
+
+def test_check_packing_out_of_range_raises():
+    params = packing_params(0., 1., 1e-4)
+    with pytest.raises(ValueError):
+        check_packing(np.array([0.5, 10.]), params, 1e-4)
+
+
+def test_packed_netcdf_round_trip(tmp_path):
+    """Checks packed flux, par and diagnostics read back within precision"""
+    rng = np.random.default_rng(0)
+    shape = (3, 60, 80)
+    flux, par, extras = run_model(rng.uniform(0.2, 3., shape),
+                                  rng.uniform(0., 0.5, shape),
+                                  rng.uniform(0.5, 0.9, shape),
+                                  rng.uniform(0., 400., shape),
+                                  rng.uniform(-20., 1., shape),
+                                  rng.uniform(0.5, 1., shape),
+                                  diagnostics=True)
+    flux[0, 0, 0] = np.nan
+    result = io.make_netcdf(flux, par, ("time", "y", "x"), {}, Path("test.nc"),
+                            extras=extras)
+    encoding = make_encoding(result)
+    outpath = tmp_path / "packed.nc"
+    io.write_results(result, outpath, encoding=encoding)
+
+    with xr.open_dataset(outpath, mask_and_scale=False) as raw:
+        assert raw.sw_flux.dtype == np.uint16
+        assert raw.surface_type.dtype == np.uint8
+    with xr.open_dataset(outpath) as packed:
+        assert np.isnan(packed.sw_flux.values[0, 0, 0])
+        assert packed.sw_flux.encoding["chunksizes"] == (1, 60, 80)
+        assert packed.sw_flux.encoding["zlib"]
+        for name in PACKING_RANGES:
+            error = np.nanmax(np.abs(packed[name].values - result[name].values))
+            assert error <= DEFAULT_PRECISION[name]
+        assert np.array_equal(packed.surface_type.values, result.surface_type.values)
+    io.write_results(result, tmp_path / "float.nc")
+    assert outpath.stat().st_size < (tmp_path / "float.nc").stat().st_size / 2
+
+
+def test_packed_netcdf_low_concentration(tmp_path):
+    """Checks cells with little sea ice, whose derived ice albedo is outside
+    0 to 1, are written"""
+    flux, par, extras = run_model(np.full(3, 1.5), np.array([0.2, 0.2, 0.]),
+                                  np.array([0.03, 0.9, 0.9]), np.full(3, 200.),
+                                  np.full(3, -5.), np.array([0.2, 0.05, 0.05]),
+                                  diagnostics=True)
+    assert (extras["quality"] == 0).all()
+    assert extras["ice_albedo"].min() < 0. and extras["ice_albedo"].max() > 1.
+    result = io.make_netcdf(flux, par, ("index",), {}, Path("test.nc"), extras=extras)
+    outpath = tmp_path / "packed.nc"
+    io.write_results(result, outpath, encoding=make_encoding(result))
+    with xr.open_dataset(outpath) as packed:
+        assert np.array_equal(packed.ice_albedo.values, extras["ice_albedo"])
+        assert np.abs(packed.sw_flux.values - flux).max() <= DEFAULT_PRECISION["sw_flux"]
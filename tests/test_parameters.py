@@ -0,0 +1,51 @@
+"""Tests for model parameters and parameter ensembles"""
+import pytest
+import numpy as np
+
+from beer_lambert_rt.parameters import Parameters
+from beer_lambert_rt.model import run_model
+import beer_lambert_rt.constants as constants
+
+
+def test_default_parameters():
+    """Checks defaults are taken from constants"""
+    params = Parameters()
+    for name, value in params.items():
+        assert value == getattr(constants, name)
+    assert params.ensemble_size is None
+
+
+def test_parameters_frozen():
+    params = Parameters()
+    with pytest.raises(AttributeError):
+        params.k_ice = 2.
+
+
+def test_ensemble_size_mismatch():
+    with pytest.raises(ValueError):
+        Parameters(k_ice=[1., 2.], k_dry_snow=[5., 6., 7.])
+
+
+@pytest.mark.parametrize("use_distribution", [True, False])
+def test_run_model_ensemble(use_distribution):
+    """Checks each member of an ensemble run matches a run with
+    the member's parameters"""
+    rng = np.random.default_rng(0)
+    shape = (4, 5)
+    inputs = (rng.uniform(0.2, 3., shape),
+              rng.uniform(0.01, 0.5, shape),
+              rng.uniform(0.5, 0.9, shape),
+              rng.uniform(50., 300., shape),
+              rng.uniform(-10., 2., shape),
+              rng.uniform(0.5, 1., shape))
+    params = Parameters(k_dry_snow=np.linspace(5., 9., 6),
+                        i0_wet_snow=np.linspace(0.3, 0.6, 6),
+                        underice_flux2par=3.)
+    flux, par = run_model(*inputs, parameters=params,
+                          use_distribution=use_distribution)
+    assert flux.shape == (6,) + shape
+    for i in range(params.ensemble_size):
+        expected_flux, expected_par = run_model(*inputs, parameters=params.member(i),
+                                                use_distribution=use_distribution)
+        assert np.allclose(flux[i], expected_flux)
+        assert np.allclose(par[i], expected_par)
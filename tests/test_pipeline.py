@@ -0,0 +1,169 @@
+"""Tests for the config-driven pipeline"""
+import datetime as dt
+import json
+
+import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import beer_lambert_rt.pipeline as pipeline
+from beer_lambert_rt.pipeline import PipelineConfig, load_config, run_pipeline, load_inputs
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.tables import MODEL_INPUTS
+from beer_lambert_rt.trajectory import ease_grid_north
+
+
+START = dt.date(2020, 3, 30)
+END = dt.date(2020, 4, 1)
+
+# Target grid coordinates in meters
+GRID_Y = np.linspace(1e6, -1e6, 10)
+GRID_X = np.linspace(-1.2e6, 1.2e6, 12)
+
+
+def make_sources(root):
+    """Writes a target grid and source files for START to END, and returns
+    the config as a dict"""
+    rng = np.random.default_rng(0)
+    xr.Dataset(coords={"y": GRID_Y, "x": GRID_X}).to_netcdf(root / "grid.nc")
+
+    # Daily files on the target grid
+    for date in pd.date_range(START, END):
+        shape = (1, GRID_Y.size, GRID_X.size)
+        xr.Dataset(
+            {
+                "alb": (("time", "y", "x"), rng.uniform(0.5, 0.9, shape)),
+                "swdn": (("time", "y", "x"), rng.uniform(50., 300., shape)),
+                "tskin": (("time", "y", "x"), rng.uniform(253., 274., shape)),
+            },
+            coords={"time": [date + pd.Timedelta(hours=12)], "y": GRID_Y, "x": GRID_X},
+        ).to_netcdf(root / f"appx_{date:%Y%m%d}.nc")
+
+    # A yearly file of ice thickness on a coarser grid
+    src_y = np.linspace(1.5e6, -1.5e6, 7)
+    src_x = np.linspace(-1.5e6, 1.5e6, 8)
+    times = pd.date_range("2020-01-01", "2020-12-31")
+    xr.Dataset(
+        {"sit": (("time", "y", "x"), rng.uniform(0.5, 3., (times.size, 7, 8)))},
+        coords={"time": times, "y": src_y, "x": src_x},
+    ).to_netcdf(root / "sit_2020.nc")
+
+    # Static snow depth on a latitude and longitude grid
+    lat, lon = np.meshgrid(np.linspace(70., 90., 30), np.linspace(-180., 180., 60),
+                           indexing="ij")
+    xr.Dataset({"snod": (("j", "i"), rng.uniform(0., 0.4, lat.shape)),
+                "lat": (("j", "i"), lat), "lon": (("j", "i"), lon)}
+               ).to_netcdf(root / "snow.nc")
+
+    return {
+        "start": START.isoformat(),
+        "end": END.isoformat(),
+        "grid": {"path": "grid.nc"},
+        "sources": {
+            "ice_thickness": {"path": "sit_{date:%Y}.nc", "variable": "sit",
+                              "regrid": "bilinear"},
+            "snow_depth": {"path": "snow.nc", "variable": "snod", "regrid": "nearest"},
+            "albedo": {"path": "appx_{date:%Y%m%d}.nc", "variable": "alb"},
+            "sw_radiation": {"path": "appx_{date:%Y%m%d}.nc", "variable": "swdn"},
+            "surface_temperature": {"path": "appx_{date:%Y%m%d}.nc", "variable": "tskin",
+                                    "offset": -273.15},
+            "sea_ice_concentration": {"value": 0.9},
+        },
+        "output": {"path": "out/par_{date:%Y%m}.nc", "period": "month"},
+        "cache": "cache",
+    }
+
+
+def write_config(root, values):
+    with open(root / "run.json", "w") as f:
+        json.dump(values, f)
+    return load_config(root / "run.json")
+
+
+def test_run_pipeline_matches_run_model(tmp_path):
+    config = write_config(tmp_path, make_sources(tmp_path))
+    written = run_pipeline(config)
+    assert [path.name for path in written] == ["par_202003.nc", "par_202004.nc"]
+
+    grid = (GRID_Y, GRID_X)
+    with xr.open_dataset(written[0]) as march:
+        assert march.par.shape == (2, GRID_Y.size, GRID_X.size)
+        for i, date in enumerate([START, START + dt.timedelta(days=1)]):
+            inputs = load_inputs(config, date, grid)
+            flux, par = run_model(*[inputs[name] for name in MODEL_INPUTS])
+            assert np.allclose(march.par.values[i], par, equal_nan=True)
+    assert np.allclose(inputs["surface_temperature"],
+                       xr.load_dataset(tmp_path / f"appx_{date:%Y%m%d}.nc").tskin[0] - 273.15)
+
+
+def test_regrid_bilinear_and_nearest(tmp_path):
+    config = write_config(tmp_path, make_sources(tmp_path))
+    inputs = load_inputs(config, START, (GRID_Y, GRID_X))
+    with xr.open_dataset(tmp_path / "sit_2020.nc") as ds:
+        expected = ds.sit.sel(time=str(START)).squeeze().interp(y=GRID_Y, x=GRID_X).values
+    assert np.allclose(inputs["ice_thickness"], expected)
+
+    with xr.open_dataset(tmp_path / "snow.nc") as ds:
+        src_x, src_y = ease_grid_north(ds.lat.values, ds.lon.values)
+        snod = ds.snod.values
+    xx, yy = np.meshgrid(GRID_X, GRID_Y)
+    distance = (src_x.reshape(-1, 1) - xx.reshape(-1)) ** 2 + \
+        (src_y.reshape(-1, 1) - yy.reshape(-1)) ** 2
+    expected = snod.reshape(-1)[np.argmin(distance, axis=0)].reshape(xx.shape)
+    assert np.array_equal(inputs["snow_depth"], expected)
+
+
+def test_rerun_with_new_model_options_uses_cache(tmp_path, monkeypatch):
+    values = make_sources(tmp_path)
+    run_pipeline(write_config(tmp_path, values))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("source loaded despite cache")
+    monkeypatch.setattr(pipeline, "load_source", fail)
+    values["model"] = {"use_distribution": False, "diagnostics": ["ice_transmittance"]}
+    values["output"]["reduce"] = "mean"
+    written = run_pipeline(write_config(tmp_path, values))
+    with xr.open_dataset(written[0]) as march:
+        assert march.par.shape == (1, GRID_Y.size, GRID_X.size)
+        assert "ice_transmittance" in march
+
+    # A changed source file invalidates cached dates
+    path = tmp_path / f"appx_{START:%Y%m%d}.nc"
+    xr.load_dataset(path).to_netcdf(path)
+    with pytest.raises(AssertionError):
+        run_pipeline(write_config(tmp_path, values))
+
+
+@pytest.mark.parametrize("reduce,expected", [("mean", 2.), ("min", 1.), ("max", 3.)])
+def test_reduce_period_skips_masked_days(reduce, expected):
+    days = [{"par": np.array([[value, np.nan]]), "quality": np.array([[0, flags]], np.uint8)}
+            for value, flags in [(1., 1), (np.nan, 4), (3., 4)]]
+    days[1]["quality"][..., 0] = 2
+    outputs = pipeline.reduce_period(days, reduce)
+    assert outputs["par"][..., 0] == expected
+    assert np.isnan(outputs["par"][..., 1])
+    assert outputs["quality"].dtype == np.uint8
+    assert outputs["quality"].tolist() == [[[2, 5]]]
+
+
+def test_run_pipeline_workers_match_serial(tmp_path):
+    config = write_config(tmp_path, {**make_sources(tmp_path), "cache": None})
+    serial = [xr.load_dataset(path) for path in run_pipeline(config)]
+    concurrent = [xr.load_dataset(path) for path in run_pipeline(config, workers=2)]
+    for expected, result in zip(serial, concurrent):
+        assert np.array_equal(expected.par.values, result.par.values, equal_nan=True)
+        assert np.array_equal(expected.time.values, result.time.values)
+
+
+@pytest.mark.parametrize("change",
+                         [
+                             {"end": "2020-03-01"},
+                             {"model": {"max_snow_factor": 2.}},
+                             {"output": {"path": "out.nc", "period": "week"}},
+                             {"output": {"path": "out.nc", "reduce": "median"}},
+                         ])
+def test_invalid_config_raises(tmp_path, change):
+    values = {**make_sources(tmp_path), **change}
+    with pytest.raises(ValueError):
+        PipelineConfig(**values)
@@ -0,0 +1,70 @@
+"""Tests for memory-budgeted execution planning"""
+import pytest
+import numpy as np
+
+from beer_lambert_rt.planner import parse_memory, plan_execution
+from beer_lambert_rt.model import run_model
+
+
+@pytest.mark.parametrize(
+    "max_memory,expected",
+    [("4GB", 4_000_000_000), ("512 MiB", 512 * 1024**2),
+     ("1.5e6", 1_500_000), (1024, 1024)],
+)
+def test_parse_memory(max_memory, expected):
+    assert parse_memory(max_memory) == expected
+
+
+def test_parse_memory_raises():
+    with pytest.raises(ValueError):
+        parse_memory("4 parsecs")
+
+
+def test_plan_covers_grid():
+    """Checks chunks cover every cell exactly once"""
+    plan = plan_execution((50, 40), max_memory="2MB")
+    assert plan.nchunks > 1
+    covered = np.zeros(plan.ncell, dtype=int)
+    for chunk in plan.chunks():
+        covered[chunk] += 1
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize("max_memory", ["2MB", "500KB"])
+def test_plan_blocks_cover_grid(max_memory):
+    """Checks blocks of repeated rows cover every cell exactly once"""
+    plan = plan_execution((12, 50, 40), max_memory=max_memory, repeats=12)
+    covered = np.zeros((12, 2000), dtype=int)
+    nblocks = 0
+    for rows, cols in plan.blocks():
+        assert (rows.stop - rows.start) * (cols.stop - cols.start) <= plan.chunk_size
+        covered[rows, cols] += 1
+        nblocks += 1
+    assert (covered == 1).all()
+    assert nblocks == plan.nchunks
+
+
+def test_plan_budget_too_small():
+    with pytest.raises(ValueError):
+        plan_execution((361, 361), max_memory="1MB")
+
+
+def test_run_model_with_plan():
+    """Checks chunked results match a single pass and peak memory is
+    within the budget"""
+    rng = np.random.default_rng(0)
+    shape = (40, 30)
+    inputs = (rng.uniform(0.2, 3., shape),
+              rng.uniform(0.01, 0.5, shape),
+              rng.uniform(0.5, 0.9, shape),
+              rng.uniform(50., 300., shape),
+              rng.uniform(-10., 2., shape),
+              rng.uniform(0.5, 1., shape))
+    expected_flux, expected_par = run_model(*inputs)
+
+    plan = plan_execution(shape, max_memory="2MB")
+    flux, par = run_model(*inputs, plan=plan)
+    assert plan.nchunks > 1
+    assert np.allclose(flux, expected_flux)
+    assert np.allclose(par, expected_par)
+    assert 0 < plan.observed_peak <= plan.max_memory
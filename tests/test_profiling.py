@@ -0,0 +1,46 @@
+"""Tests for per-stage memory profiling"""
+from pathlib import Path
+
+import numpy as np
+
+from beer_lambert_rt.io import make_global_attrs
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.planner import PeakMemory
+from beer_lambert_rt.profiling import MemoryProfiler, stage
+
+
+def test_nested_peak_memory():
+    """Checks the peak of an inner context is seen by the outer context"""
+    with PeakMemory() as outer:
+        with PeakMemory() as inner:
+            x = np.ones(1_000_000)
+            del x
+        y = np.ones(10)
+    assert inner.peak >= 8_000_000
+    assert outer.peak >= inner.peak
+
+
+def test_stage_without_profiler():
+    with stage("load"):
+        pass
+
+
+def test_memory_profiler_records_model_stages():
+    shape = (50, 40)
+    with MemoryProfiler() as profiler:
+        with stage("load"):
+            inputs = [np.full(shape, value) for value in [1.5, 0.3, 0.8, 100., -5., 1.]]
+        run_model(*inputs, max_memory="4MB")
+    summary = profiler.summary()
+    assert set(summary) == {"load", "distribution", "transmittance"}
+    assert summary["distribution"]["calls"] == summary["transmittance"]["calls"] > 1
+    # One chunk of binned temporaries is much larger than the inputs
+    assert summary["transmittance"]["tracemalloc_peak_bytes"] > 100_000
+    assert summary["transmittance"]["tracemalloc_peak_bytes"] < 4_000_000
+
+
+def test_global_attrs_memory_profile():
+    memory_profile = {"load": {"tracemalloc_peak_bytes": 10, "rss_peak_bytes": None}}
+    attrs = make_global_attrs(Path("input.nc"), memory_profile=memory_profile)
+    assert attrs["peak_memory_load_tracemalloc_bytes"] == 10
+    assert "peak_memory_load_rss_bytes" not in attrs
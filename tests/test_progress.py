@@ -0,0 +1,61 @@
+"""Tests for progress reporting"""
+import io
+import json
+
+import pytest
+import numpy as np
+
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.planner import plan_execution
+from beer_lambert_rt.progress import ProgressReporter, PROGRESS_CHUNK_SIZE
+
+
+def run(progress, shape=(3, 100, 120)):
+    inputs = [np.full(shape, value) for value in [1.5, 0.3, 0.8, 100., -5., 1.]]
+    return run_model(*inputs, progress=progress)
+
+
+def test_json_progress():
+    stream = io.StringIO()
+    run(ProgressReporter(stream=stream, min_interval=0., time_steps=["a", "b", "c"]))
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    ntiles = -(-36000 // PROGRESS_CHUNK_SIZE)
+    assert len(events) == ntiles + 1
+    assert events[-1]["event"] == "finished"
+    assert events[-1]["cells_done"] == events[-1]["cells_total"] == 36000
+    assert events[-1]["tiles_done"] == ntiles
+    assert events[-1]["time_step"] == "c"
+    assert all(event["cells_per_second"] > 0 for event in events)
+
+
+def test_progress_frequency_is_bounded():
+    """Only the final report is written if the run is shorter than min_interval"""
+    stream = io.StringIO()
+    run(ProgressReporter(stream=stream, min_interval=3600.))
+    assert len(stream.getvalue().splitlines()) == 1
+
+
+def test_bar_progress():
+    stream = io.StringIO()
+    run(ProgressReporter(stream=stream, mode="bar", min_interval=0.))
+    assert stream.getvalue().rstrip().endswith("time 2")
+    assert "100.0%" in stream.getvalue()
+
+
+def test_skipped_tiles_are_not_counted_in_throughput():
+    progress = ProgressReporter(stream=io.StringIO())
+    progress.start(plan_execution((2, 100), max_chunk_size=50, repeats=2))
+    progress.skip((slice(0, 1), slice(0, 100)))
+    status = progress.status()
+    assert status["cells_done"] == 100 and status["tiles_done"] == 1
+    assert status["cells_per_second"] is None and status["eta_seconds"] is None
+    progress.update((slice(1, 2), slice(0, 50)))
+    status = progress.status(now=progress._start + 2.)
+    assert status["cells_done"] == 150
+    assert status["cells_per_second"] == 25.
+    assert status["eta_seconds"] == 2.
+
+
+def test_progress_mode_raises():
+    with pytest.raises(ValueError):
+        ProgressReporter(mode="html")
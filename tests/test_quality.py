@@ -0,0 +1,83 @@
+"""Tests for input validation and quality flags"""
+from pathlib import Path
+
+import pytest
+import numpy as np
+
+from beer_lambert_rt.io import make_netcdf
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.quality import (validate, quality_counts, MISSING_INPUT, OUT_OF_RANGE,
+                                     ZERO_ICE_THICKNESS, SNOW_ON_POND, NO_SEA_ICE)
+
+
+# Valid inputs of one cell
+CELL = [1.5, 0.2, 0.8, 200., -5., 0.9, 0., 0.]
+
+
+@pytest.mark.parametrize("index,value,expected",
+                         [
+                             (None, None, 0),
+                             (0, np.nan, MISSING_INPUT),
+                             (4, 260., OUT_OF_RANGE),
+                             (2, 1.2, OUT_OF_RANGE),
+                             (0, 0., ZERO_ICE_THICKNESS),
+                             (0, -1., OUT_OF_RANGE),
+                             (6, 0.1, SNOW_ON_POND),
+                             (5, 0., NO_SEA_ICE),
+                         ])
+def test_validate_flags(index, value, expected):
+    inputs = [np.array(x) for x in CELL]
+    if index is not None:
+        inputs[index] = np.array(value)
+    quality, cleaned = validate(inputs)
+    assert quality == expected
+    if index is None:
+        assert all(a is b for a, b in zip(cleaned, inputs))
+    else:
+        assert all(np.isfinite(cleaned))
+
+
+@pytest.mark.parametrize("max_memory", [None, "400KB"])
+def test_run_model_masks_invalid_cells(max_memory):
+    """Checks invalid cells of static ice are masked at every time step, and
+    valid cells match a run without them"""
+    rng = np.random.default_rng(0)
+    ice_thickness = rng.uniform(0.5, 2., (20, 30))
+    ice_thickness[3, 4] = 0.
+    ice_thickness[5, 6] = np.nan
+    sea_ice_concentration = rng.uniform(0.5, 1., (4, 20, 30))
+    sea_ice_concentration[2, 7, 8] = 0.
+    inputs = [ice_thickness, 0.2, rng.uniform(0.5, 0.9, (4, 20, 30)),
+              rng.uniform(0., 300., (4, 20, 30)), -5., sea_ice_concentration]
+    flux, par, extras = run_model(*inputs, diagnostics=["quality", "surface_type"],
+                                  jacobian=["snow_depth"], max_memory=max_memory)
+
+    quality = extras["quality"]
+    assert quality.shape == (4, 20, 30)
+    assert np.all(quality[:, 3, 4] == ZERO_ICE_THICKNESS)
+    assert np.all(quality[:, 5, 6] == MISSING_INPUT)
+    assert quality[2, 7, 8] == NO_SEA_ICE
+    invalid = quality > 0
+    assert invalid.sum() == 9
+    for value in [flux, par, extras["dpar_dsnow_depth"]]:
+        assert np.all(np.isnan(value[invalid]))
+        assert np.all(np.isfinite(value[~invalid]))
+    assert np.all(extras["surface_type"][invalid] == 255)
+
+    ice_thickness[3, 4] = ice_thickness[5, 6] = 1.
+    sea_ice_concentration[2, 7, 8] = 0.9
+    expected_flux, expected_par = run_model(*inputs)
+    assert np.allclose(par[~invalid], expected_par[~invalid])
+
+
+def test_quality_counts_written_to_netcdf():
+    quality = np.array([[0, MISSING_INPUT, MISSING_INPUT | OUT_OF_RANGE],
+                        [ZERO_ICE_THICKNESS, 0, 0]], dtype=np.uint8)
+    counts = quality_counts(quality)
+    assert counts == {"valid_cells": 3, "missing_input_cells": 2, "out_of_range_cells": 1,
+                      "zero_ice_thickness_cells": 1, "snow_on_pond_cells": 0,
+                      "no_sea_ice_cells": 0}
+    result = make_netcdf(np.zeros(quality.shape), np.zeros(quality.shape), ("y", "x"), {},
+                         Path("test.nc"), extras={"quality": quality})
+    assert result.quality.attrs["valid_cells"] == 3
+    assert result.quality.attrs["flag_meanings"].split()[1] == "out_of_range"
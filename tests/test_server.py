@@ -0,0 +1,152 @@
+"""Tests for the micro-batching model server"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.server import MicroBatcher, make_server, INPUT_VARIABLES
+
+
+def make_request(n, seed):
+    rng = np.random.default_rng(seed)
+    return {
+        "ice_thickness": rng.uniform(0.2, 3., n).tolist(),
+        "snow_depth": rng.uniform(0.01, 0.5, n).tolist(),
+        "albedo": rng.uniform(0.5, 0.9, n).tolist(),
+        "sw_radiation": rng.uniform(50., 300., n).tolist(),
+        "skin_temperature": rng.uniform(-10., 2., n).tolist(),
+        "sea_ice_concentration": 0.9,
+    }
+
+
+def expected_result(request):
+    arrays = np.broadcast_arrays(*[np.asarray(request[name]) for name in INPUT_VARIABLES])
+    return run_model(*arrays)
+
+
+def test_microbatcher_coalesces_requests():
+    """Checks concurrent requests are evaluated in fewer batches and results
+    are returned to the right request"""
+    batcher = MicroBatcher(max_latency=0.2).start()
+    requests = [make_request(n, seed) for seed, n in enumerate([1, 5, 3, 8])]
+    try:
+        futures = [batcher.submit(request) for request in requests]
+        results = [future.result(timeout=10) for future in futures]
+    finally:
+        batcher.stop()
+
+    for request, (flux, par) in zip(requests, results):
+        expected_flux, expected_par = expected_result(request)
+        assert np.allclose(flux, expected_flux)
+        assert np.allclose(par, expected_par)
+
+    metrics = batcher.metrics.summary()
+    assert metrics["requests"] == len(requests)
+    assert metrics["batches"] < len(requests)
+    assert metrics["cells"] == 17
+
+
+def test_microbatcher_invalid_cell():
+    """Checks an invalid cell is masked without failing its request or batch"""
+    batcher = MicroBatcher(max_latency=0.2).start()
+    good = make_request(3, 0)
+    bad = {**make_request(2, 1), "ice_thickness": [0., 1.]}
+    try:
+        good_future = batcher.submit(good)
+        bad_future = batcher.submit(bad)
+        flux, par = good_future.result(timeout=10)
+        bad_flux, bad_par = bad_future.result(timeout=10)
+    finally:
+        batcher.stop()
+    assert np.allclose(flux, expected_result(good)[0])
+    assert np.isnan(bad_flux[0]) and np.isnan(bad_par[0])
+    assert np.isclose(bad_par[1], expected_result({**bad, "ice_thickness": 1.})[1][1])
+
+
+def test_http_server():
+    server = make_server(port=0, max_latency=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def post(request):
+        req = urllib.request.Request(f"{url}/run", data=json.dumps(request).encode(),
+                                     headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return json.loads(response.read())
+
+    requests = [make_request(4, seed) for seed in range(6)]
+    try:
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            results = list(pool.map(post, requests))
+        with urllib.request.urlopen(f"{url}/metrics", timeout=10) as response:
+            metrics = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.batcher.stop()
+
+    for request, result in zip(requests, results):
+        expected_flux, expected_par = expected_result(request)
+        assert np.allclose(result["sw_flux"], expected_flux)
+        assert np.allclose(result["par"], expected_par)
+    assert metrics["requests"] == 6
+    assert metrics["latency"]["max"] > 0.
+
+
+def test_http_server_masked_cells_are_null():
+    server = make_server(port=0, max_latency=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    request = {**make_request(2, 0), "ice_thickness": [0., 1.]}
+
+    req = urllib.request.Request(f"{url}/run", data=json.dumps(request).encode(),
+                                 headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.batcher.stop()
+
+    # NaN is not valid JSON
+    assert "NaN" not in body
+    result = json.loads(body)
+    assert result["sw_flux"][0] is None and result["par"][0] is None
+    assert np.isclose(result["par"][1], expected_result({**request, "ice_thickness": 1.})[1][1])
+
+
+def test_http_server_internal_error():
+    server = make_server(port=0, max_latency=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def fail(inputs, timeout=None):
+        raise RuntimeError("out of workers")
+    server.batcher.run = fail
+
+    req = urllib.request.Request(f"{url}/run", data=json.dumps(make_request(2, 0)).encode(),
+                                 headers={"Content-Type": "application/json"})
+    try:
+        try:
+            urllib.request.urlopen(req, timeout=10)
+            status, error = 200, None
+        except urllib.error.HTTPError as err:
+            status, error = err.code, json.loads(err.read())["error"]
+        with urllib.request.urlopen(f"{url}/metrics", timeout=10) as response:
+            metrics = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.batcher.stop()
+
+    assert status == 500
+    assert error == "RuntimeError: out of workers"
+    assert metrics["server_errors"] == 1
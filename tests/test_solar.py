@@ -0,0 +1,98 @@
+"""Tests for solar geometry and daily PAR dose"""
+import tracemalloc
+
+import pytest
+import numpy as np
+
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.planner import parse_memory
+from beer_lambert_rt.solar import (cos_zenith, subdaily_times, subdaily_sw,
+                                   daily_mean_sw, daily_par_dose)
+
+
+@pytest.mark.parametrize("time,lat,lon,expected",
+                         [
+                             # Equinox noon at the equator, sun near the zenith
+                             ("2020-03-20T12:07", 0., 0., 1.),
+                             # Solstice at the pole, sun at the declination all day
+                             ("2020-06-21T03:00", 90., 0., np.sin(np.radians(23.44))),
+                             ("2020-06-21T15:00", 90., 120., np.sin(np.radians(23.44))),
+                             # Winter solstice midnight at 70N
+                             ("2020-12-21T00:00", 70., 0., -np.cos(np.radians(70. - 23.44))),
+                         ])
+def test_cos_zenith(time, lat, lon, expected):
+    assert np.isclose(cos_zenith(np.datetime64(time), lat, lon), expected, atol=2e-3)
+
+
+def test_cos_zenith_is_vectorized_over_time_and_grid():
+    times = subdaily_times(np.array(["2020-05-01", "2020-05-02"], dtype="datetime64[D]"))
+    lat, lon = np.meshgrid(np.linspace(60., 90., 4), np.linspace(-180., 180., 5),
+                           indexing="ij")
+    cosz = cos_zenith(times, lat, lon)
+    assert cosz.shape == (2, 24, 4, 5)
+    assert np.isclose(cosz[1, 7, 2, 3], cos_zenith(times[1, 7], lat[2, 3], lon[2, 3]))
+
+
+def test_subdaily_sw_conserves_daily_mean():
+    lat = np.array([0., 60., 75., 85.])
+    lon = np.array([0., 30., -100., 170.])
+    cosz = cos_zenith(subdaily_times(np.datetime64("2020-03-01")), lat, lon)
+    sw = np.array([250., 120., 30., 0.])
+    hourly = subdaily_sw(sw, cosz.copy())
+    assert np.allclose(hourly.mean(axis=0), [250., 120., 30., 0.])
+    assert np.all(hourly[cosz <= 0.] == 0.)
+
+
+def test_daily_mean_sw_matches_numerical_mean():
+    date = np.datetime64("2020-05-01")
+    lat = np.array([60., 75., 89.])
+    minutes = date.astype("datetime64[s]") + np.arange(0, 86400, 60).astype("timedelta64[s]")
+    cosz = cos_zenith(minutes, lat, np.zeros(3))
+    noon = cos_zenith(date + np.timedelta64(12, "h"), lat, np.zeros(3))
+    daily_mean = daily_mean_sw(noon, date, lat, observed_hour=12.)
+    assert np.allclose(daily_mean, np.clip(cosz, 0., None).mean(axis=0), atol=2e-3)
+
+
+def test_daily_par_dose_matches_hourly_run():
+    rng = np.random.default_rng(0)
+    dates = np.array(["2020-04-01", "2020-06-01"], dtype="datetime64[D]")
+    lat, lon = np.meshgrid(np.linspace(65., 88., 6), np.linspace(-150., 150., 7),
+                           indexing="ij")
+    shape = (2,) + lat.shape
+    inputs = [rng.uniform(0.5, 2.5, shape), rng.uniform(0., 0.4, shape),
+              rng.uniform(0.5, 0.85, shape), rng.uniform(50., 300., shape),
+              rng.uniform(-15., 0., shape), rng.uniform(0.6, 1., shape)]
+    flux, dose = daily_par_dose(dates, lat, lon, *inputs)
+    assert flux.shape == dose.shape == shape
+
+    times = subdaily_times(dates)
+    for day in range(2):
+        hourly_sw = subdaily_sw(inputs[3][day], cos_zenith(times[day], lat, lon))
+        hourly_flux, hourly_par = run_model(inputs[0][day], inputs[1][day], inputs[2][day],
+                                            hourly_sw, inputs[4][day], inputs[5][day])
+        assert np.allclose(flux[day], hourly_flux.mean(axis=0))
+        assert np.allclose(dose[day], hourly_par.sum(axis=0) * 3600.)
+
+    assert np.allclose(daily_par_dose(dates, lat, lon, *inputs, max_memory="200KB")[1], dose)
+
+
+def test_daily_par_dose_stays_within_memory_budget():
+    """The unblocked run on this grid allocates about 11MB"""
+    dates = np.array(["2020-04-01", "2020-06-01"], dtype="datetime64[D]")
+    lat, lon = np.meshgrid(np.linspace(65., 88., 30), np.linspace(-150., 150., 40),
+                           indexing="ij")
+    ice_thickness = np.random.default_rng(0).uniform(0.5, 2., (2,) + lat.shape)
+    budget = "2MB"
+    tracemalloc.start()
+    daily_par_dose(dates, lat, lon, ice_thickness, 0.2, 0.7, 200., -5., 0.9,
+                   max_memory=budget)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < parse_memory(budget)
+
+
+def test_daily_par_dose_is_zero_in_polar_night():
+    flux, dose = daily_par_dose(np.datetime64("2020-12-21"), np.array([85.]),
+                                np.array([0.]), 1.5, 0.2, 0.8, 5., -20., 1.,
+                                observed_hour=14.)
+    assert np.all(dose == 0.)
@@ -0,0 +1,66 @@
+"""Startup benchmarks for imports and the CLI
+
+Budgets are generous multiples of the times measured on a workstation
+(about 0.15 s to import beer_lambert_rt.model and 0.06 s for --help) so
+that slow CI machines pass, while an eager import of scipy, xarray or
+pandas would still fail.
+"""
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from beer_lambert_rt.distributions import (PRECOMPUTED_SNOW_DEPTH_FRACTIONS,
+                                           get_bins, standardize_snow_depth,
+                                           get_snow_depth_anomaly_distribution)
+
+REPO = Path(__file__).parent.parent
+
+# Seconds above the startup time of a bare python interpreter
+IMPORT_BUDGET = 0.5
+CLI_HELP_BUDGET = 0.3
+
+SLOW_MODULES = ["scipy", "xarray", "pandas", "pyarrow"]
+
+
+def startup_time(args, repeat=3):
+    """Returns the minimum wall time in seconds to run python with args"""
+    env = {**os.environ, "PYTHONPATH": str(REPO)}
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], env=env, cwd=REPO,
+                       check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_import_model_does_not_load_slow_modules():
+    code = ("import sys, beer_lambert_rt.model, beer_lambert_rt.io, beer_lambert_rt.tables; "
+            f"print(','.join(m for m in {SLOW_MODULES!r} if m in sys.modules))")
+    env = {**os.environ, "PYTHONPATH": str(REPO)}
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=REPO,
+                            check=True, capture_output=True, text=True)
+    assert result.stdout.strip() == ""
+
+
+def test_import_model_startup_budget():
+    baseline = startup_time(["-c", "pass"])
+    assert startup_time(["-c", "import beer_lambert_rt.model"]) - baseline < IMPORT_BUDGET
+
+
+def test_cli_help_startup_budget():
+    baseline = startup_time(["-c", "pass"])
+    assert startup_time(["cli/run_beer_lambert_rt", "--help"]) - baseline < CLI_HELP_BUDGET
+
+
+def test_precomputed_snow_depth_fractions():
+    """Checks precomputed fractions match those calculated with scipy"""
+    for (nbins, factor), expected in PRECOMPUTED_SNOW_DEPTH_FRACTIONS.items():
+        edge, width = get_bins(1., nbins=nbins, factor=factor)
+        prob = get_snow_depth_anomaly_distribution().cdf(standardize_snow_depth(edge, 1.))
+        fraction = np.diff(prob)
+        assert np.allclose(fraction / fraction.sum(), expected, rtol=1e-14, atol=0.)
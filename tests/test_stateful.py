@@ -0,0 +1,75 @@
+"""Tests for the stateful Model"""
+import tracemalloc
+
+import pytest
+import numpy as np
+
+from conftest import make_inputs
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.parameters import Parameters
+from beer_lambert_rt.stateful import Model
+
+
+def make_edge_case_inputs(shape, seed=0):
+    """Returns random inputs with edge cases in the first rows"""
+    inputs = make_inputs(shape, seed)
+    # Missing input, no sea ice, snow free thin and intermediate ice
+    inputs[0][0, 0] = np.nan
+    inputs[5][1, 1] = 0.
+    inputs[1][2, :2] = 0.
+    inputs[0][2, :2] = [0.3, 0.6]
+    return inputs
+
+
+@pytest.mark.parametrize("use_distribution", [True, False])
+@pytest.mark.parametrize("max_memory", [None, "500KB"])
+def test_step_matches_run_model(use_distribution, max_memory):
+    shape = (20, 30)
+    model = Model(shape, use_distribution=use_distribution, max_memory=max_memory,
+                  parameters=Parameters(k_dry_snow=8.))
+    flux, par = np.empty(shape), np.empty(shape)
+    for seed in range(2):
+        inputs = make_edge_case_inputs(shape, seed)
+        expected = run_model(*inputs, use_distribution=use_distribution,
+                             parameters=Parameters(k_dry_snow=8.))
+        result = model.step(inputs, out=(flux, par))
+        assert result[0] is flux and result[1] is par
+        assert np.allclose(flux, expected[0], rtol=1e-12, equal_nan=True)
+        assert np.allclose(par, expected[1], rtol=1e-12, equal_nan=True)
+    assert np.isnan(flux[0, 0]) and np.isnan(par[1, 1])
+
+
+def test_step_broadcasts_inputs():
+    model = Model(5)
+    inputs = dict(ice_thickness=np.linspace(0.5, 2.5, 5), snow_depth=0.2, albedo=0.7,
+                  sw_radiation=200., surface_temperature=-5., sea_ice_concentration=0.9)
+    flux, par = model.step(inputs)
+    expected = run_model(*inputs.values())
+    assert np.allclose(flux, expected[0]) and np.allclose(par, expected[1])
+
+
+def test_step_does_not_allocate_in_steady_state():
+    shape = (200, 300)
+    model = Model(shape, max_memory="4MB")
+    inputs = make_edge_case_inputs(shape)
+    out = (np.empty(shape), np.empty(shape))
+    model.step(inputs, out=out)
+    tracemalloc.start()
+    model.step(inputs, out=out)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # A single (200, 300) float64 array is 480kB
+    assert peak < 16 * 1024
+
+
+@pytest.mark.parametrize("kwargs,out",
+                         [
+                             (dict(parameters=Parameters(k_ice=[1., 1.5])), None),
+                             ({}, (np.empty((4, 3)), np.empty((3, 4)))),
+                             ({}, (np.empty((3, 4), dtype=np.float32), np.empty((3, 4)))),
+                             ({}, (np.empty((4, 3)).T, np.empty((3, 4)))),
+                             (dict(max_memory="1KB"), None),
+                         ])
+def test_model_raises(kwargs, out):
+    with pytest.raises(ValueError):
+        Model((3, 4), **kwargs).step([1., 0.2, 0.7, 200., -5., 0.9], out=out)
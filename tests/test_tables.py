@@ -0,0 +1,109 @@
+"""Tests for chunked csv and parquet reading and writing"""
+import pytest
+import numpy as np
+import pandas as pd
+
+import beer_lambert_rt.io as io
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.tables import (read_csv_batches, read_parquet_batches,
+                                    run_csv, run_parquet, get_engine, MODEL_INPUTS)
+
+
+requires_pyarrow = pytest.mark.skipif(get_engine() != "pyarrow",
+                                      reason="pyarrow is not installed")
+
+ENGINES = ["pandas", pytest.param("pyarrow", marks=requires_pyarrow)]
+
+
+def make_points(path, nrows=1000, seed=0):
+    """Writes a csv file of random points"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "ice_thickness": rng.uniform(0.2, 3., nrows),
+        "snow_depth": rng.uniform(0., 0.5, nrows),
+        "pond_depth": 0.,
+        "sw_radiation": rng.uniform(0., 300., nrows),
+        "albedo": rng.uniform(0.5, 0.9, nrows),
+        "sea_ice_concentration": rng.uniform(0.5, 1., nrows),
+        "surface_temperature": rng.uniform(-20., 1., nrows),
+        }, index=pd.date_range("2020-01-01", periods=nrows, freq="h"))
+    df.to_csv(path)
+    return df
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_read_csv_batches(engine, tmp_path):
+    df = make_points(tmp_path / "points.csv")
+    batches = list(read_csv_batches(tmp_path / "points.csv", batch_size=128, engine=engine))
+    assert max(len(batch[""]) for batch in batches) <= 128
+    assert sum(len(batch[""]) for batch in batches) == len(df)
+    for name in MODEL_INPUTS:
+        assert np.allclose(np.concatenate([batch[name] for batch in batches]), df[name])
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_run_csv_matches_eager(engine, tmp_path):
+    """Checks results streamed in batches match the whole file"""
+    data = io.load_csv(io.test_datapath("csv"))
+    flux, par = run_model(*[data[name] for name in MODEL_INPUTS])
+
+    outpath = tmp_path / "out.csv"
+    nrows = run_csv(io.test_datapath("csv"), outpath, batch_size=3, engine=engine)
+    result = pd.read_csv(outpath)
+    assert nrows == len(result) == flux.size
+    assert list(result.columns) == ["index", "sw_flux", "par"]
+    assert list(result["index"]) == [str(t.date()) for t in data.indexes["index"]]
+    assert np.allclose(result["sw_flux"], flux)
+    assert np.allclose(result["par"], par)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_read_csv_batches_float_after_first_block(engine, tmp_path):
+    """Checks columns that start with whole numbers are read as floats"""
+    df = make_points(tmp_path / "points.csv", nrows=5000)
+    df["snow_depth"] = ["0"] * (len(df) - 1) + ["0.25"]
+    df["buoy"] = "a"
+    df.to_csv(tmp_path / "points.csv")
+    batches = list(read_csv_batches(tmp_path / "points.csv", batch_size=128, engine=engine))
+    assert set(batches[0]) == {""} | set(io.EXPECTED_VARIABLES)
+    snow_depth = np.concatenate([batch["snow_depth"] for batch in batches])
+    assert snow_depth.dtype == np.float64
+    assert snow_depth[-1] == 0.25 and (snow_depth[:-1] == 0.).all()
+
+
+def test_read_csv_batches_missing_column_raises(tmp_path):
+    make_points(tmp_path / "points.csv").drop(columns="albedo").to_csv(tmp_path / "bad.csv")
+    with pytest.raises(KeyError):
+        next(read_csv_batches(tmp_path / "bad.csv"))
+
+
+@requires_pyarrow
+def test_read_parquet_batches_projects_columns(tmp_path):
+    df = make_points(tmp_path / "points.csv")
+    df["buoy"] = "a"
+    df.to_parquet(tmp_path / "points.parquet", row_group_size=300)
+    batches = list(read_parquet_batches(tmp_path / "points.parquet", batch_size=128))
+    assert set(batches[0]) == {"index"} | set(io.EXPECTED_VARIABLES)
+    assert max(len(batch["index"]) for batch in batches) <= 128
+    index = np.concatenate([batch["index"] for batch in batches])
+    assert (index == df.index.to_numpy()).all()
+
+
+@requires_pyarrow
+@pytest.mark.parametrize("partition_by", [None, "date"])
+def test_run_parquet_matches_eager(partition_by, tmp_path):
+    df = make_points(tmp_path / "points.csv")
+    df.to_parquet(tmp_path / "points.parquet", row_group_size=300)
+    flux, par = run_model(*[df[name].to_numpy() for name in MODEL_INPUTS])
+
+    outpath = tmp_path / "out.parquet"
+    nrows = run_parquet(tmp_path / "points.parquet", outpath, batch_size=128,
+                        partition_by=partition_by)
+    result = pd.read_parquet(outpath).sort_values("index")
+    assert nrows == len(result) == len(df)
+    assert np.allclose(result["sw_flux"], flux)
+    assert np.allclose(result["par"], par)
+    if partition_by == "date":
+        assert len(list(outpath.iterdir())) == len(np.unique(df.index.date))
+        with pytest.raises(FileExistsError):
+            run_parquet(tmp_path / "points.parquet", outpath, partition_by="date")
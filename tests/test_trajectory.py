@@ -0,0 +1,98 @@
+"""Tests for the Lagrangian trajectory mode"""
+import pytest
+import numpy as np
+import xarray as xr
+
+from beer_lambert_rt.model import run_model
+from beer_lambert_rt.profiling import MemoryProfiler
+from beer_lambert_rt.tables import MODEL_INPUTS
+from beer_lambert_rt.trajectory import (ease_grid_north, fractional_index, bilinear_weights,
+                                        bilinear_sample, time_step_index, run_trajectories,
+                                        EASE_GRID_EARTH_RADIUS)
+
+
+SPACING = 100_000.
+COORD = np.arange(-10, 11) * SPACING
+TIMES = np.array(["2020-04-01", "2020-04-02", "2020-04-03"], dtype="datetime64[ns]")
+
+
+def make_forcing():
+    """Returns forcing that is linear in x and y, with static ice thickness"""
+    y, x = np.meshgrid(COORD, COORD, indexing="ij")
+    ramp = (x + y) / (40. * SPACING) + 0.5
+    day = np.arange(TIMES.size)[:, np.newaxis, np.newaxis]
+    dims = ("time", "y", "x")
+    return xr.Dataset({
+        "ice_thickness": (("y", "x"), 1. + ramp),
+        "snow_depth": (dims, np.broadcast_to(0.1 + 0.2 * ramp, (3,) + ramp.shape)),
+        "albedo": (dims, np.broadcast_to(0.8 - 0.1 * ramp, (3,) + ramp.shape)),
+        "sw_radiation": (dims, 100. + 50. * day + 10. * ramp),
+        "surface_temperature": (dims, -10. + day + ramp),
+        "sea_ice_concentration": (dims, np.broadcast_to(0.9 + 0.1 * ramp, (3,) + ramp.shape)),
+        }, coords={"time": TIMES, "y": COORD[::-1], "x": COORD})
+
+
+def test_ease_grid_north():
+    assert np.allclose(ease_grid_north(90., 0.), 0.)
+    x, y = ease_grid_north(0., 90.)
+    assert np.isclose(x, np.sqrt(2.) * EASE_GRID_EARTH_RADIUS)
+    assert np.isclose(y, 0., atol=1e-6)
+
+
+def test_bilinear_sample_is_exact_for_linear_fields():
+    rng = np.random.default_rng(0)
+    fy, fx = rng.uniform(0., 4., 50), rng.uniform(0., 6., 50)
+    fy[0], fx[1] = np.nan, 7.5
+    field = 2. + 3. * np.arange(5)[:, np.newaxis] - np.arange(7)[np.newaxis, :]
+    fx = np.where(fx > 6., np.nan, fx)
+    value = bilinear_sample(field, *bilinear_weights(fy, fx, field.shape))
+    assert np.isnan(value[:2]).all()
+    assert np.allclose(value[2:], (2. + 3. * fy - fx)[2:])
+
+
+def test_fractional_index_descending():
+    assert np.allclose(fractional_index([COORD[-1], 0.5 * SPACING], COORD[::-1]), [0., 9.5])
+    assert np.isnan(fractional_index([COORD[-1] + 1.], COORD)).all()
+
+
+def test_time_step_index():
+    times = np.array(["2020-03-31T12", "2020-04-01T00", "2020-04-02T23", "2020-04-04T00"],
+                     dtype="datetime64[ns]")
+    assert list(time_step_index(times, TIMES)) == [-1, 0, 1, -1]
+
+
+def test_run_trajectories_matches_grid():
+    """Points at grid nodes give the model result for the node on the day
+    of each point, and each field is loaded once per time step"""
+    forcing = make_forcing()
+    iy, ix, day = np.array([2, 5, 5, 12, 20]), np.array([3, 5, 8, 0, 20]), np.array([0, 0, 2, 1, 2])
+    x, y = COORD[ix], COORD[::-1][iy]
+    # Inverts ease_grid_north to place points on grid nodes
+    rho = np.hypot(x, y)
+    lat = np.degrees(np.pi / 2. - 2. * np.arcsin(rho / (2. * EASE_GRID_EARTH_RADIUS)))
+    lon = np.degrees(np.arctan2(x, -y))
+    time = TIMES[day] + np.timedelta64(6, "h")
+
+    with MemoryProfiler(trace=False, sample_rss=False) as profiler:
+        result = run_trajectories(time, lat, lon, forcing)
+    # One static field, and five time-varying fields for each of 3 days
+    assert profiler.summary()["load"]["calls"] == 1 + 5 * 3
+
+    nodes = [forcing[name].values[..., iy, ix] for name in MODEL_INPUTS]
+    nodes = [node if node.ndim == 1 else node[day, np.arange(day.size)] for node in nodes]
+    for name, node in zip(MODEL_INPUTS, nodes):
+        assert np.allclose(result[name], node)
+    flux, par = run_model(*nodes)
+    assert np.allclose(result["sw_flux"], flux)
+    assert np.allclose(result["par"], par)
+
+
+def test_run_trajectories_outside_grid_is_nan():
+    result = run_trajectories(TIMES[:2], [45., 89.], [0., 0.], make_forcing())
+    assert np.isnan(result["par"][0])
+    assert np.isfinite(result["par"][1])
+
+
+def test_run_trajectories_size_mismatch_raises():
+    with pytest.raises(ValueError):
+        run_trajectories(TIMES, [89.], [0.], make_forcing())
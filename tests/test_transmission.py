@@ -180,3 +180,39 @@ def test_get_transmittance(ndim, use_distribution):
                                             pond_depth, skin_temperature,
                                             use_distribution=use_distribution)
     assert result.shape == ice_thickness.shape
+
+
+# surface_type requires skin temperature above 0 for wet snow
+EXPECTED_SURFACE_TYPE = {
+    "dry_snow": "dry_snow",
+    "wet_snow": "dry_snow",
+    "thin_wet_snow": "dry_snow",
+    "thick_bare_ice": "bare_ice",
+    "medium1_bare_ice": "bare_ice",
+    "medium2_bare_ice": "bare_ice",
+    "thin_bare_ice": "thin_bare_ice",
+    "melt_pond": "bare_ice",  # first matching condition wins
+    }
+
+
+def test_surface_type_flag():
+    names = list(SURFACE_CONDITION)
+    inputs = [np.array([SURFACE_CONDITION[name][key] for name in names])
+              for key in ["hice", "hsnow", "hpond", "skin_temperature"]]
+    flag = transmission.surface_type_flag(*inputs)
+    assert flag.dtype == np.uint8
+    meanings = [transmission.SURFACE_TYPE_FLAG_MEANINGS[value] for value in flag]
+    assert meanings == [EXPECTED_SURFACE_TYPE[name] for name in names]
+
+    labels = transmission.surface_type(*inputs)
+    assert [label.lower().replace(" ", "_") for label in labels] == meanings
+
+    flag = transmission.surface_type_flag(np.array([1.5, 1.5]), np.array([0.3, 0.01]),
+                                          0., np.array([0.5, 0.5]))
+    assert list(flag) == [0, 1]
+
+
+def test_surface_type_flag_fill_value():
+    flag = transmission.surface_type_flag(np.array([1.5, np.nan]), np.array([np.nan, 0.]),
+                                          0., np.array([-5., -5.]))
+    assert (flag == transmission.SURFACE_TYPE_FILL_VALUE).all()